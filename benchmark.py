@@ -0,0 +1,190 @@
+"""
+benchmark.py
+
+Microbenchmarks for the backend hot paths.
+
+Run with:
+  python benchmark.py                    # compare against benchmark_baseline.json
+  python benchmark.py --save-baseline    # store the current results as baseline
+  python benchmark.py --threshold 0.5    # allow 50 % slowdown before failing
+
+Each benchmark reports the best per-call time over several repeats. With a
+baseline present the script exits with status 1 if any benchmark got slower
+than baseline × (1 + threshold).
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+from contextlib import ExitStack
+from unittest import mock
+
+from fastapi.encoders import jsonable_encoder
+
+import modbus_interaction
+import rest_api
+import shared_state
+import sites
+import solar_charging
+from energy_sources import source_polling
+from device_simulator import SIMULATOR_HOST, build_emeter_datagram, start_simulators
+
+BASELINE_PATH     = "benchmark_baseline.json"
+DEFAULT_THRESHOLD = 0.2
+REPEATS           = 5
+
+GRID_METER_ADDR = ("192.168.188.54", 9522)
+
+
+def _bench_emeter_parsing(stack: ExitStack):
+    feed_in_datagram = build_emeter_datagram(consumption=0, feed_in=35000)
+    consumption_datagram = build_emeter_datagram(consumption=12000, feed_in=0)
+
+    def run():
+        rest_api._parse_emeter_datagram(feed_in_datagram, GRID_METER_ADDR)
+        rest_api._parse_emeter_datagram(consumption_datagram, GRID_METER_ADDR)
+    return run
+
+
+def _bench_sma_decoding(stack: ExitStack):
+    signed = dict(modbus_interaction.sma_devices["battery_power"])
+    unsigned = dict(modbus_interaction.sma_devices["tripower_total_power"])
+    nan = dict(modbus_interaction.sma_devices["battery_SoC"])
+    # negative battery power, plain PV power, NaN marker
+    responses = {
+        signed["ip"] + str(signed["register"]):     [0xFFFF, 0xFA24],
+        unsigned["ip"] + str(unsigned["register"]): [0x0000, 0x1518],
+        nan["ip"] + str(nan["register"]):           [0xFFFF, 0xFFFF],
+    }
+    stack.enter_context(mock.patch.object(
+        modbus_interaction, "read_modbus_data",
+        lambda ip, modbus_port, register, slave, count: responses[ip + str(register)],
+    ))
+
+    def run():
+        modbus_interaction.read_sma_modbus_data(**signed)
+        modbus_interaction.read_sma_modbus_data(**unsigned)
+        modbus_interaction.read_sma_modbus_data(**nan)
+    return run
+
+
+def _bench_excess_and_target(stack: ExitStack):
+    shared_state.grid_power = -42000
+    shared_state.battery_power = -2500
+    shared_state.battery_SoC = 60
+
+    def run():
+        excess = solar_charging._current_excess_power()
+        solar_charging._calculate_wallbox_target_current(8000, excess, 3)
+    return run
+
+
+def _bench_power_data_serialization(stack: ExitStack):
+    sites.default_site().totals = source_polling.aggregate()
+
+    def run():
+        json.dumps(jsonable_encoder(rest_api.get_power_data()))
+    return run
+
+
+def _bench_modbus_round_trip(stack: ExitStack):
+    port = start_simulators()["tripower"]
+    # the stand-in can take any rate; keep the scheduler out of the measurement
+    modbus_interaction.device_max_requests_per_second[(SIMULATOR_HOST, port, 3)] = 1e9
+    # every call reads the same range: without this all but the first were read cache hits
+    stack.enter_context(mock.patch.object(modbus_interaction, "READ_CACHE_TTL_S", 0))
+
+    def run():
+        modbus_interaction.read_modbus_data(SIMULATOR_HOST, port, 30775, 3, 2)
+    return run
+
+
+def _bench_modbus_batch_read(stack: ExitStack):
+    port = start_simulators()["tripower"]
+    modbus_interaction.device_max_requests_per_second[(SIMULATOR_HOST, port, 3)] = 1e9
+    stack.enter_context(mock.patch.object(modbus_interaction, "READ_CACHE_TTL_S", 0))
+    requests = [
+        {"ip": SIMULATOR_HOST, "modbus_port": port, "register": register, "slave": 3, "count": 2}
+        for register in (30773, 30775, 30961, 30967)
+    ]
+
+    # a batch of timeouts would be measured as a very slow read
+    if None in modbus_interaction.read_modbus_batch(requests):
+        raise RuntimeError("Batch read against the simulated Tripower failed")
+
+    def run():
+        modbus_interaction.read_modbus_batch(requests)
+    return run
+
+
+# name → (setup returning the function to time, calls per repeat)
+BENCHMARKS = {
+    "emeter_parsing":           (_bench_emeter_parsing, 20000),
+    "sma_decoding":             (_bench_sma_decoding, 2000),
+    "excess_and_target":        (_bench_excess_and_target, 20000),
+    "power_data_serialization": (_bench_power_data_serialization, 1000),
+    "modbus_round_trip":        (_bench_modbus_round_trip, 50),
+    "modbus_batch_read":        (_bench_modbus_batch_read, 50),
+}
+
+
+def run_benchmarks() -> dict[str, float]:
+    """Returns the best time per call in microseconds."""
+    results = {}
+    for name, (setup, number) in BENCHMARKS.items():
+        with ExitStack() as stack:
+            func = setup(stack)
+            best = min(timeit.repeat(func, number=number, repeat=REPEATS)) / number
+        results[name] = round(best * 1e6, 3)
+        print(f"{name:<28} {results[name]:>12.3f} µs")
+    return results
+
+
+def compare(results: dict[str, float], baseline: dict[str, float], threshold: float) -> list[str]:
+    regressions = []
+    for name, value in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+        change = value / reference - 1
+        marker = "REGRESSION" if change > threshold else "ok"
+        print(f"{name:<28} {reference:>12.3f} → {value:>12.3f} µs  {change:+7.1%}  {marker}")
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed relative slowdown (0.2 = 20 %%)")
+    args = parser.parse_args()
+
+    results = run_benchmarks()
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline} – run with --save-baseline first")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    print()
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
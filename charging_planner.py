@@ -0,0 +1,276 @@
+"""
+charging_planner.py
+
+Departure-time charging plans for solar-only wallboxes.
+
+A plan says "this car needs target_energy_wh by departure". The planner
+forecasts the solar excess until departure from the recorded meter history
+(see meter_history.py) and schedules the smallest grid top-up that still
+reaches the target. The top-up is placed as late as possible (before a safety
+margin ahead of departure), so solar that turns out better than forecast
+replaces grid energy. The regulator charges at least at the plan's floor
+current; above it, it keeps following the solar excess.
+
+Forecast
+────────
+Solar excess = power the EV could take without grid import
+             = wallbox power − grid power − battery power
+It is kept as sum/count per (day of year, SLOT_S time-of-day slot). The
+forecast for a day averages the slots of ±SEASON_WINDOW_DAYS around it over
+all recorded years. Every new history record updates one cell and the cached
+window sums that contain it, and the plans are recomputed from the remaining
+slots – nothing is reloaded or rescanned.
+"""
+
+import logging
+import math
+import threading
+import time
+from datetime import date, datetime
+from typing import Optional
+
+import numpy as np
+
+import energy_accounting
+import meter_history
+import power_model
+import shared_state
+# module import: solar_charging imports this module for floor_current
+import solar_charging
+
+SLOT_S             = 900           # 15-minute time-of-day slots
+SLOTS_PER_DAY      = 24 * 3600 // SLOT_S
+DAYS_PER_YEAR      = 366
+SEASON_WINDOW_DAYS = 14
+
+# Share of the forecast solar energy the plan relies on
+FORECAST_CONFIDENCE = 0.8
+
+# The grid top-up is scheduled to be done this long before departure
+SAFETY_MARGIN_S = 3600
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+
+# sum of solar excess samples (W) and sample count per (day of year, slot)
+_excess_sum   = np.zeros((DAYS_PER_YEAR, SLOTS_PER_DAY))
+_excess_count = np.zeros((DAYS_PER_YEAR, SLOTS_PER_DAY))
+
+# day of year → (window sum, window count) per slot
+_window_cache: dict[int, tuple[np.ndarray, np.ndarray]] = {}
+WINDOW_CACHE_SIZE = 16
+
+# wallbox id → plan
+_plans: dict[int, dict] = {}
+
+
+# ── Profiles ───────────────────────────────────────────────────────────────────
+
+def _day_and_slot(timestamp: float) -> tuple[int, int]:
+    moment = datetime.fromtimestamp(timestamp)
+    midnight = datetime.combine(moment.date(), datetime.min.time()).timestamp()
+    slot = min(int((timestamp - midnight) // SLOT_S), SLOTS_PER_DAY - 1)
+    return moment.timetuple().tm_yday - 1, slot
+
+
+def _excess_w(grid_w, battery_w, wallbox_w):
+    return np.maximum(wallbox_w - grid_w - battery_w, 0)
+
+
+def load(history_dir: str = meter_history.HISTORY_DIR) -> None:
+    """Build the profiles from the stored history and follow new records from then on."""
+    records = meter_history.load_history(history_dir=history_dir)
+    if len(records):
+        timestamps = records["timestamp"]
+        first = datetime.fromtimestamp(timestamps[0]).date()
+        last = datetime.fromtimestamp(timestamps[-1]).date()
+        days = [date.fromordinal(o) for o in range(first.toordinal(), last.toordinal() + 1)]
+        midnights = np.array([datetime.combine(d, datetime.min.time()).timestamp() for d in days])
+        day_of_year = np.array([d.timetuple().tm_yday - 1 for d in days])
+
+        day_index = np.searchsorted(midnights, timestamps, side="right") - 1
+        slots = np.minimum((timestamps - midnights[day_index]) // SLOT_S, SLOTS_PER_DAY - 1).astype(int)
+        cells = day_of_year[day_index] * SLOTS_PER_DAY + slots
+        excess = _excess_w(records["grid_w"], records["battery_w"], records["wallbox_w"])
+
+        size = DAYS_PER_YEAR * SLOTS_PER_DAY
+        with _lock:
+            _excess_sum[:]   = np.bincount(cells, weights=excess, minlength=size).reshape(_excess_sum.shape)
+            _excess_count[:] = np.bincount(cells, minlength=size).reshape(_excess_count.shape)
+            _window_cache.clear()
+        logger.info(f"Charging planner: PV profiles built from {len(records)} history records")
+
+    meter_history.add_listener(_on_history_record)
+
+
+def _window_rows(day_of_year: int) -> np.ndarray:
+    return np.arange(day_of_year - SEASON_WINDOW_DAYS, day_of_year + SEASON_WINDOW_DAYS + 1) % DAYS_PER_YEAR
+
+
+def _window(day_of_year: int) -> tuple[np.ndarray, np.ndarray]:
+    """Cached seasonal window sums for one day of year. Caller holds _lock."""
+    window = _window_cache.get(day_of_year)
+    if window is None:
+        rows = _window_rows(day_of_year)
+        window = _window_cache[day_of_year] = (_excess_sum[rows].sum(axis=0), _excess_count[rows].sum(axis=0))
+        while len(_window_cache) > WINDOW_CACHE_SIZE:
+            del _window_cache[next(iter(_window_cache))]
+    return window
+
+
+def _on_history_record(record: tuple) -> None:
+    timestamp, grid_w, _pv_w, battery_w, _soc, wallbox_w = record
+    day_of_year, slot = _day_and_slot(timestamp)
+    excess = float(_excess_w(grid_w, battery_w, wallbox_w))
+
+    with _lock:
+        _excess_sum[day_of_year, slot] += excess
+        _excess_count[day_of_year, slot] += 1
+        for cached_day, (window_sum, window_count) in _window_cache.items():
+            distance = abs(cached_day - day_of_year)
+            if min(distance, DAYS_PER_YEAR - distance) <= SEASON_WINDOW_DAYS:
+                window_sum[slot] += excess
+                window_count[slot] += 1
+
+    _recompute_plans(timestamp)
+
+
+def forecast_excess_w(slot_starts: np.ndarray) -> np.ndarray:
+    """Expected solar excess (W) for the slots starting at the given times (0 where nothing is recorded)."""
+    forecast = np.zeros(len(slot_starts))
+    with _lock:
+        for i, start in enumerate(slot_starts):
+            day_of_year, slot = _day_and_slot(start)
+            window_sum, window_count = _window(day_of_year)
+            if window_count[slot]:
+                forecast[i] = window_sum[slot] / window_count[slot]
+    return forecast
+
+
+# ── Plans ──────────────────────────────────────────────────────────────────────
+
+def set_plan(wallbox_id: int, target_energy_wh: float, departure: float) -> dict:
+    session = energy_accounting.current_session(wallbox_id)
+    plan = {
+        "wallbox_id":       wallbox_id,
+        "target_energy_wh": target_energy_wh,
+        "departure":        departure,
+        "session_start":    session["start"] if session else None,
+        "energy_offset_wh": session["energy_wh"] if session else 0.0,
+    }
+    with _lock:
+        _plans[wallbox_id] = plan
+    return _compute_plan(plan, time.time())
+
+
+def cancel_plan(wallbox_id: int) -> bool:
+    with _lock:
+        return _plans.pop(wallbox_id, None) is not None
+
+
+def get_plan(wallbox_id: int) -> Optional[dict]:
+    with _lock:
+        plan = _plans.get(wallbox_id)
+        return dict(plan) if plan else None
+
+
+def floor_current(wallbox_id: int) -> int:
+    """Minimum current (mA) the regulator has to keep for the plan right now, 0 = none."""
+    with _lock:
+        plan = _plans.get(wallbox_id)
+        if plan is None or time.time() >= plan["departure"]:
+            return 0
+        return plan.get("floor_current", 0)
+
+
+def snapshot_plans() -> list[dict]:
+    with _lock:
+        return [dict(plan) for plan in _plans.values()]
+
+
+def restore_plans(plans: list[dict]) -> None:
+    """Plans of a predecessor process (handover)."""
+    now = time.time()
+    for plan in plans:
+        with _lock:
+            _plans[plan["wallbox_id"]] = plan
+        _compute_plan(plan, now)
+
+
+def _delivered_wh(plan: dict) -> float:
+    session = energy_accounting.current_session(plan["wallbox_id"])
+    if session is None:
+        return 0.0
+    if session["start"] != plan["session_start"]:
+        # car plugged in after the plan was made: count the whole session
+        plan["session_start"] = session["start"]
+        plan["energy_offset_wh"] = 0.0
+    return session["energy_wh"] - plan["energy_offset_wh"]
+
+
+def _recompute_plans(now: float) -> None:
+    with _lock:
+        plans = list(_plans.values())
+    for plan in plans:
+        if now >= plan["departure"]:
+            logger.info(f"Wallbox {plan['wallbox_id']}: departure reached, charging plan removed")
+            cancel_plan(plan["wallbox_id"])
+            continue
+        _compute_plan(plan, now)
+
+
+def _compute_plan(plan: dict, now: float) -> dict:
+    """Schedule the grid top-up for the remaining time and store the current floor current in the plan."""
+    wb_state = shared_state.wallbox_states[plan["wallbox_id"]]
+    model = power_model.for_state(plan["wallbox_id"], wb_state)
+    ev_min_w = model.power_w(solar_charging.MIN_CHARGING_CURRENT)
+    ev_max_w = model.power_w(solar_charging.MAX_CHARGING_CURRENT)
+
+    remaining_wh = max(plan["target_energy_wh"] - _delivered_wh(plan), 0.0)
+    finish = max(plan["departure"] - SAFETY_MARGIN_S, now)
+
+    # slot grid from now to the planned finish; the first slot is partial
+    boundaries = np.arange((now // SLOT_S + 1) * SLOT_S, finish, SLOT_S)
+    starts = np.concatenate(([now], boundaries))
+    hours = (np.append(boundaries, finish) - starts) / 3600
+
+    solar_w = forecast_excess_w(starts) * FORECAST_CONFIDENCE
+    # below the minimum current the regulator pauses, so small excess is not usable
+    usable_w = np.where(solar_w >= ev_min_w, np.minimum(solar_w, ev_max_w), 0.0)
+    solar_wh = float(np.sum(usable_w * hours))
+
+    shortfall_wh = max(remaining_wh - solar_wh, 0.0)
+    headroom_wh = (ev_max_w - usable_w) * hours
+
+    # fill the grid top-up from the last slot backwards
+    headroom_after = np.cumsum(headroom_wh[::-1])[::-1] - headroom_wh
+    grid_wh = np.clip(shortfall_wh - headroom_after, 0, headroom_wh)
+    grid_w = np.divide(grid_wh, hours, out=np.zeros_like(grid_wh), where=hours > 0)
+    floor_w = np.where(grid_wh > 0, np.maximum(usable_w + grid_w, ev_min_w), 0.0)
+
+    feasible = shortfall_wh <= float(np.sum(headroom_wh)) + 1e-6
+    if remaining_wh <= 0:
+        current = 0
+    elif not feasible:
+        current = solar_charging.MAX_CHARGING_CURRENT
+    else:
+        current = (
+            min(math.ceil(model.current_ma(floor_w[0])), solar_charging.MAX_CHARGING_CURRENT)
+            if floor_w[0] > 0 else 0
+        )
+
+    with _lock:
+        plan.update(
+            updated_at=now,
+            remaining_wh=round(remaining_wh, 1),
+            forecast_solar_wh=round(solar_wh, 1),
+            grid_topup_wh=round(float(np.sum(grid_wh)), 1),
+            feasible=feasible,
+            floor_current=current,
+            schedule=[
+                {"start": float(start), "solar_w": round(float(s), 0), "floor_w": round(float(f), 0)}
+                for start, s, f in zip(starts, usable_w, floor_w)
+            ],
+        )
+        return dict(plan)
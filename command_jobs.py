@@ -0,0 +1,161 @@
+"""
+command_jobs.py
+
+Asynchronous wallbox commands.
+
+The REST handler validates a request, registers a job and returns its ID
+immediately (HTTP 202). One worker per wallbox executes its jobs in
+submission order against the hardware, so a command hanging on one wallbox
+does not hold up the others, and reports every status change through the job table
+(GET /commands/{id}) and the push stream (event type "command").
+
+Job status
+──────────
+  queued   – accepted, waiting for the device
+  running  – write in progress
+  applied  – write done, no read-back for this command
+  verified – read-back matches the requested value
+  failed   – write raised an error or the read-back shows another value
+"""
+
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import event_stream
+
+MAX_JOBS = 500
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_jobs: "OrderedDict[str, dict]" = OrderedDict()
+_actions: dict[str, tuple[Callable, Optional[Callable]]] = {}
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+# wallbox id → job queue / worker task, created on the first job of the wallbox
+_queues: dict[int, asyncio.Queue] = {}
+_workers: dict[int, asyncio.Task] = {}
+
+
+def submit(wallbox_id: int, command: str, params: dict, apply: Callable, verify: Optional[Callable] = None) -> dict:
+    """
+    Register a job and hand it to the executor. Safe to call from any thread.
+
+    apply()  performs the hardware write; its return value is stored as result.
+    verify() reads the device back and returns True when the change is visible.
+    """
+    if _loop is None:
+        raise RuntimeError("Command executor is not running")
+
+    job = {
+        "id":          uuid.uuid4().hex,
+        "wallbox_id":  wallbox_id,
+        "command":     command,
+        "params":      params,
+        "status":      "queued",
+        "result":      None,
+        "error":       None,
+        "created_at":  time.time(),
+        "updated_at":  time.time(),
+    }
+    with _lock:
+        _jobs[job["id"]] = job
+        _actions[job["id"]] = (apply, verify)
+        while len(_jobs) > MAX_JOBS:
+            old_id, _ = _jobs.popitem(last=False)
+            _actions.pop(old_id, None)
+    event_stream.publish("command", dict(job))
+    _loop.call_soon_threadsafe(_enqueue, wallbox_id, job["id"])
+    return dict(job)
+
+
+def _enqueue(wallbox_id: int, job_id: str) -> None:
+    """Runs on the executor's loop."""
+    queue = _queues.get(wallbox_id)
+    if queue is None:
+        queue = _queues[wallbox_id] = asyncio.Queue()
+        _workers[wallbox_id] = asyncio.create_task(
+            _wallbox_worker(wallbox_id, queue), name=f"command_worker_{wallbox_id}"
+        )
+    queue.put_nowait(job_id)
+
+
+def get_job(job_id: str) -> Optional[dict]:
+    with _lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job else None
+
+
+def _update(job_id: str, **changes) -> None:
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is None:
+            return
+        job.update(changes, updated_at=time.time())
+        snapshot = dict(job)
+    event_stream.publish("command", snapshot)
+
+
+async def command_executor():
+    """
+    background task owning the per-wallbox command workers
+    """
+    global _loop
+    _loop = asyncio.get_running_loop()
+    logger.info("✅ Command executor task started")
+    try:
+        await asyncio.Future()   # the workers run the jobs
+    except asyncio.CancelledError:
+        logger.warning("🛑 Command executor cancelled")
+        _loop = None
+        workers = list(_workers.values())
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        _workers.clear()
+        _queues.clear()
+        raise
+
+
+async def _wallbox_worker(wallbox_id: int, queue: asyncio.Queue):
+    """Execute the queued commands of one wallbox in submission order."""
+    while True:
+        try:
+            job_id = await queue.get()
+            with _lock:
+                apply, verify = _actions.pop(job_id, (None, None))
+            if apply is None:
+                continue  # evicted before it ran
+
+            _update(job_id, status="running")
+            try:
+                result = await asyncio.to_thread(apply)
+            except Exception as e:
+                logger.error(f"Command {job_id} failed: {e}")
+                _update(job_id, status="failed", error=str(e))
+                continue
+
+            _update(job_id, status="applied", result=result)
+            if verify is None:
+                continue
+            try:
+                verified = await asyncio.to_thread(verify)
+            except Exception as e:
+                verified, error = False, f"read-back failed: {e}"
+            else:
+                error = "read-back does not show the requested value"
+            if verified:
+                _update(job_id, status="verified")
+            else:
+                logger.error(f"Command {job_id}: {error}")
+                _update(job_id, status="failed", error=error)
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"⚠️ Command worker error (wallbox {wallbox_id}): {e}")
@@ -0,0 +1,135 @@
+"""
+controller.py
+
+Controller process for the multi-worker deployment.
+
+Exactly one controller owns the hardware: it receives the SMA meter stream,
+polls the battery, runs the solar regulation and executes every write
+command. API workers never touch a device; they read the snapshot published
+here and forward commands (see controller_ipc.py).
+
+Run with (both need the same PV_BACKEND_AUTHKEY, e.g. from `openssl rand -hex 32`):
+  python controller.py
+  PV_BACKEND_ROLE=worker uvicorn rest_api:app --host 0.0.0.0 --port 8000 --workers 4
+"""
+
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+
+os.environ["PV_BACKEND_ROLE"] = "controller"
+
+import event_stream  # noqa: E402
+import rest_api  # noqa: E402  (role must be set before import)
+from controller_ipc import COMMAND_TIMEOUT_S, SeqlockSharedMemory, serve_command_queue  # noqa: E402
+
+# Seconds between two snapshots published to the API workers
+CONTROLLER_PUBLISH_INTERVAL_S = 1
+
+# How long the command loop blocks on the queue before checking for cancellation
+COMMAND_QUEUE_POLL_S = 0.5
+
+logger = logging.getLogger("controller")
+
+
+async def publish_state(state: SeqlockSharedMemory):
+    """
+    background task to publish the API snapshot into shared memory
+    (get_power_data only reads the aggregated state, no device I/O)
+    """
+    logger.info("✅ State publisher task started")
+    while True:
+        try:
+            power_data = await asyncio.to_thread(rest_api.get_power_data)
+            state.publish({
+                "published_at": time.time(),
+                "power_data": power_data,
+                "modbus_schedulers": rest_api.get_modbus_schedulers(),
+                "events": event_stream.recent_events(),
+            })
+            await asyncio.sleep(CONTROLLER_PUBLISH_INTERVAL_S)
+        except asyncio.CancelledError:
+            logger.warning("🛑 State publisher cancelled")
+            raise
+        except Exception as e:
+            logger.error(f"⚠️ State publisher error: {e}")
+            await asyncio.sleep(1)
+
+
+def _store_reply(replies: dict, reply_times: dict, command_id: str, reply: dict) -> None:
+    """Hand a reply to the worker and drop the replies no worker waits for anymore."""
+    now = time.monotonic()
+    replies[command_id] = reply
+    reply_times[command_id] = now
+    for stale_id, replied_at in list(reply_times.items()):
+        if now - replied_at > COMMAND_TIMEOUT_S:
+            del reply_times[stale_id]
+            replies.pop(stale_id, None)
+
+
+async def process_commands(command_queue: queue.Queue, replies: dict, reply_times: dict, name: str = "Command"):
+    """
+    background task to execute commands forwarded by the API workers, one at a time
+    """
+    logger.info(f"✅ {name} processing task started")
+    while True:
+        try:
+            try:
+                command = await asyncio.to_thread(command_queue.get, True, COMMAND_QUEUE_POLL_S)
+            except queue.Empty:
+                continue
+            logger.info(f"Executing command {command['command']} {command['params']}")
+            reply = await asyncio.to_thread(
+                rest_api.execute_controller_command, command["command"], command["params"]
+            )
+            _store_reply(replies, reply_times, command["id"], reply)
+        except asyncio.CancelledError:
+            logger.warning(f"🛑 {name} processing cancelled")
+            raise
+        except Exception as e:
+            logger.error(f"⚠️ {name} processing error: {e}")
+
+
+async def main():
+    command_queue: queue.Queue = queue.Queue()
+    read_queue: queue.Queue = queue.Queue()
+    replies: dict = {}
+    reply_times: dict = {}
+
+    # first: refuses to start without an authkey
+    manager = serve_command_queue(command_queue, read_queue, replies)
+    state = SeqlockSharedMemory.create()
+    server = manager.get_server()
+    threading.Thread(target=server.serve_forever, name="command_queue", daemon=True).start()
+    logger.info(f"✅ Command queue listening on {server.address[0]}:{server.address[1]}")
+
+    await rest_api.load_state()
+    tasks = rest_api.start_background_tasks() + [
+        asyncio.create_task(publish_state(state), name="publish_state"),
+        asyncio.create_task(process_commands(command_queue, replies, reply_times), name="process_commands"),
+        # reads (get_*) must not wait behind device writes
+        asyncio.create_task(
+            process_commands(read_queue, replies, reply_times, name="Read command"), name="process_read_commands"
+        ),
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        state.close()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logger.info("Controller stopped")
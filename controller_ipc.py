@@ -0,0 +1,207 @@
+"""
+controller_ipc.py
+
+Inter-process plumbing for the controller / API-worker deployment mode.
+
+One controller process (see controller.py) owns the hardware, the UDP meter
+stream and the regulation loop. It publishes a JSON snapshot of its state into
+a shared-memory segment guarded by a seqlock, and it receives commands from
+the API workers over two local manager queues: one for commands that only
+read (get_*), one for everything else, so reads never wait behind device
+writes.
+
+Any number of stateless uvicorn workers (PV_BACKEND_ROLE=worker) attach to
+the segment for reads and forward write requests to the controller.
+
+Shared-memory layout
+────────────────────
+  [0:8]   sequence counter (uint64, odd while the writer is updating)
+  [8:12]  payload length   (uint32)
+  [12:]   payload          (UTF-8 JSON)
+"""
+
+import itertools
+import json
+import logging
+import os
+import queue
+import struct
+import time
+from typing import Optional
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.managers import BaseManager, DictProxy
+
+logger = logging.getLogger(__name__)
+
+SHARED_STATE_NAME  = os.environ.get("PV_BACKEND_SHM_NAME", "pv_backend_state")
+SHARED_STATE_SIZE  = 1024 * 1024       # bytes, header included
+
+CONTROLLER_ADDRESS = ("127.0.0.1", int(os.environ.get("PV_BACKEND_CONTROLLER_PORT", "50555")))
+# The manager channel exchanges pickles: whoever knows the key can run code in
+# the controller. There is no default; controller and workers share it via the environment.
+CONTROLLER_AUTHKEY_ENV = "PV_BACKEND_AUTHKEY"
+
+# A command may trigger Modbus read-before-write plus write, each with a 10 s timeout
+COMMAND_TIMEOUT_S      = 30
+COMMAND_POLL_INTERVAL_S = 0.02
+
+# Commands with this prefix only read controller state and use the read queue
+READ_COMMAND_PREFIX = "get_"
+
+# A snapshot older than this (about five publish intervals) means the controller is gone
+SNAPSHOT_MAX_AGE_S = 5
+
+_HEADER = struct.Struct("<QI")
+
+
+# ── Seqlock-guarded shared memory ──────────────────────────────────────────────
+
+class SeqlockSharedMemory:
+    """
+    Single-writer / multi-reader JSON snapshot in a shared-memory segment.
+
+    The writer bumps the sequence counter to an odd value, writes the payload
+    and bumps it to the next even value. Readers retry until they copied the
+    payload between two identical, even counter values.
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool):
+        self._shm = shm
+        self._owner = owner
+        self._seq = 0
+
+    @classmethod
+    def create(cls, name: str = SHARED_STATE_NAME, size: int = SHARED_STATE_SIZE) -> "SeqlockSharedMemory":
+        try:
+            # left over from a controller that did not shut down cleanly
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        _HEADER.pack_into(shm.buf, 0, 0, 0)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name: str = SHARED_STATE_NAME) -> "SeqlockSharedMemory":
+        shm = shared_memory.SharedMemory(name=name)
+        # Attaching registers the segment with this process' resource tracker,
+        # which would unlink it when the worker exits. Only the controller owns it.
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm, owner=False)
+
+    def publish(self, data: dict) -> None:
+        payload = json.dumps(data, separators=(",", ":")).encode()
+        if len(payload) > self._shm.size - _HEADER.size:
+            logger.error(f"Snapshot of {len(payload)} bytes does not fit into shared memory – skipped")
+            return
+
+        buf = self._shm.buf
+        self._seq += 1                                   # odd: write in progress
+        struct.pack_into("<Q", buf, 0, self._seq)
+        struct.pack_into("<I", buf, 8, len(payload))
+        buf[_HEADER.size:_HEADER.size + len(payload)] = payload
+        self._seq += 1                                   # even: consistent
+        struct.pack_into("<Q", buf, 0, self._seq)
+
+    def read(self, timeout: float = 1.0) -> Optional[dict]:
+        buf = self._shm.buf
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            seq_before, length = _HEADER.unpack_from(buf, 0)
+            if seq_before % 2:
+                time.sleep(0)
+                continue
+            payload = bytes(buf[_HEADER.size:_HEADER.size + length])
+            seq_after = struct.unpack_from("<Q", buf, 0)[0]
+            if seq_before == seq_after:
+                return json.loads(payload) if seq_before else None
+        logger.warning("Timed out waiting for a consistent shared-memory snapshot")
+        return None
+
+    def close(self) -> None:
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+# ── Command queue ──────────────────────────────────────────────────────────────
+
+class ControllerManager(BaseManager):
+    """Local manager exposing the controller's command queues and reply table."""
+
+
+class _ControllerServerManager(BaseManager):
+    """Controller-side twin of ControllerManager holding the actual objects."""
+
+
+ControllerManager.register("get_command_queue")
+ControllerManager.register("get_read_queue")
+ControllerManager.register("get_replies", proxytype=DictProxy)
+
+
+def is_read_command(command: str) -> bool:
+    return command.startswith(READ_COMMAND_PREFIX)
+
+
+def _authkey() -> bytes:
+    key = os.environ.get(CONTROLLER_AUTHKEY_ENV)
+    if not key:
+        raise RuntimeError(
+            f"{CONTROLLER_AUTHKEY_ENV} is not set – set the same random secret for the controller and the workers"
+        )
+    return key.encode()
+
+
+def serve_command_queue(command_queue: queue.Queue, read_queue: queue.Queue, replies: dict) -> BaseManager:
+    """Register the controller-side objects and return an (unstarted) manager."""
+    _ControllerServerManager.register("get_command_queue", callable=lambda: command_queue)
+    _ControllerServerManager.register("get_read_queue", callable=lambda: read_queue)
+    _ControllerServerManager.register("get_replies", callable=lambda: replies, proxytype=DictProxy)
+    return _ControllerServerManager(address=CONTROLLER_ADDRESS, authkey=_authkey())
+
+
+class ControllerClient:
+    """Used by API workers to read the snapshot and submit commands."""
+
+    def __init__(self):
+        self._manager = ControllerManager(address=CONTROLLER_ADDRESS, authkey=_authkey())
+        self._manager.connect()
+        self._commands = self._manager.get_command_queue()
+        self._reads = self._manager.get_read_queue()
+        self._replies = self._manager.get_replies()
+        self._state = SeqlockSharedMemory.attach()
+        self._ids = itertools.count()
+        logger.info(f"✅ Connected to controller at {CONTROLLER_ADDRESS[0]}:{CONTROLLER_ADDRESS[1]}")
+
+    def read_snapshot(self) -> dict:
+        snapshot = self._state.read()
+        if snapshot is None:
+            raise RuntimeError("Controller has not published a snapshot yet")
+        age = time.time() - snapshot["published_at"]
+        if age > SNAPSHOT_MAX_AGE_S:
+            raise RuntimeError(f"Controller snapshot is {age:.0f}s old – controller not running")
+        return snapshot
+
+    def send_command(self, command: str, params: dict) -> dict:
+        """
+        Enqueue a command and wait for the controller's reply.
+        Returns a dict with status_code, detail and result.
+        """
+        command_id = f"{os.getpid()}-{next(self._ids)}"
+        target = self._reads if is_read_command(command) else self._commands
+        target.put({"id": command_id, "command": command, "params": params})
+
+        deadline = time.monotonic() + COMMAND_TIMEOUT_S
+        while time.monotonic() < deadline:
+            reply = self._replies.pop(command_id, None)
+            if reply is not None:
+                return reply
+            time.sleep(COMMAND_POLL_INTERVAL_S)
+        # a reply that arrived meanwhile; later ones are dropped by the controller
+        self._replies.pop(command_id, None)
+        raise TimeoutError(f"Controller did not answer command {command} within {COMMAND_TIMEOUT_S}s")
+
+    def close(self) -> None:
+        self._state.close()
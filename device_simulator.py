@@ -0,0 +1,147 @@
+"""
+device_simulator.py
+
+Local stand-ins for the hardware, used by the benchmarks, the load test and
+the discovery scan tests.
+
+Each simulated device is a pymodbus TCP server on 127.0.0.1 with the register
+map the backend expects:
+
+  tripower      unit 3: 30773/30775/30961/30967 (PV power, W)
+  sunny_island  unit 3: 30775 (battery power, signed W), 30845 (SoC %)
+  juice         unit 1: 122 (IEC 61851 state), 1000 (max current, A, writable)
+  keba          unit 1: 1000 (state), 1020 (active power, mW), 1100 (max current, mA),
+                        5004 (set current, mirrored to 1100), 5014 (enable)
+
+build_emeter_datagram() produces SMA EMETER datagrams for the UDP parser.
+
+Run standalone with:
+  python device_simulator.py [base_port]
+"""
+
+import asyncio
+import socket
+import struct
+import sys
+import threading
+import time
+
+from pymodbus.datastore import ModbusServerContext, ModbusSlaveContext, ModbusSparseDataBlock
+from pymodbus.server import StartAsyncTcpServer
+
+SIMULATOR_HOST      = "127.0.0.1"
+SIMULATOR_BASE_PORT = 15020
+
+# base port → ports of the simulators already running in this process
+_running: dict[int, dict[str, int]] = {}
+
+
+def _split(value: int) -> list[int]:
+    """32-bit value → [high, low] registers (two's complement for negatives)."""
+    value &= 0xFFFFFFFF
+    return [value >> 16, value & 0xFFFF]
+
+
+# ModbusSlaveContext reads and writes data block address = register + 1
+# (zero_mode, which turned that off, is gone since pymodbus 3.8)
+BLOCK_OFFSET = 1
+
+
+def _registers(values: dict[int, int], double: tuple[int, ...]) -> dict[int, int]:
+    registers = {}
+    for address, value in values.items():
+        address += BLOCK_OFFSET
+        if address - BLOCK_OFFSET in double:
+            high, low = _split(value)
+            registers[address], registers[address + 1] = high, low
+        else:
+            registers[address] = value
+    return registers
+
+
+class _KebaRegisters(ModbusSparseDataBlock):
+    """KEBA reports the set current (5004) back in register 1100."""
+
+    def setValues(self, address, values, use_as_default=False):
+        super().setValues(address, values, use_as_default)
+        if address == 5004 + BLOCK_OFFSET:
+            super().setValues(1100 + BLOCK_OFFSET, _split(values[0]))
+
+
+def device_register_maps() -> dict[str, tuple[int, ModbusSparseDataBlock]]:
+    """name → (unit id, register block, keyed by register + BLOCK_OFFSET)"""
+    tripower = {30773: 1800, 30775: 5400, 30961: 1800, 30967: 1800}
+    sunny_island = {30775: -1500, 30845: 75}
+    juice = {122: 3, 1000: 16}
+    keba = {1000: 3, 1020: 7_000_000, 1100: 16000, 5004: 16000, 5014: 1}
+    return {
+        "tripower":     (3, ModbusSparseDataBlock(_registers(tripower, tuple(tripower)))),
+        "sunny_island": (3, ModbusSparseDataBlock(_registers(sunny_island, (30775, 30845)))),
+        "juice":        (1, ModbusSparseDataBlock(_registers(juice, ()))),
+        "keba":         (1, _KebaRegisters(_registers(keba, (1000, 1020, 1100)))),
+    }
+
+
+def start_simulators(base_port: int = SIMULATOR_BASE_PORT, timeout: float = 10) -> dict[str, int]:
+    """
+    Start all simulated devices in a background thread.
+    Returns name → TCP port once every server accepts connections.
+    Calling it again with the same base port returns the running simulators.
+    """
+    if base_port in _running:
+        return _running[base_port]
+    devices = device_register_maps()
+    ports = {name: base_port + index for index, name in enumerate(devices)}
+
+    async def serve_all():
+        await asyncio.gather(*(
+            StartAsyncTcpServer(
+                context=ModbusServerContext(
+                    # di and co as well: pymodbus 3.9 ignores hr/ir when di is missing
+                    slaves={unit: ModbusSlaveContext(
+                        di=ModbusSparseDataBlock(), co=ModbusSparseDataBlock(), hr=block, ir=block
+                    )},
+                    single=False,
+                ),
+                address=(SIMULATOR_HOST, ports[name]),
+            )
+            for name, (unit, block) in devices.items()
+        ))
+
+    threading.Thread(target=asyncio.run, args=(serve_all(),), name="device_simulator", daemon=True).start()
+
+    deadline = time.monotonic() + timeout
+    for port in ports.values():
+        while True:
+            try:
+                socket.create_connection((SIMULATOR_HOST, port), timeout=0.5).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Simulated device on port {port} did not start")
+                time.sleep(0.05)
+    _running[base_port] = ports
+    return ports
+
+
+def build_emeter_datagram(consumption: int, feed_in: int) -> bytes:
+    """
+    Minimal SMA EMETER datagram. Values in 0.1 W, at the offsets the backend
+    parses (32: total consumption, 52: total feed-in).
+    """
+    data = bytearray(608)
+    data[0:4] = b"SMA\x00"
+    struct.pack_into(">I", data, 32, consumption)
+    struct.pack_into(">I", data, 52, feed_in)
+    return bytes(data)
+
+
+if __name__ == "__main__":
+    base_port = int(sys.argv[1]) if len(sys.argv) > 1 else SIMULATOR_BASE_PORT
+    for name, port in start_simulators(base_port).items():
+        print(f"{name:<14} {SIMULATOR_HOST}:{port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
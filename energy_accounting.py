@@ -0,0 +1,295 @@
+"""
+energy_accounting.py
+
+Incremental energy accounting (Wh) for the meters and every wallbox.
+
+Each power sample is integrated against the previous sample of the same
+channel (sample-and-hold) and added to the current minute, hour and day bucket
+in O(1). Period totals are answered from the coarsest buckets that cover the
+requested range, so raw samples never need to be kept or rescanned.
+
+Channels
+────────
+  grid_import, grid_export         grid meter (W > 0 import / W < 0 feed-in)
+  pv                               PV production of all sources (meters and inverters)
+  battery_charge, battery_discharge
+  wallbox_<id>                     energy delivered by a wallbox
+  wallbox_<id>_solar / _grid       split of that energy by grid import share
+
+Charging sessions (cable plugged in → unplugged) are tracked per wallbox.
+Rollups and sessions are kept in memory and saved to ENERGY_STORE_PATH.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+import shared_state
+
+ENERGY_STORE_PATH = os.environ.get("PV_BACKEND_ENERGY_STORE", "energy_rollups.json")
+
+# Samples further apart than this are not integrated (backend was down, device offline)
+MAX_SAMPLE_GAP_S = 300
+
+MINUTE = 60
+HOUR   = 3600
+
+# Number of buckets kept per resolution (days are kept forever)
+MINUTE_RETENTION = 2 * 24 * 60       # two days
+HOUR_RETENTION   = 400 * 24          # a bit more than a year
+
+MAX_SESSIONS = 200
+
+CONNECTED_STATES = (2, 3, 4)
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+
+# resolution name → {bucket start (epoch s) → {channel → Wh}}
+_rollups: dict[str, dict[int, dict[str, float]]] = {"minute": {}, "hour": {}, "day": {}}
+
+# channel → (timestamp, W) of the previous sample
+_last_samples: dict[str, tuple[float, float]] = {}
+
+# closed and open charging sessions, oldest first
+_sessions: list[dict] = []
+_open_sessions: dict[int, dict] = {}
+
+# cached local-day boundaries (start, end) for day bucketing; guarded by _lock
+_day_bounds = (0, 0)
+
+
+# ── Bucketing ──────────────────────────────────────────────────────────────────
+
+def local_day_start(timestamp: float) -> int:
+    """Local midnight before timestamp (pure; callable without _lock)."""
+    midnight = datetime.fromtimestamp(timestamp).replace(hour=0, minute=0, second=0, microsecond=0)
+    return int(midnight.timestamp())
+
+
+def _cached_day_start(timestamp: float) -> int:
+    """local_day_start with the current day cached. Caller holds _lock."""
+    global _day_bounds
+    if not (_day_bounds[0] <= timestamp < _day_bounds[1]):
+        start = local_day_start(timestamp)
+        _day_bounds = (start, _bucket_end("day", start))
+    return _day_bounds[0]
+
+
+def _bucket_start(resolution: str, timestamp: float) -> int:
+    if resolution == "minute":
+        return int(timestamp // MINUTE * MINUTE)
+    if resolution == "hour":
+        return int(timestamp // HOUR * HOUR)
+    return _cached_day_start(timestamp)
+
+
+def _bucket_end(resolution: str, start: int) -> int:
+    if resolution == "minute":
+        return start + MINUTE
+    if resolution == "hour":
+        return start + HOUR
+    midnight = datetime.fromtimestamp(start)
+    return int((midnight + timedelta(days=1)).timestamp())
+
+
+def _add_energy(channel: str, timestamp: float, wh: float) -> None:
+    for resolution, retention in (("minute", MINUTE_RETENTION), ("hour", HOUR_RETENTION), ("day", None)):
+        buckets = _rollups[resolution]
+        start = _bucket_start(resolution, timestamp)
+        bucket = buckets.get(start)
+        if bucket is None:
+            bucket = buckets[start] = {}
+            if retention is not None and len(buckets) > retention:
+                del buckets[next(iter(buckets))]   # dicts keep insertion order → oldest first
+        bucket[channel] = bucket.get(channel, 0.0) + wh
+
+
+def _integrate(channel: str, timestamp: float, watts: float) -> float:
+    """Integrate the previous sample of channel up to timestamp. Returns the added Wh."""
+    previous = _last_samples.get(channel)
+    _last_samples[channel] = (timestamp, watts)
+    if previous is None:
+        return 0.0
+    last_time, last_watts = previous
+    dt = timestamp - last_time
+    if dt <= 0 or dt > MAX_SAMPLE_GAP_S or last_watts == 0:
+        return 0.0
+    wh = last_watts * dt / 3600
+    _add_energy(channel, last_time, wh)
+    return wh
+
+
+# ── Sample input ───────────────────────────────────────────────────────────────
+
+def record_meter_sample(timestamp: Optional[float] = None) -> None:
+    """Integrate the current meter values from shared_state (grid in 0.1 W, PV and battery in W)."""
+    timestamp = timestamp or time.time()
+    grid_w    = shared_state.grid_power / 10
+    pv_w      = shared_state.pv_power
+    battery_w = shared_state.battery_power
+
+    with _lock:
+        _integrate("grid_import",       timestamp, max(grid_w, 0))
+        _integrate("grid_export",       timestamp, max(-grid_w, 0))
+        _integrate("pv",                timestamp, max(pv_w, 0))
+        _integrate("battery_charge",    timestamp, max(-battery_w, 0))
+        _integrate("battery_discharge", timestamp, max(battery_w, 0))
+
+
+def record_wallbox_samples(samples: dict[int, tuple[float, int]], timestamp: Optional[float] = None) -> None:
+    """
+    Integrate one reading per wallbox: {wallbox_id: (W, charging_state)}.
+
+    The grid import at that moment is attributed to the wallboxes in
+    proportion to their power; the remainder counts as solar (PV or battery).
+    """
+    timestamp = timestamp or time.time()
+    total_w = sum(max(watts, 0) for watts, _ in samples.values())
+    grid_import_w = max(shared_state.grid_power / 10, 0)
+    grid_share = min(grid_import_w / total_w, 1.0) if total_w > 0 else 0.0
+
+    with _lock:
+        for wb_id, (watts, charging_state) in samples.items():
+            watts = max(watts, 0)
+            wh       = _integrate(f"wallbox_{wb_id}",       timestamp, watts)
+            grid_wh  = _integrate(f"wallbox_{wb_id}_grid",  timestamp, watts * grid_share)
+            solar_wh = _integrate(f"wallbox_{wb_id}_solar", timestamp, watts * (1 - grid_share))
+            _track_session(wb_id, timestamp, charging_state, wh, solar_wh, grid_wh)
+
+
+def _track_session(wb_id: int, timestamp: float, charging_state: int, wh: float, solar_wh: float, grid_wh: float) -> None:
+    session = _open_sessions.get(wb_id)
+    if session is not None:
+        session["energy_wh"]       += wh
+        session["solar_energy_wh"] += solar_wh
+        session["grid_energy_wh"]  += grid_wh
+        session["last_update"]      = timestamp
+
+    if charging_state in CONNECTED_STATES and session is None:
+        session = {
+            "wallbox_id":      wb_id,
+            "start":           timestamp,
+            "end":             None,
+            "last_update":     timestamp,
+            "energy_wh":       0.0,
+            "solar_energy_wh": 0.0,
+            "grid_energy_wh":  0.0,
+        }
+        _open_sessions[wb_id] = session
+        _sessions.append(session)
+        del _sessions[:-MAX_SESSIONS]
+        logger.info(f"Wallbox {wb_id}: charging session started")
+    elif charging_state not in CONNECTED_STATES and session is not None:
+        session["end"] = timestamp
+        del _open_sessions[wb_id]
+        logger.info(f"Wallbox {wb_id}: charging session ended, {session['energy_wh'] / 1000:.2f} kWh")
+
+
+def current_session(wb_id: int) -> Optional[dict]:
+    """Open charging session of a wallbox, if a vehicle is connected."""
+    with _lock:
+        session = _open_sessions.get(wb_id)
+        return dict(session) if session else None
+
+
+# ── Queries ────────────────────────────────────────────────────────────────────
+
+def period_totals(start: float, end: float) -> dict[str, float]:
+    """
+    Energy per channel (Wh) in [start, end), assembled from day, hour and
+    minute buckets. Precision is one minute at the period edges.
+    """
+    totals: dict[str, float] = {}
+    with _lock:
+        if not _rollups["day"]:
+            return totals
+        start = max(start, next(iter(_rollups["day"])))
+        t = int(start // MINUTE * MINUTE)
+        while t < end:
+            for resolution in ("day", "hour", "minute"):
+                bucket_end = _bucket_end(resolution, t)
+                if _bucket_start(resolution, t) == t and bucket_end <= end or resolution == "minute":
+                    for channel, wh in _rollups[resolution].get(t, {}).items():
+                        totals[channel] = totals.get(channel, 0.0) + wh
+                    t = bucket_end
+                    break
+    return {channel: round(wh, 3) for channel, wh in sorted(totals.items())}
+
+
+def rollup_buckets(resolution: str, start: float, end: float) -> list[dict]:
+    with _lock:
+        return [
+            {"start": bucket_start, "energy_wh": {c: round(wh, 3) for c, wh in bucket.items()}}
+            for bucket_start, bucket in _rollups[resolution].items()
+            if start <= bucket_start < end
+        ]
+
+
+def sessions(wb_id: Optional[int] = None) -> list[dict]:
+    with _lock:
+        return [dict(s) for s in _sessions if wb_id is None or s["wallbox_id"] == wb_id]
+
+
+# ── Persistence ────────────────────────────────────────────────────────────────
+
+def save(path: str = ENERGY_STORE_PATH) -> None:
+    with _lock:
+        data = {
+            "rollups":  {res: {str(k): v for k, v in buckets.items()} for res, buckets in _rollups.items()},
+            "sessions": _sessions,
+        }
+        payload = json.dumps(data)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(payload)
+    os.replace(tmp_path, path)
+
+
+def load(path: str = ENERGY_STORE_PATH) -> None:
+    if not os.path.exists(path):
+        return
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error(f"Could not load energy rollups from {path}: {e}")
+        return
+
+    with _lock:
+        for resolution, buckets in data.get("rollups", {}).items():
+            _rollups[resolution] = {int(k): v for k, v in sorted(buckets.items(), key=lambda kv: int(kv[0]))}
+        _sessions[:] = data.get("sessions", [])
+        # sessions still open when the backend stopped are closed at their last update
+        for session in _sessions:
+            if session["end"] is None:
+                session["end"] = session["last_update"]
+        _open_sessions.clear()
+    logger.info(f"Loaded energy rollups from {path}")
+
+
+def snapshot_state() -> dict:
+    """Rollups, sessions (open ones included) and last samples, for a process handover."""
+    with _lock:
+        return {
+            "rollups":      {res: {str(k): v for k, v in buckets.items()} for res, buckets in _rollups.items()},
+            "sessions":     [dict(s) for s in _sessions],
+            "last_samples": dict(_last_samples),
+        }
+
+
+def restore_state(snapshot: dict) -> None:
+    """State of a predecessor process (handover): open sessions continue, no energy is lost."""
+    with _lock:
+        for resolution, buckets in snapshot["rollups"].items():
+            _rollups[resolution] = {int(k): v for k, v in buckets.items()}
+        _sessions[:] = snapshot["sessions"]
+        _open_sessions.clear()
+        _open_sessions.update({s["wallbox_id"]: s for s in _sessions if s["end"] is None})
+        _last_samples.clear()
+        _last_samples.update({channel: tuple(sample) for channel, sample in snapshot["last_samples"].items()})
@@ -0,0 +1,52 @@
+"""
+sma_emeter.py
+
+SMA Energy Meter (EMETER), pushed over UDP.
+
+The meter multicasts a datagram about once per second; emeter_receiver
+receives them and hands each one to the source with the sender's IP.
+Totals are in 0.1 W at fixed offsets:
+  32: active power consumed from the grid (import)
+  52: active power supplied to the grid (feed-in)
+"""
+
+import logging
+import struct
+from typing import Optional
+
+from energy_sources.source_base import EnergySourceBase
+
+logger = logging.getLogger(__name__)
+
+OFFSET_CONSUMPTION = 32
+OFFSET_FEED_IN     = 52
+
+
+class SmaEnergyMeter(EnergySourceBase):
+    """
+    kind "grid": grid connection point, import positive / feed-in negative.
+    kind "pv":   meter in the line of a PV system, its feed-in is the production.
+    """
+
+    polled = False
+
+    def __init__(self, source_id: str, name: str, kind: str, ip: str):
+        super().__init__(source_id, name, kind)
+        self.ip = ip
+        self.power_decawatt: Optional[int] = None   # last value in 0.1 W (unit of shared_state)
+
+    def handle_datagram(self, data: bytes, ip: str) -> bool:
+        if ip != self.ip or data[:3] != b"SMA":
+            return False
+        feed_in = struct.unpack(">I", data[OFFSET_FEED_IN:OFFSET_FEED_IN + 4])[0]
+        if self.kind == "grid":
+            consumption = struct.unpack(">I", data[OFFSET_CONSUMPTION:OFFSET_CONSUMPTION + 4])[0]
+            self.power_decawatt = consumption if feed_in == 0 else -feed_in
+        else:
+            self.power_decawatt = feed_in
+        return True
+
+    def read(self) -> Optional[dict]:
+        if self.power_decawatt is None:
+            return None
+        return {"power_w": self.power_decawatt / 10}
@@ -0,0 +1,84 @@
+"""
+sma_inverter.py
+
+SMA devices read over Modbus (32-bit registers, SMA NaN markers):
+
+SmaInverter (PV, e.g. Sunny Tripower)
+  Total power:   register 30775  (W, unsigned)
+  String powers: e.g. 30773 / 30961 / 30967  (W, unsigned)
+
+SmaBattery (e.g. Sunny Island)
+  Battery power: register 30775  (W, signed; < 0 charging)
+  SoC:           register 30845  (%)
+
+All registers of one device are read in one pipelined batch.
+"""
+
+import logging
+from typing import Optional
+
+from energy_sources.source_base import EnergySourceBase
+from modbus_interaction import read_sma_modbus_values
+
+logger = logging.getLogger(__name__)
+
+SMA_NAN_S32 = 0x80000000
+SMA_NAN_U32 = 0xFFFFFFFF
+SMA_SLAVE   = 3
+
+
+class _SmaModbusSource(EnergySourceBase):
+    def __init__(self, source_id: str, name: str, kind: str, ip: str, modbus_port: int = 502,
+                 slave: int = SMA_SLAVE, capacity_wh: Optional[float] = None):
+        super().__init__(source_id, name, kind, capacity_wh)
+        self.ip = ip
+        self.modbus_port = modbus_port
+        self.slave = slave
+
+    def _register(self, register: int, signed: bool, nan_value: int) -> dict:
+        return {
+            "ip": self.ip,
+            "modbus_port": self.modbus_port,
+            "register": register,
+            "slave": self.slave,
+            "signed": signed,
+            "nan_value": nan_value,
+        }
+
+
+class SmaInverter(_SmaModbusSource):
+    """PV inverter: total AC power plus optional DC string powers."""
+
+    def __init__(self, source_id: str, name: str, ip: str, modbus_port: int = 502, slave: int = SMA_SLAVE,
+                 power_register: int = 30775, string_registers: tuple = ()):
+        super().__init__(source_id, name, "pv", ip, modbus_port, slave)
+        self.power_register = power_register
+        self.string_registers = tuple(string_registers)
+
+    def read(self) -> Optional[dict]:
+        values = read_sma_modbus_values(
+            [self._register(self.power_register, False, SMA_NAN_S32)]
+            + [self._register(register, False, SMA_NAN_S32) for register in self.string_registers]
+        )
+        if values[0] is None:
+            return None
+        return {"power_w": values[0], "string_powers_w": [value or 0 for value in values[1:]]}
+
+
+class SmaBattery(_SmaModbusSource):
+    """Battery inverter: signed battery power and state of charge."""
+
+    def __init__(self, source_id: str, name: str, ip: str, modbus_port: int = 502, slave: int = SMA_SLAVE,
+                 capacity_wh: Optional[float] = None, power_register: int = 30775, soc_register: int = 30845):
+        super().__init__(source_id, name, "battery", ip, modbus_port, slave, capacity_wh)
+        self.power_register = power_register
+        self.soc_register = soc_register
+
+    def read(self) -> Optional[dict]:
+        power, soc = read_sma_modbus_values([
+            self._register(self.power_register, True, SMA_NAN_S32),
+            self._register(self.soc_register, False, SMA_NAN_U32),
+        ])
+        if power is None or soc is None:
+            return None
+        return {"power_w": power, "soc": soc}
@@ -0,0 +1,66 @@
+"""
+source_base.py
+
+Abstract base class for energy-source implementations (grid meters, PV
+inverters and meters, home batteries).
+Each device type subclasses this and overrides the hardware-specific read.
+"""
+
+from abc import ABC, abstractmethod
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+# What a source measures; the aggregation sums power per kind
+SOURCE_KINDS = ("grid", "pv", "battery")
+
+
+class EnergySourceBase(ABC):
+    """
+    Abstract base class for all energy sources.
+
+    Subclasses must implement:
+      - read() -> dict   {"power_w": float, ...}; batteries add "soc" (%),
+                         devices with more detail may add further keys.
+                         Sign convention (as shared_state):
+                           grid    > 0 import,      < 0 feed-in
+                           pv      ≥ 0 production
+                           battery > 0 discharging, < 0 charging
+
+    Optional override:
+      - handle_datagram(data, ip) -> bool  for push devices (SMA EMETER):
+        take a received datagram if it belongs to this device.
+        Push devices set `polled = False`; read() then only returns the last value.
+    """
+
+    polled = True
+
+    def __init__(self, source_id: str, name: str, kind: str, capacity_wh: Optional[float] = None):
+        if kind not in SOURCE_KINDS:
+            raise ValueError(f"Unknown energy source kind {kind!r}")
+        self.source_id = source_id
+        self.name = name
+        self.kind = kind
+        self.capacity_wh = capacity_wh   # batteries: weight of the SoC in the aggregate
+
+    # ------------------------------------------------------------------
+    # Abstract hardware interface
+    # ------------------------------------------------------------------
+
+    @abstractmethod
+    def read(self) -> Optional[dict]:
+        """Return the current reading, or None if the device could not be read."""
+        ...
+
+    def handle_datagram(self, data: bytes, ip: str) -> bool:
+        """Consume a pushed datagram. Polled devices ignore datagrams."""
+        return False
+
+    # ------------------------------------------------------------------
+    # Convenience
+    # ------------------------------------------------------------------
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} id={self.source_id!r} kind={self.kind} name={self.name!r}>"
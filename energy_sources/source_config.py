@@ -0,0 +1,71 @@
+"""
+source_config.py
+
+Central registry of all configured energy sources.
+
+The sources are read from the JSON file named by PV_BACKEND_SOURCES_CONFIG,
+a list of entries like
+  {"id": "tripower2", "type": "sma_inverter", "name": "Tripower Garage",
+   "ip": "192.168.188.46", "string_registers": [30773, 30961]}
+Without that file the installation below is used.
+data_collection, the regulator and rest_api only see ENERGY_SOURCES and
+never need to know the concrete class.
+"""
+
+import json
+import logging
+import os
+
+from energy_sources.source_base import EnergySourceBase
+from energy_sources.sma_emeter import SmaEnergyMeter
+from energy_sources.sma_inverter import SmaBattery, SmaInverter
+from modbus_interaction import SUNNY_ISLAND_IP, TRIPOWER_IP
+
+SOURCES_CONFIG_PATH = os.environ.get("PV_BACKEND_SOURCES_CONFIG", "")
+
+# config "type" → class
+SOURCE_TYPES = {
+    "sma_emeter":   SmaEnergyMeter,
+    "sma_inverter": SmaInverter,
+    "sma_battery":  SmaBattery,
+}
+
+# ── Network addresses ──────────────────────────────────────────────────────────
+GRID_METER_IP = "192.168.188.54"
+PV_METER_IP   = "192.168.188.87"
+
+DEFAULT_SOURCES = [
+    {"id": "grid", "type": "sma_emeter", "name": "Grid meter", "kind": "grid", "ip": GRID_METER_IP},
+    {"id": "pv_meter", "type": "sma_emeter", "name": "PV energy meter", "kind": "pv", "ip": PV_METER_IP},
+    {
+        "id": "tripower", "type": "sma_inverter", "name": "Sunny Tripower", "ip": TRIPOWER_IP,
+        "string_registers": [30773, 30961, 30967],
+    },
+    {"id": "sunny_island", "type": "sma_battery", "name": "Sunny Island", "ip": SUNNY_ISLAND_IP},
+]
+
+logger = logging.getLogger(__name__)
+
+
+def build_sources(entries: list[dict]) -> dict[str, EnergySourceBase]:
+    sources = {}
+    for entry in entries:
+        params = dict(entry)
+        source_id = params.pop("id")
+        source_type = params.pop("type")
+        if source_type not in SOURCE_TYPES:
+            raise ValueError(f"Energy source {source_id}: unknown type {source_type!r}")
+        sources[source_id] = SOURCE_TYPES[source_type](source_id=source_id, **params)
+    return sources
+
+
+def load_sources(path: str = SOURCES_CONFIG_PATH) -> dict[str, EnergySourceBase]:
+    if not path:
+        return build_sources(DEFAULT_SOURCES)
+    with open(path) as f:
+        entries = json.load(f)
+    logger.info(f"Loaded {len(entries)} energy sources from {path}")
+    return build_sources(entries)
+
+
+ENERGY_SOURCES: dict[str, EnergySourceBase] = load_sources()
@@ -0,0 +1,203 @@
+"""
+source_polling.py
+
+Concurrent polling of the energy sources and aggregation of their readings.
+
+data_collection calls, once per sample:
+  handle_datagram()  for every received meter datagram (push sources)
+  poll(due_sources()) reads every polled source that is due (see
+                     polling_policy) in parallel, so the sample takes as long
+                     as the slowest device instead of the sum of all of them;
+                     a source whose read is still running is not due, and a
+                     failed read backs the source off (record_failure)
+  aggregate()        sums power per kind over the last good reading of every
+                     source and publishes the totals to shared_state, which
+                     the regulator and the API read without device I/O
+
+A reading older than STALE_POLL_INTERVALS poll intervals of its source plus
+one read timeout (PUSH_SOURCE_MAX_AGE_S for meters) is dropped and left out of the totals, so
+an offline inverter or battery does not keep its last power in the state.
+
+Without arguments these work on ENERGY_SOURCES and shared_state (the default
+site); sites.py passes the sources, state and thread pool of further sites.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor, wait
+from typing import Iterable, Optional
+
+import polling_policy
+import shared_state
+from energy_sources.source_base import EnergySourceBase
+from energy_sources.source_config import ENERGY_SOURCES
+
+SOURCE_POLL_WORKERS   = 8
+SOURCE_READ_TIMEOUT_S = 5
+
+# readings older than this many poll intervals of their source are dropped
+STALE_POLL_INTERVALS  = 3
+# meters push about once per second
+PUSH_SOURCE_MAX_AGE_S = 10
+
+# a battery charging or discharging more than this is not idle, even at night:
+# the regulator uses its power
+BATTERY_ACTIVE_W = 50
+
+logger = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(max_workers=SOURCE_POLL_WORKERS, thread_name_prefix="source_poll")
+
+_lock = threading.Lock()
+# source id → last good reading (with "timestamp")
+_readings: dict[str, dict] = {}
+# ids of the sources with a read submitted and not finished yet
+_in_flight: set[str] = set()
+
+
+def push_sources(sources: dict[str, EnergySourceBase]) -> list[EnergySourceBase]:
+    return [source for source in sources.values() if not source.polled]
+
+
+_push_sources = push_sources(ENERGY_SOURCES)
+
+
+def handle_datagram(data: bytes, ip: str, sources: Optional[Iterable[EnergySourceBase]] = None) -> bool:
+    """Hand a meter datagram to the push source it belongs to."""
+    for source in _push_sources if sources is None else sources:
+        if source.handle_datagram(data, ip):
+            reading = source.read()
+            if reading is not None:
+                reading["timestamp"] = time.time()
+                with _lock:
+                    _readings[source.source_id] = reading
+            return True
+    return False
+
+
+def due_sources(sources: dict[str, EnergySourceBase] = ENERGY_SOURCES) -> list[EnergySourceBase]:
+    with _lock:
+        in_flight = set(_in_flight)
+    return [
+        source for source in sources.values()
+        if source.polled and source.source_id not in in_flight and polling_policy.source(source.source_id).due()
+    ]
+
+
+def _read(source: EnergySourceBase) -> None:
+    try:
+        _read_and_record(source)
+    finally:
+        # after record/record_failure, so the source is not due again in between
+        with _lock:
+            _in_flight.discard(source.source_id)
+
+
+def _read_and_record(source: EnergySourceBase) -> None:
+    target = polling_policy.source(source.source_id)
+    try:
+        reading = source.read()
+    except Exception:
+        target.record_failure()
+        raise
+    if reading is None:
+        logger.warning("⚠️ Energy source %s could not be read", source.source_id)
+        target.record_failure()
+        return
+    reading["timestamp"] = time.time()
+    with _lock:
+        _readings[source.source_id] = reading
+    active = source.kind == "battery" and abs(reading["power_w"]) >= BATTERY_ACTIVE_W
+    target.record(reading["power_w"], active=active)
+
+
+def poll(sources: list[EnergySourceBase], executor: Optional[Executor] = None) -> None:
+    """Read the given sources in parallel (blocking, call from a worker thread)."""
+    executor = executor or _executor
+    with _lock:
+        _in_flight.update(source.source_id for source in sources)
+    futures = {executor.submit(_read, source): source for source in sources}
+    done, not_done = wait(futures, timeout=SOURCE_READ_TIMEOUT_S)
+    for future in done:
+        if future.exception() is not None:
+            logger.warning("⚠️ Energy source %s error: %s", futures[future].source_id, future.exception())
+    for future in not_done:
+        logger.warning("⚠️ Energy source %s did not answer within %ss", futures[future].source_id, SOURCE_READ_TIMEOUT_S)
+
+
+def snapshot_readings() -> dict:
+    with _lock:
+        return {source_id: dict(reading) for source_id, reading in _readings.items()}
+
+
+def restore_readings(readings: dict) -> None:
+    """Last readings of a predecessor process (handover), until fresh ones arrive."""
+    with _lock:
+        for source_id, reading in readings.items():
+            _readings.setdefault(source_id, reading)
+
+
+def _max_age_s(source: EnergySourceBase) -> float:
+    if not source.polled:
+        return PUSH_SOURCE_MAX_AGE_S
+    # plus one read timeout, so a single slow answer does not drop the source
+    return STALE_POLL_INTERVALS * polling_policy.source(source.source_id).interval_s + SOURCE_READ_TIMEOUT_S
+
+
+def _drop_stale_readings(sources: dict[str, EnergySourceBase]) -> None:
+    now = time.time()
+    with _lock:
+        stale = [
+            source_id for source_id, source in sources.items()
+            if source_id in _readings and now - _readings[source_id]["timestamp"] > _max_age_s(source)
+        ]
+        for source_id in stale:
+            del _readings[source_id]
+    for source_id in stale:
+        logger.warning(
+            f"⚠️ Energy source {source_id}: no reading for more than {_max_age_s(sources[source_id]):.0f}s "
+            "– left out of the totals"
+        )
+
+
+def aggregate(sources: dict[str, EnergySourceBase] = ENERGY_SOURCES, state=shared_state) -> dict:
+    """Totals over the fresh readings of the sources of a site; also written to its state (shared_state by default)."""
+    _drop_stale_readings(sources)
+    with _lock:
+        readings = {source_id: _readings[source_id] for source_id in sources if source_id in _readings}
+
+    power = {"grid": 0.0, "pv": 0.0, "battery": 0.0}
+    pv_meters_w = 0.0
+    soc_weighted, soc_weight = 0.0, 0.0
+    source_readings = []
+    for source_id, reading in readings.items():
+        source = sources[source_id]
+        power[source.kind] += reading["power_w"]
+        if source.kind == "pv" and not source.polled:
+            pv_meters_w += reading["power_w"]
+        if source.kind == "battery":
+            weight = source.capacity_wh or 1.0
+            soc_weighted += reading["soc"] * weight
+            soc_weight += weight
+        source_readings.append({"id": source_id, "name": source.name, "kind": source.kind, **reading})
+
+    totals = {
+        "grid_w":      power["grid"],
+        "pv_w":        power["pv"],
+        "pv_meters_w": pv_meters_w,
+        "battery_w":   power["battery"],
+        "battery_soc": round(soc_weighted / soc_weight) if soc_weight else None,
+        "sources":     source_readings,
+    }
+
+    # shared_state keeps its units: meters in 0.1 W, battery in W
+    state.grid_power   = round(totals["grid_w"] * 10)
+    state.emeter_power = round(pv_meters_w * 10)
+    state.pv_power     = totals["pv_w"]
+    # a site with batteries but no fresh battery reading counts no battery power
+    if any(source.kind == "battery" for source in sources.values()):
+        state.battery_power = round(totals["battery_w"])
+    if totals["battery_soc"] is not None:
+        state.battery_SoC   = totals["battery_soc"]
+    return totals
@@ -0,0 +1,86 @@
+"""
+event_stream.py
+
+In-process publish/subscribe for the server-sent events push stream (GET /events).
+
+Events can be published from any thread. Every event gets a sequence number and
+the most recent ones are kept, so API workers can replay them from the
+controller snapshot and clients can resume with Last-Event-ID.
+
+Every subscriber has a bounded queue. A client too slow to keep up is
+disconnected when its queue is full; it reconnects with Last-Event-ID and
+catches up from the recent events.
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+RECENT_EVENTS = 200
+# events waiting for one subscriber before it is disconnected
+SUBSCRIBER_QUEUE_SIZE = 100
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_sequence = itertools.count(1)
+_recent: deque = deque(maxlen=RECENT_EVENTS)
+_subscribers: set[tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = set()
+
+
+def publish(event_type: str, data: dict) -> None:
+    with _lock:
+        event = {"id": next(_sequence), "type": event_type, "time": time.time(), "data": data}
+        _recent.append(event)
+        subscribers = list(_subscribers)
+    for subscriber in subscribers:
+        subscriber[0].call_soon_threadsafe(_deliver, subscriber, event)
+
+
+def _deliver(subscriber: tuple[asyncio.AbstractEventLoop, asyncio.Queue], event: dict) -> None:
+    """Runs on the subscriber's loop."""
+    queue = subscriber[1]
+    try:
+        queue.put_nowait(event)
+    except asyncio.QueueFull:
+        with _lock:
+            if subscriber not in _subscribers:
+                return   # already disconnected
+            _subscribers.discard(subscriber)
+        logger.warning(f"⚠️ Event subscriber {SUBSCRIBER_QUEUE_SIZE} events behind – disconnected")
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)   # ends the stream
+
+
+def recent_events(after_id: int = 0) -> list[dict]:
+    with _lock:
+        return [event for event in _recent if event["id"] > after_id]
+
+
+def format_sse(event: dict) -> str:
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+
+
+async def subscribe(after_id: int = 0):
+    """Async generator of SSE-formatted events, starting with the ones after after_id."""
+    queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+    subscriber = (asyncio.get_running_loop(), queue)
+    with _lock:
+        backlog = [event for event in _recent if event["id"] > after_id]
+        _subscribers.add(subscriber)
+    try:
+        for event in backlog:
+            yield format_sse(event)
+        while True:
+            event = await queue.get()
+            if event is None:
+                return
+            yield format_sse(event)
+    finally:
+        with _lock:
+            _subscribers.discard(subscriber)
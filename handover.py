@@ -0,0 +1,232 @@
+"""
+handover.py
+
+Zero-downtime restart: a new backend process takes over the listening
+sockets and the in-memory state of the running one.
+
+Run the backend through this module (instead of plain uvicorn):
+  python handover.py --host 0.0.0.0 --port 8000
+
+On start it connects to HANDOVER_SOCKET_PATH. If an instance is running
+there:
+  1. the running instance sends the HTTP listening socket and the UDP meter
+     socket (SCM_RIGHTS) and keeps serving,
+  2. the new instance imports the application and, before it loads any
+     stored state or starts its control tasks, reports "ready",
+  3. the running instance stops its control tasks (meter receiver, data
+     collection, regulation, energy accounting – the rollups are saved to
+     disk) and sends a JSON snapshot of its state (see
+     rest_api.handover_snapshot),
+  4. the new instance restores the snapshot (energy rollups and open charging
+     sessions included, the file on disk is not read) and starts its tasks on
+     the same sockets; the old one stops serving, uvicorn lets the running
+     requests finish.
+Connections and meter datagrams that arrive meanwhile wait in the kernel
+queues of the shared sockets, nothing is dropped, and the devices are not
+probed again. The control tasks are down only between 3. and 4. If the
+handover fails after they were stopped, the running instance starts them
+again and waits for the next successor. Without a running instance the new
+one binds the sockets itself.
+
+Standalone role only; the controller/worker deployment restarts as before.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+import tempfile
+from typing import Awaitable, Callable, Optional
+
+# absolute, so instances started from different working directories meet
+HANDOVER_SOCKET_PATH = os.path.abspath(os.environ.get(
+    "PV_BACKEND_HANDOVER_SOCKET",
+    os.path.join(os.environ.get("XDG_RUNTIME_DIR", tempfile.gettempdir()), "pv-backend-handover.sock"),
+))
+HANDOVER_TIMEOUT_S   = 30
+
+_LENGTH = struct.Struct(">I")
+
+logger = logging.getLogger(__name__)
+
+# Set in the process started through main()
+http_socket: Optional[socket.socket] = None
+server = None                                       # uvicorn.Server
+
+# Received from the predecessor, consumed by rest_api on start-up
+_inherited_sockets: dict[str, socket.socket] = {}
+_predecessor: Optional[socket.socket] = None        # connection, until the snapshot arrived
+
+
+def enabled() -> bool:
+    """True when this process can hand over to a successor (it owns its HTTP socket)."""
+    return http_socket is not None
+
+
+def take_socket(name: str) -> Optional[socket.socket]:
+    """Socket inherited from the predecessor ("udp"), once."""
+    return _inherited_sockets.pop(name, None)
+
+
+def take_snapshot() -> Optional[dict]:
+    """
+    Report ready to the predecessor and wait for its state snapshot (blocking,
+    at most HANDOVER_TIMEOUT_S), once. None without a predecessor or when it
+    failed to hand over.
+    """
+    global _predecessor
+    conn, _predecessor = _predecessor, None
+    if conn is None:
+        return None
+    with conn:
+        try:
+            _send_message(conn, {"ready": True})
+            message, _ = _receive_message(conn)
+        except (OSError, EOFError, ValueError) as e:
+            logger.warning(f"⚠️ Handover: no state from the running instance ({e}) – starting fresh")
+            return None
+    logger.info("✅ Took over the state of the running instance")
+    return message["snapshot"]
+
+
+# ── Messages ───────────────────────────────────────────────────────────────────
+# length-prefixed JSON; file descriptors travel with the length prefix
+
+def _send_message(conn: socket.socket, message: dict, fds: list[int] = ()) -> None:
+    payload = json.dumps(message).encode()
+    socket.send_fds(conn, [_LENGTH.pack(len(payload))], list(fds))
+    conn.sendall(payload)
+
+
+def _receive_message(conn: socket.socket) -> tuple[dict, list[int]]:
+    header, fds, _, _ = socket.recv_fds(conn, _LENGTH.size, 8)
+    if len(header) < _LENGTH.size:
+        raise EOFError("handover connection closed")
+    length = _LENGTH.unpack(header)[0]
+    payload = b""
+    while len(payload) < length:
+        chunk = conn.recv(length - len(payload))
+        if not chunk:
+            raise EOFError("handover connection closed")
+        payload += chunk
+    return json.loads(payload), fds
+
+
+# ── Predecessor side ───────────────────────────────────────────────────────────
+
+async def serve(
+    stop_control: Callable[[], Awaitable[None]],
+    start_control: Callable[[], None],
+    sockets: Callable[[], dict[str, socket.socket]],
+    snapshot: Callable[[], dict],
+) -> None:
+    """
+    background task to wait for a successor and hand over to it
+    sockets: name → socket to pass on besides "http"; snapshot: taken after stop_control;
+    start_control: restarts the control tasks when a handover fails after they were stopped
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        listener = _listen()
+        try:
+            conn, _ = await loop.sock_accept(listener)
+        finally:
+            listener.close()
+            if os.path.exists(HANDOVER_SOCKET_PATH):
+                os.unlink(HANDOVER_SOCKET_PATH)
+
+        with conn:
+            conn.setblocking(True)
+            conn.settimeout(HANDOVER_TIMEOUT_S)
+            logger.info("Successor connected – handing over")
+            stopped = False
+            try:
+                # the successor starts up while this process keeps controlling
+                passed = {"http": http_socket, **sockets()}
+                await asyncio.to_thread(
+                    _send_message, conn, {"sockets": list(passed)}, [sock.fileno() for sock in passed.values()]
+                )
+                await asyncio.to_thread(_receive_message, conn)        # ready
+
+                await stop_control()
+                stopped = True
+                await asyncio.to_thread(_send_message, conn, {"snapshot": snapshot()})
+            except (OSError, EOFError, ValueError) as e:
+                logger.error(f"⚠️ Handover failed ({e}) – continuing")
+                if stopped:
+                    start_control()
+                continue
+
+        logger.info("Handover done – stopping")
+        server.should_exit = True
+        return
+
+
+def _listen() -> socket.socket:
+    if os.path.exists(HANDOVER_SOCKET_PATH):
+        os.unlink(HANDOVER_SOCKET_PATH)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(HANDOVER_SOCKET_PATH)
+    listener.listen(1)
+    listener.setblocking(False)
+    logger.info(f"✅ Handover socket {HANDOVER_SOCKET_PATH}")
+    return listener
+
+
+# ── Successor side ─────────────────────────────────────────────────────────────
+
+def receive_handover() -> bool:
+    """Take over the sockets of a running instance; False when there is none."""
+    global http_socket, _predecessor
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(HANDOVER_SOCKET_PATH)
+    except (FileNotFoundError, ConnectionRefusedError):
+        conn.close()
+        return False
+
+    conn.settimeout(HANDOVER_TIMEOUT_S)
+    try:
+        message, fds = _receive_message(conn)
+    except (OSError, EOFError, ValueError):
+        conn.close()
+        raise
+    sockets = {name: socket.socket(fileno=fd) for name, fd in zip(message["sockets"], fds)}
+    http_socket = sockets.pop("http")
+    _inherited_sockets.update(sockets)
+    # kept open: the state follows once this process is ready (take_snapshot)
+    _predecessor = conn
+    logger.info(f"✅ Took over sockets {message['sockets']} from the running instance")
+    return True
+
+
+def _bind_http_socket(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    return sock
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    import uvicorn
+
+    global http_socket, server
+    if not receive_handover():
+        http_socket = _bind_http_socket(args.host, args.port)
+    server = uvicorn.Server(uvicorn.Config("rest_api:app", host=args.host, port=args.port))
+    server.run(sockets=[http_socket])
+
+
+if __name__ == "__main__":
+    # run in the imported module, the one rest_api sees
+    import handover
+    handover.main()
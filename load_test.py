@@ -0,0 +1,266 @@
+"""
+load_test.py
+
+HTTP load test of the REST API against the simulated devices.
+
+The app runs in-process under uvicorn on 127.0.0.1, with every Modbus device
+(Tripower, Sunny Island, both wallboxes) pointed at the local stand-ins from
+device_simulator.py. Virtual clients keep one HTTP/1.1 keep-alive connection
+each and send a mixed read/write workload back to back. The number of clients
+is raised stage by stage; per stage the script reports latency percentiles,
+throughput, errors and the peak usage of the threadpool that runs the sync
+endpoints (sampled from /debug/threadpool).
+
+Run with:
+  python load_test.py                                   # 1 … 64 clients, 10 s each
+  python load_test.py --concurrency 8 32 128 --duration 20
+  python load_test.py --json load_test_result.json      # keep the numbers for comparison
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from typing import Optional
+
+# keep the energy store and meter history of a real installation untouched
+_scratch_dir = tempfile.mkdtemp(prefix="pv_backend_load_test_")
+os.environ["PV_BACKEND_ENERGY_STORE"] = os.path.join(_scratch_dir, "energy_rollups.json")
+os.environ["PV_BACKEND_HISTORY_DIR"] = os.path.join(_scratch_dir, "history")
+
+import uvicorn  # noqa: E402
+
+import modbus_interaction  # noqa: E402
+import rest_api  # noqa: E402
+from device_simulator import SIMULATOR_HOST, start_simulators  # noqa: E402
+from energy_sources.sma_inverter import SmaBattery, SmaInverter  # noqa: E402
+from energy_sources.source_config import ENERGY_SOURCES  # noqa: E402
+from wallbox.wallbox_config import WALLBOXES  # noqa: E402
+
+APP_HOST = "127.0.0.1"
+APP_PORT = 18000
+
+DEFAULT_CONCURRENCY = [1, 2, 4, 8, 16, 32, 64]
+DEFAULT_DURATION_S  = 10
+
+THREADPOOL_SAMPLE_INTERVAL_S = 0.1
+REQUEST_TIMEOUT_S = 30
+# the energy sources must report the simulated values before load is generated
+SOURCES_READY_TIMEOUT_S = 20
+
+# (method, path, JSON body, weight) – dashboard polling plus occasional control
+WORKLOAD = [
+    ("GET",  "/solar-data",                None,                 70),
+    ("GET",  "/energy",                    None,                 10),
+    ("POST", "/home-bat-min-soc",          {"value": 80},        10),
+    ("POST", "/wallbox/2/max_current",     {"value": 16000},     10),
+]
+
+SIMULATED_DEVICES = {
+    # sma_devices name prefix → simulator
+    "tripower":      "tripower",
+    "battery":       "sunny_island",
+}
+SIMULATED_WALLBOXES = {1: "juice", 2: "keba"}
+
+
+# ── App under test ─────────────────────────────────────────────────────────────
+
+def point_devices_at_simulators(ports: dict[str, int]) -> None:
+    for name, device in modbus_interaction.sma_devices.items():
+        simulator = SIMULATED_DEVICES[name.split("_")[0]]
+        device["ip"], device["modbus_port"] = SIMULATOR_HOST, ports[simulator]
+    for source in ENERGY_SOURCES.values():
+        if isinstance(source, (SmaInverter, SmaBattery)):
+            simulator = "tripower" if isinstance(source, SmaInverter) else "sunny_island"
+            source.ip, source.modbus_port = SIMULATOR_HOST, ports[simulator]
+    for wallbox_id, simulator in SIMULATED_WALLBOXES.items():
+        WALLBOXES[wallbox_id].ip, WALLBOXES[wallbox_id].modbus_port = SIMULATOR_HOST, ports[simulator]
+    for port in ports.values():
+        for slave in (1, 3):
+            modbus_interaction.device_max_requests_per_second[(SIMULATOR_HOST, port, slave)] = 1e9
+    # meter stream on loopback (nothing is sent; keeps the UDP task from failing to bind)
+    rest_api.UDP_IP = rest_api.UDP_INTERFACE_IP = APP_HOST
+
+
+def start_app(port: int) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(rest_api.app, host=APP_HOST, port=port, log_level="warning"))
+    threading.Thread(target=server.run, name="uvicorn", daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+async def wait_for_sources(port: int) -> dict:
+    """
+    /solar-data once PV and battery report the simulated values; RuntimeError when they
+    do not within SOURCES_READY_TIMEOUT_S (the numbers would measure an app without data).
+    """
+    connection = HttpConnection(APP_HOST, port)
+    deadline = time.monotonic() + SOURCES_READY_TIMEOUT_S
+    try:
+        while True:
+            _, body = await connection.request("GET", "/solar-data")
+            data = json.loads(body)
+            if data["pv_power"] and data["battery_power"] and data["battery_SoC"]:
+                return data
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Energy sources did not report within {SOURCES_READY_TIMEOUT_S}s: {data}")
+            await asyncio.sleep(0.5)
+    finally:
+        connection.close()
+
+
+# ── Minimal keep-alive HTTP client ─────────────────────────────────────────────
+
+class HttpConnection:
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method: str, path: str, body: Optional[dict] = None) -> tuple[int, bytes]:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        payload = json.dumps(body).encode() if body is not None else b""
+        head = (
+            f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n"
+        )
+        self.writer.write(head.encode() + payload)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("connection closed by server")
+        status = int(status_line.split()[1])
+        length = 0
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode().partition(":")
+            if name.lower() == "content-length":
+                length = int(value)
+        return status, await self.reader.readexactly(length)
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+# ── Load generation ────────────────────────────────────────────────────────────
+
+async def _client(port: int, deadline: float, latencies: list, errors: list) -> None:
+    connection = HttpConnection(APP_HOST, port)
+    methods, paths, bodies, weights = zip(*WORKLOAD)
+    rng = random.Random()
+    try:
+        while time.monotonic() < deadline:
+            index = rng.choices(range(len(WORKLOAD)), weights)[0]
+            started = time.perf_counter()
+            try:
+                status, _ = await asyncio.wait_for(
+                    connection.request(methods[index], paths[index], bodies[index]), REQUEST_TIMEOUT_S
+                )
+                if status >= 400:
+                    errors.append(status)
+            except (OSError, ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                errors.append(type(e).__name__)
+                connection.close()
+                continue
+            latencies.append(time.perf_counter() - started)
+    finally:
+        connection.close()
+
+
+async def _sample_threadpool(port: int, stop: asyncio.Event, samples: list) -> None:
+    connection = HttpConnection(APP_HOST, port)
+    try:
+        while not stop.is_set():
+            _, body = await connection.request("GET", "/debug/threadpool")
+            samples.append(json.loads(body))
+            await asyncio.sleep(THREADPOOL_SAMPLE_INTERVAL_S)
+    finally:
+        connection.close()
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+
+async def run_stage(port: int, concurrency: int, duration_s: float) -> dict:
+    latencies: list[float] = []
+    errors: list = []
+    samples: list[dict] = []
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(_sample_threadpool(port, stop, samples))
+
+    started = time.monotonic()
+    deadline = started + duration_s
+    await asyncio.gather(*(_client(port, deadline, latencies, errors) for _ in range(concurrency)))
+    elapsed = time.monotonic() - started
+    stop.set()
+    await sampler
+
+    latencies.sort()
+    return {
+        "concurrency":       concurrency,
+        "requests":          len(latencies),
+        "errors":            len(errors),
+        "throughput_rps":    round(len(latencies) / elapsed, 1),
+        "p50_ms":            round(_percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms":            round(_percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms":            round(_percentile(latencies, 0.99) * 1000, 2),
+        "threads_total":     samples[-1]["total_tokens"] if samples else None,
+        "threads_busy_max":  max((s["borrowed_tokens"] for s in samples), default=0),
+        "threads_queue_max": max((s["tasks_waiting"] for s in samples), default=0),
+    }
+
+
+COLUMNS = [
+    ("concurrency", 11), ("requests", 9), ("errors", 7), ("throughput_rps", 14), ("p50_ms", 9),
+    ("p95_ms", 9), ("p99_ms", 9), ("threads_busy_max", 16), ("threads_queue_max", 17),
+]
+
+
+def print_row(result: dict) -> None:
+    print("".join(f"{result[name]!s:>{width}}" for name, width in COLUMNS), flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION_S, help="seconds per stage")
+    parser.add_argument("--port", type=int, default=APP_PORT)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    point_devices_at_simulators(start_simulators())
+    server = start_app(args.port)
+    data = asyncio.run(wait_for_sources(args.port))
+    print(f"Sources ready: PV {data['pv_power']} W, battery {data['battery_power']} W, SoC {data['battery_SoC']} %")
+
+    print("".join(f"{name:>{width}}" for name, width in COLUMNS))
+    results = []
+    for concurrency in args.concurrency:
+        result = asyncio.run(run_stage(args.port, concurrency, args.duration))
+        print_row(result)
+        results.append(result)
+
+    server.should_exit = True
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
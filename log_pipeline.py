@@ -0,0 +1,163 @@
+"""
+log_pipeline.py
+
+Non-blocking logging for the backend.
+
+configure() replaces the synchronous root handler with a QueueHandler: log
+calls only put the record on a bounded queue, a QueueListener thread formats
+and writes it (the handler passes the record on unformatted, the standard
+QueueHandler would format it in the calling thread). When the queue is full
+(writer stuck on a slow terminal or disk) records are dropped and counted
+instead of blocking the event loop.
+
+Repeated warnings and errors are rate limited per call site (file and line)
+and subject – the first %-argument (usually the device) or, for messages
+without arguments, the message itself: at most RATE_LIMIT_BURST records per
+RATE_LIMIT_WINDOW_S, the rest is counted, and the next record that passes
+carries the number of suppressed ones. A device that is offline therefore
+logs a few lines per window instead of one line per attempt, without hiding
+the errors of other devices logged from the same line.
+
+Hot-path log calls use %-style arguments, so the message is only built when
+the level is enabled.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from typing import Optional
+
+LOG_FORMAT = "%(asctime)s [%(levelname)s] %(name)s: %(message)s"
+LOG_LEVEL  = os.environ.get("PV_BACKEND_LOG_LEVEL", "INFO")
+
+LOG_QUEUE_SIZE = 10000
+
+# Per call site: RATE_LIMIT_BURST records of level ≥ RATE_LIMIT_LEVEL per window
+RATE_LIMIT_LEVEL    = logging.WARNING
+RATE_LIMIT_BURST    = 5
+RATE_LIMIT_WINDOW_S = 60
+# rate-limit keys kept; expired ones are dropped beyond this
+RATE_LIMIT_MAX_KEYS = 1000
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class RateLimitFilter(logging.Filter):
+    """Drops repeated records of the same call site and subject beyond the burst per window."""
+
+    def __init__(self, burst: int = RATE_LIMIT_BURST, window_s: float = RATE_LIMIT_WINDOW_S, level: int = RATE_LIMIT_LEVEL):
+        super().__init__()
+        self.burst = burst
+        self.window_s = window_s
+        self.level = level
+        self._lock = threading.Lock()
+        # (pathname, lineno, subject) → [window start, passed in window, suppressed since last passed record]
+        self._sites: dict[tuple[str, int, str], list] = {}
+
+    @staticmethod
+    def _key(record: logging.LogRecord) -> tuple[str, int, str]:
+        if isinstance(record.args, tuple) and record.args:
+            subject = str(record.args[0])
+        else:
+            subject = str(record.msg)
+        return record.pathname, record.lineno, subject
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < self.level:
+            return True
+        now = time.monotonic()
+        key = self._key(record)
+        with self._lock:
+            if key not in self._sites and len(self._sites) >= RATE_LIMIT_MAX_KEYS:
+                self._drop_expired(now)
+            site = self._sites.setdefault(key, [now, 0, 0])
+            if now - site[0] >= self.window_s:
+                site[0], site[1] = now, 0
+            if site[1] >= self.burst:
+                site[2] += 1
+                return False
+            site[1] += 1
+            suppressed, site[2] = site[2], 0
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+        return True
+
+    def _drop_expired(self, now: float) -> None:
+        """Forget keys whose window ended and that have nothing suppressed. Caller holds _lock."""
+        for key in [
+            key for key, site in self._sites.items() if now - site[0] >= self.window_s and not site[2]
+        ]:
+            del self._sites[key]
+
+    def stats(self) -> list[dict]:
+        with self._lock:
+            return [
+                {"site": f"{os.path.basename(path)}:{line}", "subject": subject, "suppressed": site[2]}
+                for (path, line, subject), site in self._sites.items()
+                if site[2]
+            ]
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the queue is full instead of blocking."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # formatting is left to the listener thread (the queue never leaves the process)
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+rate_limit_filter = RateLimitFilter()
+queue_handler: Optional[DroppingQueueHandler] = None
+
+
+def configure(level: str = LOG_LEVEL) -> None:
+    """Route all logging through the queue (idempotent)."""
+    global _listener, queue_handler
+    if _listener is not None:
+        return
+
+    writer = logging.StreamHandler()
+    writer.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(rate_limit_filter)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(queue_handler.queue, writer, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown)
+
+
+def shutdown() -> None:
+    """Flush the queue and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def stats() -> dict:
+    return {
+        "queued": queue_handler.queue.qsize() if queue_handler else 0,
+        "dropped": queue_handler.dropped if queue_handler else 0,
+        "rate_limited": rate_limit_filter.stats(),
+    }
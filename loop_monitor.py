@@ -0,0 +1,119 @@
+"""
+loop_monitor.py
+
+Event-loop lag watchdog.
+
+A background task sleeps for LOOP_LAG_INTERVAL_S and measures how late it
+wakes up; the difference is the time the loop was busy with something else
+(typically a synchronous Modbus call). Lag percentiles are served at
+GET /debug/loop.
+
+In debug mode (PV_BACKEND_LOOP_DEBUG=1) a watchdog thread additionally checks
+the task's heartbeat. When the loop has not come back for longer than
+BLOCKING_THRESHOLD_S it captures the stack of the loop thread, i.e. the code
+that is blocking it, and keeps the report for the endpoint and the log.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Optional
+
+LOOP_LAG_INTERVAL_S  = 0.1
+LOOP_LAG_SAMPLES     = 3000          # ~5 minutes at the default interval
+BLOCKING_THRESHOLD_S = float(os.environ.get("PV_BACKEND_BLOCKING_THRESHOLD_S", "0.25"))
+BLOCKING_REPORTS     = 50
+
+debug = os.environ.get("PV_BACKEND_LOOP_DEBUG", "0") == "1"
+
+logger = logging.getLogger(__name__)
+
+_lag_samples: deque = deque(maxlen=LOOP_LAG_SAMPLES)
+_blocking_reports: deque = deque(maxlen=BLOCKING_REPORTS)
+_heartbeat = time.monotonic()
+_loop_thread_id: Optional[int] = None
+
+
+async def monitor_loop_lag():
+    """
+    background task measuring event-loop lag (and feeding the blocking-call watchdog)
+    """
+    global _heartbeat, _loop_thread_id
+    _loop_thread_id = threading.get_ident()
+    _heartbeat = time.monotonic()
+    stop = threading.Event()
+    if debug:
+        threading.Thread(target=_watchdog, args=(stop,), name="loop_watchdog", daemon=True).start()
+    logger.info(f"✅ Loop lag monitor started (blocking-call detector {'on' if debug else 'off'})")
+
+    try:
+        while True:
+            expected = time.monotonic() + LOOP_LAG_INTERVAL_S
+            await asyncio.sleep(LOOP_LAG_INTERVAL_S)
+            now = time.monotonic()
+            _lag_samples.append(max(now - expected, 0.0))
+            _heartbeat = now
+    except asyncio.CancelledError:
+        logger.warning("🛑 Loop lag monitor cancelled")
+        stop.set()
+        raise
+
+
+def _watchdog(stop: threading.Event) -> None:
+    report = None
+    while not stop.wait(BLOCKING_THRESHOLD_S / 2):
+        heartbeat = _heartbeat
+        # the task wakes every LOOP_LAG_INTERVAL_S, anything beyond that is blocking
+        blocked_for = time.monotonic() - heartbeat - LOOP_LAG_INTERVAL_S
+
+        if report is not None and report["heartbeat"] != heartbeat:
+            logger.warning(
+                f"⚠️ Event loop was blocked for {report['blocked_s']:.3f}s in:\n{report['stack']}"
+            )
+            report = None
+
+        if blocked_for <= BLOCKING_THRESHOLD_S:
+            continue
+        if report is None:
+            frame = sys._current_frames().get(_loop_thread_id)
+            if frame is None:
+                continue
+            report = {
+                "heartbeat":  heartbeat,
+                "detected_at": time.time(),
+                "blocked_s":  blocked_for,
+                "stack":      "".join(traceback.format_stack(frame)),
+            }
+            _blocking_reports.append(report)
+        else:
+            report["blocked_s"] = blocked_for
+
+
+def _percentile(sorted_values: list[float], fraction: float) -> float:
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def lag_stats() -> dict:
+    lags = sorted(_lag_samples)
+    stats = {"samples": len(lags), "interval_s": LOOP_LAG_INTERVAL_S, "debug": debug}
+    if lags:
+        stats.update({
+            "p50_ms": round(_percentile(lags, 0.50) * 1000, 3),
+            "p90_ms": round(_percentile(lags, 0.90) * 1000, 3),
+            "p99_ms": round(_percentile(lags, 0.99) * 1000, 3),
+            "max_ms": round(lags[-1] * 1000, 3),
+        })
+    return stats
+
+
+def blocking_reports() -> list[dict]:
+    return [
+        {key: value for key, value in report.items() if key != "heartbeat"}
+        for report in reversed(_blocking_reports)
+    ]
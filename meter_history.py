@@ -0,0 +1,100 @@
+"""
+meter_history.py
+
+Down-sampled history of the meter values, for offline analysis (regulator
+tuning) and PV forecasting.
+
+Every HISTORY_SAMPLE_INTERVAL_S one record is appended to a daily binary file
+HISTORY_DIR/meter_YYYY-MM-DD.bin. Records are fixed-size little-endian
+float64 tuples (see FIELDS), so a year of data loads with one np.fromfile per
+day and no parsing.
+"""
+
+import glob
+import logging
+import os
+import struct
+import threading
+import time
+from datetime import date, datetime
+from typing import Callable, Optional
+
+import numpy as np
+
+import shared_state
+
+HISTORY_DIR               = os.environ.get("PV_BACKEND_HISTORY_DIR", "history")
+HISTORY_SAMPLE_INTERVAL_S = 10
+
+FIELDS = ("timestamp", "grid_w", "pv_w", "battery_w", "battery_soc", "wallbox_w")
+RECORD_DTYPE = np.dtype([(name, "<f8") for name in FIELDS])
+_RECORD = struct.Struct("<" + "d" * len(FIELDS))
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_last_sample = 0.0
+_wallbox_power_w = 0.0
+_listeners: list[Callable[[tuple], None]] = []
+
+
+def set_wallbox_power(total_w: float) -> None:
+    """Latest total charging power of all wallboxes (recorded with the next sample)."""
+    global _wallbox_power_w
+    _wallbox_power_w = total_w
+
+
+def add_listener(listener: Callable[[tuple], None]) -> None:
+    """Call listener(record) for every record appended from now on."""
+    _listeners.append(listener)
+
+
+def _path_for(day: date) -> str:
+    return os.path.join(HISTORY_DIR, f"meter_{day.isoformat()}.bin")
+
+
+def record_sample(timestamp: Optional[float] = None) -> None:
+    """Append the current meter values if HISTORY_SAMPLE_INTERVAL_S has passed."""
+    global _last_sample
+    timestamp = timestamp or time.time()
+    if timestamp - _last_sample < HISTORY_SAMPLE_INTERVAL_S:
+        return
+    _last_sample = timestamp
+
+    record = (
+        timestamp,
+        shared_state.grid_power / 10,
+        float(shared_state.pv_power),       # all PV sources, not only the PV meter
+        float(shared_state.battery_power),
+        float(shared_state.battery_SoC),
+        _wallbox_power_w,
+    )
+    try:
+        with _lock:
+            os.makedirs(HISTORY_DIR, exist_ok=True)
+            with open(_path_for(datetime.fromtimestamp(timestamp).date()), "ab") as f:
+                f.write(_RECORD.pack(*record))
+    except OSError as e:
+        logger.error(f"Could not append meter history: {e}")
+        return
+
+    for listener in _listeners:
+        listener(record)
+
+
+def load_history(
+    start: Optional[date] = None, end: Optional[date] = None, history_dir: str = HISTORY_DIR
+) -> np.ndarray:
+    """All records of the days in [start, end] (inclusive) as a structured array, sorted by time."""
+    days = []
+    for path in sorted(glob.glob(os.path.join(history_dir, "meter_*.bin"))):
+        day = date.fromisoformat(os.path.basename(path)[len("meter_"):-len(".bin")])
+        if (start is None or day >= start) and (end is None or day <= end):
+            with open(path, "rb") as f:
+                raw = f.read()
+            # drop a torn last record (crash while appending)
+            usable = len(raw) - len(raw) % RECORD_DTYPE.itemsize
+            days.append(np.frombuffer(raw[:usable], dtype=RECORD_DTYPE))
+    if not days:
+        return np.empty(0, dtype=RECORD_DTYPE)
+    return np.concatenate(days)
@@ -0,0 +1,256 @@
+"""
+modbus_discovery.py
+
+Finds wallboxes on the local network and proposes wallbox_config entries.
+
+Every address of a subnet is tried on every Modbus port concurrently (at most
+DISCOVERY_CONCURRENCY connection attempts at a time, short connect and read
+timeouts), so a /24 is done in about a second. Endpoints that accept a
+connection are fingerprinted against the register maps of the wallbox
+drivers: a responder is e.g. a KEBA P30 X when every probe register of the
+KEBA map answers with a plausible value. Devices that are not configured yet
+get a proposed entry in the format of wallbox_config.build_wallboxes.
+
+Run with:
+  python modbus_discovery.py 192.168.188.0/24
+  python modbus_discovery.py --simulate          # against the device_simulator stand-ins
+or via POST /discovery/scan.
+"""
+
+import argparse
+import asyncio
+import ipaddress
+import json
+import logging
+import os
+import struct
+import time
+from typing import Callable, Iterable, Optional
+
+from modbus_interaction import combine_registers
+from modbus_pipeline import READ_HOLDING_REGISTERS
+import sites
+from wallbox import wallbox_juice, wallbox_keba
+
+DISCOVERY_SUBNET      = os.environ.get("PV_BACKEND_DISCOVERY_SUBNET", "192.168.188.0/24")
+DISCOVERY_PORTS       = (502, 1502)
+DISCOVERY_CONCURRENCY = 256
+MAX_SCAN_HOSTS        = 1024       # /22
+
+CONNECT_TIMEOUT_S = 0.3
+READ_TIMEOUT_S    = 0.5
+
+_MBAP = struct.Struct(">HHHB")   # transaction id, protocol id, length, unit id
+
+logger = logging.getLogger(__name__)
+
+# wallbox type (see wallbox_config.WALLBOX_TYPES) → unit id, probes and entry defaults.
+# probe: (register, count, plausible(value)); two registers are one 32-bit value.
+FINGERPRINTS: dict[str, dict] = {
+    "keba": {
+        "model": "KEBA P30 X",
+        "slave": wallbox_keba.MODBUS_SLAVE,
+        "number_of_phases": 3,
+        "probes": [
+            (wallbox_keba.REG_CHARGING_STATE, 2, lambda value: value in wallbox_keba.KEBA_STATE_MAP),
+            (wallbox_keba.REG_MAX_CURRENT, 2, lambda value: value == 0 or 6000 <= value <= 63000),   # mA
+        ],
+    },
+    "juice": {
+        "model": "Juice Charger Me",
+        "slave": wallbox_juice.MODBUS_SLAVE,
+        "number_of_phases": 3,
+        "probes": [
+            (wallbox_juice.CHARGING_STATE_REGISTER, 1, lambda value: 0 <= value <= 6),              # IEC 61851
+            (wallbox_juice.MAX_CURRENT_REGISTER, 1, lambda value: 0 <= value <= 32),                # A
+        ],
+    },
+}
+
+
+# ── Probing ────────────────────────────────────────────────────────────────────
+
+async def _read_registers(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, tid: int, slave: int, register: int, count: int
+) -> Optional[list[int]]:
+    """Holding registers, or None for a Modbus exception response; ValueError for a malformed answer."""
+    pdu = struct.pack(">BHH", READ_HOLDING_REGISTERS, register, count)
+    writer.write(_MBAP.pack(tid, 0, len(pdu) + 1, slave) + pdu)
+    await writer.drain()
+
+    header = await asyncio.wait_for(reader.readexactly(_MBAP.size), READ_TIMEOUT_S)
+    response_tid, _, length, _ = _MBAP.unpack(header)
+    if length < 3:      # unit id, function code and at least one byte
+        raise ValueError(f"MBAP length {length}")
+    response = await asyncio.wait_for(reader.readexactly(length - 1), READ_TIMEOUT_S)
+    if response_tid != tid:
+        raise ValueError(f"transaction id {response_tid}, expected {tid}")
+    if response[0] != READ_HOLDING_REGISTERS:
+        return None
+    byte_count = response[1]
+    if byte_count != 2 * count or len(response) < 2 + byte_count:
+        raise ValueError(f"byte count {byte_count} for {count} registers")
+    return list(struct.unpack(f">{count}H", response[2:2 + byte_count]))
+
+
+async def _fingerprint(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, fingerprint: dict) -> Optional[dict]:
+    """Probe values when every probe register of the register map answers plausibly."""
+    values = {}
+    for tid, (register, count, plausible) in enumerate(fingerprint["probes"], start=1):
+        registers = await _read_registers(reader, writer, tid, fingerprint["slave"], register, count)
+        if registers is None:
+            return None
+        value = combine_registers(*registers) if count == 2 else registers[0]
+        if not plausible(value):
+            return None
+        values[register] = value
+    return values
+
+
+async def _probe(ip: str, port: int, semaphore: asyncio.Semaphore) -> Optional[dict]:
+    """
+    None when nothing listens; otherwise the endpoint with its fingerprint (type None if unknown).
+    Every register map is tried on a fresh connection, so a timeout or a late
+    answer to one probe cannot affect the next.
+    """
+    async with semaphore:
+        match = None
+        for wallbox_type, fingerprint in FINGERPRINTS.items():
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), CONNECT_TIMEOUT_S)
+            except (OSError, asyncio.TimeoutError):
+                if wallbox_type == next(iter(FINGERPRINTS)):
+                    return None
+                break
+            try:
+                values = await _fingerprint(reader, writer, fingerprint)
+            except (
+                OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, struct.error, ValueError, IndexError
+            ) as e:
+                logger.debug("Discovery probe %s:%s (%s) failed: %s", ip, port, wallbox_type, e)
+                values = None
+            finally:
+                writer.close()
+            if values is not None:
+                match = wallbox_type, values
+                break
+    if match is None:
+        return {"ip": ip, "modbus_port": port, "type": None}
+    wallbox_type, values = match
+    return {
+        "ip": ip,
+        "modbus_port": port,
+        "type": wallbox_type,
+        "model": FINGERPRINTS[wallbox_type]["model"],
+        "slave": FINGERPRINTS[wallbox_type]["slave"],
+        "registers": values,
+    }
+
+
+# ── Scan ───────────────────────────────────────────────────────────────────────
+
+def _hosts(subnet: str) -> list[str]:
+    """Addresses to scan; ValueError for an invalid or too large subnet."""
+    network = ipaddress.ip_network(subnet, strict=False)
+    if network.num_addresses > MAX_SCAN_HOSTS:
+        raise ValueError(f"Subnet {subnet} has more than {MAX_SCAN_HOSTS} addresses")
+    return [str(host) for host in network.hosts()] or [str(network.network_address)]
+
+
+def _configured_wallboxes() -> list:
+    return [wallbox for site in sites.SITES.values() for wallbox in site.wallboxes.values()]
+
+
+def propose_entries(devices: list[dict], configured: Iterable) -> list[dict]:
+    """wallbox_config entries for the identified devices that are not configured yet."""
+    configured = list(configured)
+    known = {(wallbox.ip, wallbox.modbus_port) for wallbox in configured}
+    next_id = max((wallbox.wallbox_id for wallbox in configured), default=0) + 1
+    entries = []
+    for device in devices:
+        if device["type"] is None or (device["ip"], device["modbus_port"]) in known:
+            continue
+        fingerprint = FINGERPRINTS[device["type"]]
+        entries.append({
+            "id": next_id,
+            "type": device["type"],
+            "name": f"{fingerprint['model']} {device['ip']}",
+            "number_of_phases": fingerprint["number_of_phases"],
+            "ip": device["ip"],
+            "modbus_port": device["modbus_port"],
+        })
+        next_id += 1
+    return entries
+
+
+async def scan(
+    subnet: str = DISCOVERY_SUBNET,
+    ports: Iterable[int] = DISCOVERY_PORTS,
+    concurrency: int = DISCOVERY_CONCURRENCY,
+    configured: Optional[Callable[[], list]] = None,
+) -> dict:
+    """
+    Scan every host of the subnet on every port.
+    configured: returns the wallboxes already in use (default: those of all sites).
+    """
+    hosts = _hosts(subnet)
+    ports = list(ports)
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(*(_probe(ip, port, semaphore) for ip in hosts for port in ports))
+    endpoints = [result for result in results if result is not None]
+
+    configured_wallboxes = (configured or _configured_wallboxes)()
+    known = {(wallbox.ip, wallbox.modbus_port) for wallbox in configured_wallboxes}
+    devices = [
+        {**endpoint, "configured": (endpoint["ip"], endpoint["modbus_port"]) in known}
+        for endpoint in endpoints if endpoint["type"] is not None
+    ]
+    duration_s = time.perf_counter() - started
+    logger.info(
+        f"Discovery of {subnet} on ports {ports}: {len(endpoints)} open endpoints, "
+        f"{len(devices)} wallboxes in {duration_s:.1f}s"
+    )
+    return {
+        "subnet": subnet,
+        "ports": ports,
+        "hosts_scanned": len(hosts),
+        "duration_s": round(duration_s, 2),
+        "open_endpoints": [
+            {"ip": endpoint["ip"], "modbus_port": endpoint["modbus_port"]}
+            for endpoint in endpoints if endpoint["type"] is None
+        ],
+        "devices": devices,
+        "proposed": propose_entries(devices, configured_wallboxes),
+    }
+
+
+# ── CLI ────────────────────────────────────────────────────────────────────────
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("subnet", nargs="?", default=DISCOVERY_SUBNET)
+    parser.add_argument("--ports", default=",".join(map(str, DISCOVERY_PORTS)), help="comma-separated")
+    parser.add_argument("--concurrency", type=int, default=DISCOVERY_CONCURRENCY)
+    parser.add_argument("--simulate", action="store_true", help="scan the local device_simulator stand-ins")
+    args = parser.parse_args()
+
+    subnet, ports = args.subnet, [int(port) for port in args.ports.split(",")]
+    if args.simulate:
+        from device_simulator import SIMULATOR_HOST, start_simulators
+        subnet, ports = f"{SIMULATOR_HOST}/32", sorted(start_simulators().values())
+
+    result = asyncio.run(scan(subnet, ports, args.concurrency))
+    print(f"Scanned {result['hosts_scanned']} hosts × {len(ports)} ports in {result['duration_s']}s")
+    for device in result["devices"]:
+        state = "configured" if device["configured"] else "new"
+        print(f"  {device['ip']}:{device['modbus_port']:<6} {device['model']:<18} {state}")
+    for endpoint in result["open_endpoints"]:
+        print(f"  {endpoint['ip']}:{endpoint['modbus_port']:<6} (no wallbox fingerprint)")
+    if result["proposed"]:
+        print("\nProposed wallbox entries:")
+        print(json.dumps(result["proposed"], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+modbus_gateway.py
+
+Optional local Modbus TCP server mirroring the SMA and wallbox registers.
+
+Other consumers (e.g. home automation) poll this gateway instead of the
+physical devices, so the backend stays the only client of each device. Reads
+are answered from the register mirror in modbus_interaction; writes are
+rejected unless GATEWAY_FORWARD_WRITES is set, in which case they are passed
+through the per-device scheduler like any other control write and only
+acknowledged once the device took them (a failed write is answered with a
+Modbus exception).
+
+Unit IDs
+────────
+  3        Sunny Tripower      (device unit 3)
+  4        Sunny Island        (device unit 3 as well, hence remapped)
+  10 + id  wallbox <id>        (see wallbox_config.WALLBOXES)
+
+Enable with PV_BACKEND_MODBUS_GATEWAY=1. The gateway listens on localhost
+only; set PV_BACKEND_MODBUS_GATEWAY_HOST to serve other hosts.
+"""
+
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from pymodbus.datastore import ModbusServerContext
+from pymodbus.datastore.context import ModbusBaseSlaveContext
+from pymodbus.server import StartAsyncTcpServer
+
+from modbus_interaction import (
+    SUNNY_ISLAND_IP,
+    TRIPOWER_IP,
+    mirrored_registers,
+    read_sma_modbus_batch,
+    sma_devices,
+    write_modbus_data,
+)
+from wallbox.wallbox_config import WALLBOXES
+
+GATEWAY_ENABLED        = os.environ.get("PV_BACKEND_MODBUS_GATEWAY", "0") == "1"
+GATEWAY_HOST           = os.environ.get("PV_BACKEND_MODBUS_GATEWAY_HOST", "127.0.0.1")
+GATEWAY_PORT           = int(os.environ.get("PV_BACKEND_MODBUS_GATEWAY_PORT", "5020"))
+GATEWAY_FORWARD_WRITES = os.environ.get("PV_BACKEND_MODBUS_GATEWAY_WRITES", "0") == "1"
+
+# Values older than this are not served (the consumer gets an exception instead)
+GATEWAY_MAX_AGE_S = 60
+
+# Seconds between refreshes of the SMA registers (wallboxes are polled by the
+# regulator and the energy accounting anyway)
+GATEWAY_REFRESH_INTERVAL_S = 5
+
+# gateway unit id → physical device (ip, port, slave)
+GATEWAY_UNITS: dict[int, tuple[str, int, int]] = {
+    3: (TRIPOWER_IP, 502, 3),
+    4: (SUNNY_ISLAND_IP, 502, 3),
+}
+GATEWAY_UNITS.update({
+    10 + wb_id: (wallbox.ip, wallbox.modbus_port, wallbox.slave)
+    for wb_id, wallbox in WALLBOXES.items()
+})
+
+READ_FUNCTION_CODES  = (3, 4)     # read holding / input registers
+WRITE_FUNCTION_CODES = (6, 16)    # write single / multiple registers
+
+logger = logging.getLogger(__name__)
+
+# keeps forwarded writes in order and off the event loop
+_write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gateway_write")
+
+
+class MirrorSlaveContext(ModbusBaseSlaveContext):
+    """Serves one physical device from the register mirror."""
+
+    def __init__(self, ip: str, modbus_port: int, slave: int):
+        self.ip = ip
+        self.modbus_port = modbus_port
+        self.slave = slave
+
+    def reset(self):
+        pass
+
+    def validate(self, fc_as_hex, address, count=1):
+        if fc_as_hex in READ_FUNCTION_CODES:
+            return self._mirrored(address, count) is not None
+        if fc_as_hex in WRITE_FUNCTION_CODES:
+            return GATEWAY_FORWARD_WRITES
+        return False
+
+    def getValues(self, fc_as_hex, address, count=1):
+        return self._mirrored(address, count) or [0] * count
+
+    def setValues(self, fc_as_hex, address, values):
+        # raises ModbusWriteError, which the server answers with a slave device failure
+        for offset, value in enumerate(values):
+            logger.info(f"Gateway forwarding write {self.ip}:{address + offset} = {value}")
+            write_modbus_data(self.ip, self.modbus_port, address + offset, self.slave, value)
+
+    async def async_setValues(self, fc_as_hex, address, values):
+        # the response goes out only after the device write
+        await asyncio.get_running_loop().run_in_executor(
+            _write_executor, self.setValues, fc_as_hex, address, values
+        )
+
+    def _mirrored(self, address, count):
+        return mirrored_registers(self.ip, self.modbus_port, self.slave, address, count, GATEWAY_MAX_AGE_S)
+
+
+def _refresh_sma_registers() -> None:
+    read_sma_modbus_batch(list(sma_devices))
+
+
+async def _refresh_loop():
+    while True:
+        try:
+            await asyncio.to_thread(_refresh_sma_registers)
+        except Exception as e:
+            logger.error(f"⚠️ Gateway refresh error: {e}")
+        await asyncio.sleep(GATEWAY_REFRESH_INTERVAL_S)
+
+
+async def serve():
+    """
+    background task running the gateway server and keeping the SMA registers fresh
+    """
+    context = ModbusServerContext(
+        slaves={unit: MirrorSlaveContext(*device) for unit, device in GATEWAY_UNITS.items()},
+        single=False,
+    )
+    refresh = asyncio.create_task(_refresh_loop(), name="gateway_refresh")
+    logger.info(f"✅ Modbus gateway on {GATEWAY_HOST}:{GATEWAY_PORT} (units {sorted(GATEWAY_UNITS)})")
+    try:
+        await StartAsyncTcpServer(context=context, address=(GATEWAY_HOST, GATEWAY_PORT))
+    except asyncio.CancelledError:
+        logger.warning("🛑 Modbus gateway cancelled")
+        raise
+    finally:
+        refresh.cancel()
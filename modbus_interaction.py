@@ -1,5 +1,17 @@
 from pymodbus.client import ModbusTcpClient  # older versions pymodbus.client.sync
+from concurrent.futures import Future, TimeoutError as FuturesTimeoutError
+from contextlib import ExitStack, contextmanager
+import asyncio
+import heapq
+import itertools
 import logging
+import os
+import threading
+import time
+from typing import Optional
+
+import modbus_pipeline
+import regulation_trace
 
 
 TRIPOWER_IP = "192.168.188.45"
@@ -65,57 +77,452 @@ sma_devices = {
     },
 }
 
-def write_modbus_data(ip: str, modbus_port: int, register: int, slave: int, value: int):
+# ── Per-device request scheduling ─────────────────────────────────────────────
+# Every physical device (ip, port, slave) gets one scheduler. It serializes all
+# Modbus transactions to that device, serves control writes before telemetry
+# reads and spaces requests so the device is never asked more often than it can
+# handle.
+
+PRIORITY_CONTROL   = 0   # writes and read-modify-write sequences (user / regulator commands)
+PRIORITY_TELEMETRY = 1   # plain reads
+
+DEFAULT_MAX_REQUESTS_PER_SECOND = 10
+
+# Per-device overrides of the request rate, keyed by (ip, port, slave)
+device_max_requests_per_second: dict[tuple, float] = {}
+
+
+class DeviceScheduler:
+    """
+    Priority queue for one Modbus device.
+
+    A caller obtains exclusive access with `slot(priority)`. Waiting callers are
+    served lowest priority value first, FIFO within the same priority. The slot
+    is reentrant for the owning thread, so a read-modify-write sequence can hold
+    the device across several transactions.
+
+    Waiting blocks the thread: call it from worker threads, never from the
+    event loop (a warning is logged when it happens).
+    """
+
+    def __init__(self, key: tuple, max_requests_per_second: float):
+        self.key = key
+        self.min_interval_s = 1 / max_requests_per_second
+        self._cond = threading.Condition()
+        self._waiting: list[tuple] = []   # heap of (priority, sequence)
+        self._sequence = itertools.count()
+        self._owner = None
+        self._depth = 0
+        self._last_request = 0.0
+        self.requests = 0
+        self.max_queue_depth = 0
+        self._loop_warning_logged = False
+
+    @contextmanager
+    def slot(self, priority: int = PRIORITY_TELEMETRY):
+        me = threading.get_ident()
+        self._check_not_on_event_loop()
+        with self._cond:
+            if self._owner == me:
+                self._depth += 1
+            else:
+                ticket = (priority, next(self._sequence))
+                heapq.heappush(self._waiting, ticket)
+                self.max_queue_depth = max(self.max_queue_depth, len(self._waiting))
+                try:
+                    while self._owner is not None or self._waiting[0] != ticket:
+                        self._cond.wait()
+                except BaseException:
+                    # interrupted while waiting: a ticket left in the heap would block every later caller
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    self._cond.notify_all()
+                    raise
+                heapq.heappop(self._waiting)
+                self._owner = me
+                self._depth = 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._owner = None
+                    self._cond.notify_all()
+
+    def _check_not_on_event_loop(self) -> None:
+        if self._loop_warning_logged:
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._loop_warning_logged = True
+        logger.warning("⚠️ Modbus device %s:%s accessed from the event loop thread – blocks the loop", *self.key[:2])
+
+    def held_by_current_thread(self) -> bool:
+        with self._cond:
+            return self._owner == threading.get_ident()
+
+    def throttle(self) -> None:
+        """Wait until the device may receive the next request. Call while holding the slot."""
+        wait = self._last_request + self.min_interval_s - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        self._last_request = time.monotonic()
+        self.requests += 1
+
+    def stats(self) -> dict:
+        ip, port, slave = self.key
+        with self._cond:
+            return {
+                "ip": ip,
+                "port": port,
+                "slave": slave,
+                "queue_depth": len(self._waiting),
+                "busy": self._owner is not None,
+                "max_queue_depth": self.max_queue_depth,
+                "requests": self.requests,
+                "max_requests_per_second": 1 / self.min_interval_s,
+            }
+
+
+_schedulers: dict[tuple, DeviceScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_device_scheduler(ip: str, modbus_port: int, slave: int) -> DeviceScheduler:
+    key = (ip, modbus_port, slave)
+    with _schedulers_lock:
+        scheduler = _schedulers.get(key)
+        if scheduler is None:
+            rate = device_max_requests_per_second.get(key, DEFAULT_MAX_REQUESTS_PER_SECOND)
+            scheduler = _schedulers[key] = DeviceScheduler(key, rate)
+        return scheduler
+
+
+def device_slot(ip: str, modbus_port: int, slave: int, priority: int = PRIORITY_CONTROL):
+    """
+    Hold a device across several transactions, e.g. read-before-write in the
+    wallbox drivers. Nested reads/writes from the same thread reuse the slot.
+    """
+    return get_device_scheduler(ip, modbus_port, slave).slot(priority)
+
+
+def scheduler_stats() -> list[dict]:
+    with _schedulers_lock:
+        schedulers = list(_schedulers.values())
+    return [scheduler.stats() for scheduler in schedulers]
+
+
+# ── Register mirror ────────────────────────────────────────────────────────────
+# Last value seen for every register read from or written to a device, keyed by
+# (ip, port, slave) → {register: (value, timestamp)}. Used by the Modbus gateway
+# to answer other consumers without touching the device.
+
+register_mirror: dict[tuple, dict[int, tuple[int, float]]] = {}
+_mirror_lock = threading.Lock()
+
+
+def _update_mirror(ip: str, modbus_port: int, slave: int, register: int, values: list[int]) -> None:
+    now = time.time()
+    with _mirror_lock:
+        registers = register_mirror.setdefault((ip, modbus_port, slave), {})
+        for offset, value in enumerate(values):
+            registers[register + offset] = (value, now)
+
+
+def mirrored_registers(
+    ip: str, modbus_port: int, slave: int, register: int, count: int, max_age_s: Optional[float] = None
+) -> Optional[list[int]]:
+    """Cached values of a register range, or None if any register is unknown or too old."""
+    oldest = time.time() - max_age_s if max_age_s is not None else 0
+    with _mirror_lock:
+        registers = register_mirror.get((ip, modbus_port, slave), {})
+        values = []
+        for address in range(register, register + count):
+            entry = registers.get(address)
+            if entry is None or entry[1] < oldest:
+                return None
+            values.append(entry[0])
+    return values
+
+
+# ── Read cache ─────────────────────────────────────────────────────────────────
+# Register ranges read within the last READ_CACHE_TTL_S are answered from
+# memory, keyed by (ip, port, slave, register, count). Concurrent readers of a
+# range that is not cached share one request (single flight). Any write to a
+# device drops all its entries – devices reflect written values in other
+# registers too (KEBA 5004 → 1100) – and results of reads that overlapped a
+# write are not stored. A thread holding the device (device_slot, e.g.
+# read-before-write) always reads the device.
+
+READ_CACHE_TTL_S = float(os.environ.get("PV_BACKEND_MODBUS_READ_CACHE_TTL", "1.0"))   # 0 disables
+
+_read_cache: dict[tuple, tuple[list[int], float]] = {}    # key → (registers, expires at)
+_reads_in_flight: dict[tuple, Future] = {}
+_write_generation: dict[tuple, int] = {}                  # (ip, port, slave) → writes started
+_read_cache_lock = threading.Lock()
+read_cache_counters = {"hits": 0, "misses": 0, "shared": 0}
+
+
+def _cached_read(key: tuple) -> Optional[list[int]]:
+    """Unexpired cached registers for key. Caller holds _read_cache_lock."""
+    entry = _read_cache.get(key)
+    if entry is not None and entry[1] > time.monotonic():
+        read_cache_counters["hits"] += 1
+        return list(entry[0])
+    return None
+
+
+def _store_read(key: tuple, registers, generation: int) -> None:
+    """Cache a successful read unless a write to the device started meanwhile. Caller holds _read_cache_lock."""
+    if isinstance(registers, list) and _write_generation.get(key[:3], 0) == generation:
+        _read_cache[key] = (list(registers), time.monotonic() + READ_CACHE_TTL_S)
+
+
+def _invalidate_reads(ip: str, modbus_port: int, slave: int) -> None:
+    device = (ip, modbus_port, slave)
+    with _read_cache_lock:
+        _write_generation[device] = _write_generation.get(device, 0) + 1
+        for key in [key for key in _read_cache if key[:3] == device]:
+            del _read_cache[key]
+
+
+def read_cache_stats() -> dict:
+    with _read_cache_lock:
+        return {"ttl_s": READ_CACHE_TTL_S, "entries": len(_read_cache), **read_cache_counters}
+
+
+class ModbusWriteError(Exception):
+    """A register write did not reach the device or was rejected by it."""
+
+
+def write_modbus_data(
+    ip: str, modbus_port: int, register: int, slave: int, value: int, priority: int = PRIORITY_CONTROL
+) -> None:
+    """Write one holding register; ModbusWriteError when the write did not happen."""
+    scheduler = get_device_scheduler(ip, modbus_port, slave)
+    _invalidate_reads(ip, modbus_port, slave)
     try:
-        client = ModbusTcpClient(ip, port=modbus_port, timeout=10)
-        connection = client.connect()
-        if connection:
-            response = client.write_register(register, value, slave=slave)
-        else:
-            logger.error("Failed to connect to Modbus Server")
-        client.close()
+        with regulation_trace.span("modbus_write", ip=ip, register=register, value=value), scheduler.slot(priority):
+            scheduler.throttle()
+            client = ModbusTcpClient(ip, port=modbus_port, timeout=10)
+            try:
+                if not client.connect():
+                    raise ModbusWriteError(f"failed to connect to Modbus server {ip}:{modbus_port}")
+                response = client.write_register(register, value, slave=slave)
+                if response.isError():
+                    raise ModbusWriteError(f"device rejected the write: {response}")
+            finally:
+                client.close()
+            _update_mirror(ip, modbus_port, slave, register, [value])
+    except ModbusWriteError as e:
+        logger.error("Error writing to %s:%s - %s", ip, register, e)
+        raise
     except Exception as e:
-        logger.error(f"Error writing to {ip}:{register} - {e}")
+        logger.error("Error writing to %s:%s - %s", ip, register, e)
+        raise ModbusWriteError(str(e)) from e
+    finally:
+        # reads that completed during the write may hold the old value
+        _invalidate_reads(ip, modbus_port, slave)
 
 
-def read_modbus_data(ip: str, modbus_port: int, register: int, slave: int, count: int):
+def read_modbus_data(
+    ip: str, modbus_port: int, register: int, slave: int, count: int, priority: int = PRIORITY_TELEMETRY
+):
+    """
+    Holding registers of a range (list), None without a valid response or the
+    exception. Served from the read cache / a concurrent identical read if possible.
+    """
+    if READ_CACHE_TTL_S <= 0:
+        return _read_modbus_device(ip, modbus_port, register, slave, count, priority)
+
+    key = (ip, modbus_port, slave, register, count)
+    # the thread holding the device (read-modify-write) reads the device itself:
+    # a cached value may predate its slot, and the leader of a shared read would wait for the slot
+    holds_device = get_device_scheduler(ip, modbus_port, slave).held_by_current_thread()
+    with _read_cache_lock:
+        cached = None if holds_device else _cached_read(key)
+        if cached is not None:
+            return cached
+        future = None if holds_device else _reads_in_flight.get(key)
+        if future is not None:
+            read_cache_counters["shared"] += 1
+        else:
+            read_cache_counters["misses"] += 1
+            generation = _write_generation.get((ip, modbus_port, slave), 0)
+            leader = None if holds_device else _reads_in_flight.setdefault(key, Future())
+
+    if future is not None:
+        result = future.result()
+        return list(result) if isinstance(result, list) else result
+
+    result = None
     try:
-        client = ModbusTcpClient(ip, port=modbus_port, timeout=10)
-        client.connect()
-        response = client.read_holding_registers(
-            register, count=count, slave=slave
-        )  # older versions unit instead of slave
-        client.close()
+        result = _read_modbus_device(ip, modbus_port, register, slave, count, priority)
+        return result
+    finally:
+        with _read_cache_lock:
+            _store_read(key, result, generation)
+            if leader is not None:
+                del _reads_in_flight[key]
+        if leader is not None:
+            leader.set_result(result)
+
+
+def _read_modbus_device(ip: str, modbus_port: int, register: int, slave: int, count: int, priority: int):
+    scheduler = get_device_scheduler(ip, modbus_port, slave)
+    try:
+        with regulation_trace.span("modbus_read", ip=ip, register=register, count=count), scheduler.slot(priority):
+            scheduler.throttle()
+            client = ModbusTcpClient(ip, port=modbus_port, timeout=10)
+            client.connect()
+            response = client.read_holding_registers(
+                register, count=count, slave=slave
+            )  # older versions unit instead of slave
+            client.close()
         if response and response.registers:
+            _update_mirror(ip, modbus_port, slave, register, response.registers)
             return response.registers
         else:
-            logger.error(f"Error reading {ip}:{register} - no response or no registers in response")
+            logger.error("Error reading %s:%s - no response or no registers in response", ip, register)
             return (
                 None  # Return 0 if the register is empty or there is no valid response
             )
     except Exception as e:
-        logger.error(f"Error reading {ip}:{register} - {e}")
+        logger.error("Error reading %s:%s - %s", ip, register, e)
         return e  # Return 0 in case of an exception
 
 
+def read_modbus_batch(requests: list[dict], priority: int = PRIORITY_TELEMETRY) -> list:
+    """
+    Read several independent register ranges at once.
+    requests: dicts with ip, modbus_port, register, slave, count.
+
+    Requests to the same endpoint are pipelined over one connection (see
+    modbus_pipeline), so the batch takes about one round trip per endpoint
+    instead of one per request. Every involved device is held for the whole
+    batch; the batch counts as one request for its throttle.
+    Returns the registers per request, or None where the read failed.
+    Ranges in the read cache are not requested again.
+    """
+    results = [None] * len(requests)
+    pending = list(range(len(requests)))
+    if READ_CACHE_TTL_S > 0:
+        with _read_cache_lock:
+            generations = {}
+            for index, r in enumerate(requests):
+                results[index] = _cached_read((r["ip"], r["modbus_port"], r["slave"], r["register"], r["count"]))
+                generations[(r["ip"], r["modbus_port"], r["slave"])] = _write_generation.get(
+                    (r["ip"], r["modbus_port"], r["slave"]), 0
+                )
+        pending = [index for index in pending if results[index] is None]
+        if not pending:
+            return results
+    all_requests, requests = requests, [requests[index] for index in pending]
+
+    keys = sorted({(r["ip"], r["modbus_port"], r["slave"]) for r in requests})
+    with ExitStack() as stack:
+        for key in keys:
+            scheduler = get_device_scheduler(*key)
+            stack.enter_context(scheduler.slot(priority))
+            scheduler.throttle()
+
+        with regulation_trace.span("modbus_batch_read", requests=len(requests), devices=len(keys)):
+            # one deadline for the whole batch: hung requests must not add up
+            deadline = time.monotonic() + modbus_pipeline.REQUEST_TIMEOUT_S
+            attempts = [
+                (index, request, _submit_batch_read(request, deadline)) for index, request in zip(pending, requests)
+            ]
+            for retry in (False, True):
+                broken = []
+                for index, request, future in attempts:
+                    try:
+                        registers = future.result(timeout=max(deadline - time.monotonic(), 0))
+                    except FuturesTimeoutError:
+                        modbus_pipeline.get_connection(request["ip"], request["modbus_port"]).abandon(future)
+                        logger.error("Error reading %s:%s - timeout", request["ip"], request["register"])
+                        continue
+                    except OSError as e:
+                        if not retry:
+                            broken.append((index, request))
+                            continue
+                        logger.error("Error reading %s:%s - %s", request["ip"], request["register"], e)
+                        continue
+                    except Exception as e:
+                        logger.error("Error reading %s:%s - %s", request["ip"], request["register"], e)
+                        continue
+                    _update_mirror(
+                        request["ip"], request["modbus_port"], request["slave"], request["register"], registers
+                    )
+                    results[index] = registers
+                # the device dropped the persistent connection (idle, restart): reconnect once and retry
+                attempts = [(index, request, _submit_batch_read(request, deadline)) for index, request in broken]
+
+    if READ_CACHE_TTL_S > 0:
+        with _read_cache_lock:
+            read_cache_counters["misses"] += len(pending)
+            for index in pending:
+                r = all_requests[index]
+                device = (r["ip"], r["modbus_port"], r["slave"])
+                _store_read((*device, r["register"], r["count"]), results[index], generations[device])
+    return results
+
+
+def _submit_batch_read(request: dict, deadline: float) -> Future:
+    connection = modbus_pipeline.get_connection(request["ip"], request["modbus_port"])
+    return connection.submit_read(
+        request["slave"], request["register"], request["count"], timeout=deadline - time.monotonic()
+    )
+
+
+def _decode_sma_value(registers, signed: bool, nan_value: int) -> int:
+    if registers and len(registers) == 2:
+        value = combine_registers(registers[0], registers[1])
+        if value == nan_value:
+            return 0
+        if signed:
+            return int.from_bytes(
+                value.to_bytes(length=4), byteorder="big", signed=True
+            )
+        else:
+            return value
+    else:
+        return 0  # Return 0 if the register is empty or there is no valid response
+
+
 # Modbus read function
 def read_sma_modbus_data(
     ip: str, modbus_port: int, register: int, slave: int, signed: bool, nan_value: int
 ):
     try:
         registers = read_modbus_data(ip, modbus_port, register, slave, 2)
-        if registers and len(registers) == 2:
-            value = combine_registers(registers[0], registers[1])
-            if value == nan_value:
-                return 0
-            if signed:
-                return int.from_bytes(
-                    value.to_bytes(length=4), byteorder="big", signed=True
-                )
-            else:
-                return value
-        else:
-            return 0  # Return 0 if the register is empty or there is no valid response
+        return _decode_sma_value(registers, signed, nan_value)
     except Exception as e:
-        logger.error(f"Error reading {ip}:{register} - {e}")
+        logger.error("Error reading %s:%s - %s", ip, register, e)
         return 0  # Return 0 in case of an exception
+
+
+def read_sma_modbus_values(devices: list[dict]) -> list[Optional[int]]:
+    """
+    Decoded values for several sma_devices-style dicts (ip, modbus_port,
+    register, slave, signed, nan_value) in one pipelined batch; None where the read failed.
+    """
+    registers = read_modbus_batch([
+        {"ip": d["ip"], "modbus_port": d["modbus_port"], "register": d["register"], "slave": d["slave"], "count": 2}
+        for d in devices
+    ])
+    return [
+        _decode_sma_value(values, device["signed"], device["nan_value"]) if values is not None else None
+        for device, values in zip(devices, registers)
+    ]
+
+
+def read_sma_modbus_batch(names: list[str]) -> dict[str, Optional[int]]:
+    """
+    Several sma_devices values in one pipelined batch: name → value, None where
+    the read failed (unknown, not 0 W: callers keep their previous reading).
+    """
+    values = read_sma_modbus_values([sma_devices[name] for name in names])
+    return dict(zip(names, values))
@@ -0,0 +1,240 @@
+"""
+modbus_pipeline.py
+
+Pipelined Modbus TCP client.
+
+One persistent connection per endpoint (ip, port). Requests for any unit ID on
+that endpoint are written without waiting for earlier responses; a reader
+thread matches each response to its request by the MBAP transaction ID. At
+most `window` requests are in flight per endpoint, so a device that handles
+only a few parallel transactions is not overrun (window 1 = classic
+request/response). The window defaults to 1: many servers (the pymodbus
+servers of device_simulator.py among them) answer only the first of several
+back-to-back requests, so a larger window is set per device in
+device_pipeline_window once that device has been verified.
+
+Devices drop idle connections, often without the client noticing until the
+next request fails. A connection idle for longer than IDLE_RECONNECT_S is
+therefore reopened before the next request, TCP keepalive detects dead peers
+in between, and batch reads retry requests that failed on a broken
+connection once (see modbus_interaction.read_modbus_batch).
+
+Only the function codes the backend needs are implemented:
+  0x03 read holding registers
+  0x06 write single register
+"""
+
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FuturesTimeoutError
+from typing import Optional
+
+DEFAULT_PIPELINE_WINDOW = int(os.environ.get("PV_BACKEND_MODBUS_PIPELINE_WINDOW", "1"))
+
+# Per-endpoint overrides of the in-flight window, keyed by (ip, port); only for
+# devices verified to answer pipelined requests
+device_pipeline_window: dict[tuple, int] = {}
+
+CONNECT_TIMEOUT_S = 3
+REQUEST_TIMEOUT_S = 10
+# A connection without traffic for this long is reopened before the next request
+IDLE_RECONNECT_S  = 30
+
+READ_HOLDING_REGISTERS = 0x03
+WRITE_SINGLE_REGISTER  = 0x06
+
+_MBAP = struct.Struct(">HHHB")   # transaction id, protocol id, length, unit id
+
+logger = logging.getLogger(__name__)
+
+
+class ModbusExceptionResponse(Exception):
+    def __init__(self, function_code: int, exception_code: int):
+        super().__init__(f"Modbus exception {exception_code} for function {function_code:#04x}")
+        self.exception_code = exception_code
+
+
+class PipelinedConnection:
+    def __init__(self, ip: str, port: int, window: int):
+        self.ip = ip
+        self.port = port
+        self.window = window
+        self._slots = threading.BoundedSemaphore(window)
+        self._lock = threading.Lock()
+        self._sock: Optional[socket.socket] = None
+        self._next_tid = 0
+        self._last_activity = 0.0
+        self._pending: dict[int, tuple[Future, int]] = {}   # tid → (future, function code)
+        self.requests = 0
+        self.max_in_flight = 0
+
+    # ── Requests ───────────────────────────────────────────────────────────────
+
+    def submit_read(self, slave: int, register: int, count: int, timeout: float = REQUEST_TIMEOUT_S) -> Future:
+        """
+        Future resolving to the list of register values.
+        timeout: how long to wait for a free slot in the window.
+        """
+        return self._submit(slave, READ_HOLDING_REGISTERS, struct.pack(">HH", register, count), timeout)
+
+    def submit_write(self, slave: int, register: int, value: int, timeout: float = REQUEST_TIMEOUT_S) -> Future:
+        """Future resolving to the echoed value."""
+        return self._submit(slave, WRITE_SINGLE_REGISTER, struct.pack(">HH", register, value & 0xFFFF), timeout)
+
+    def abandon(self, future: Future) -> None:
+        """Give up on a request (caller timed out); a late response is ignored."""
+        with self._lock:
+            for tid, (pending, _) in list(self._pending.items()):
+                if pending is future:
+                    del self._pending[tid]
+                    self._slots.release()
+                    break
+
+    def _submit(self, slave: int, function_code: int, payload: bytes, timeout: float) -> Future:
+        future: Future = Future()
+        if not self._slots.acquire(timeout=max(timeout, 0)):
+            # the requests in flight are not answered (silent device)
+            future.set_exception(FuturesTimeoutError(f"no free request slot for {self.ip}:{self.port}"))
+            return future
+        registered = False
+        try:
+            with self._lock:
+                if self._sock is not None and not self._pending and self._idle_for() > IDLE_RECONNECT_S:
+                    # the device has probably dropped it already; its reader exits on the closed socket
+                    stale, self._sock = self._sock, None
+                    stale.close()
+                if self._sock is None:
+                    self._connect()
+                tid = self._next_tid
+                self._next_tid = (self._next_tid + 1) & 0xFFFF
+                self._pending[tid] = (future, function_code)
+                registered = True
+                self.requests += 1
+                self.max_in_flight = max(self.max_in_flight, len(self._pending))
+                frame = _MBAP.pack(tid, 0, len(payload) + 2, slave) + bytes([function_code]) + payload
+                self._sock.sendall(frame)
+                self._last_activity = time.monotonic()
+        except OSError as e:
+            if not registered:
+                self._slots.release()
+            self._fail_all(e)
+            if not future.done():
+                future.set_exception(e)
+        return future
+
+    # ── Connection handling ────────────────────────────────────────────────────
+
+    def _connect(self) -> None:
+        """Open the socket and start its reader. Caller holds _lock."""
+        sock = socket.create_connection((self.ip, self.port), timeout=CONNECT_TIMEOUT_S)
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self._sock = sock
+        threading.Thread(
+            target=self._read_responses, args=(sock,), name=f"modbus_pipeline_{self.ip}:{self.port}", daemon=True
+        ).start()
+
+    def _idle_for(self) -> float:
+        return time.monotonic() - self._last_activity
+
+    def _read_responses(self, sock: socket.socket) -> None:
+        try:
+            while True:
+                tid, _protocol, length, _unit = _MBAP.unpack(_receive_exactly(sock, _MBAP.size))
+                pdu = _receive_exactly(sock, length - 1)
+                with self._lock:
+                    self._last_activity = time.monotonic()
+                    entry = self._pending.pop(tid, None)
+                    if entry is not None:
+                        self._slots.release()
+                if entry is not None:
+                    future, function_code = entry
+                    _resolve(future, function_code, pdu)
+        except (OSError, EOFError, struct.error) as e:
+            self._fail_all(e, sock)
+
+    def _fail_all(self, error: Exception, sock: Optional[socket.socket] = None) -> None:
+        """Drop the connection and fail every pending request; the next request reconnects."""
+        with self._lock:
+            if sock is not None and sock is not self._sock:
+                return   # an older connection, already replaced
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+            pending, self._pending = self._pending, {}
+            for _ in pending:
+                self._slots.release()
+        for future, _ in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"Modbus connection {self.ip}:{self.port} lost: {error}"))
+
+    def close(self) -> None:
+        self._fail_all(ConnectionAbortedError("closed"))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "ip": self.ip,
+                "port": self.port,
+                "window": self.window,
+                "connected": self._sock is not None,
+                "in_flight": len(self._pending),
+                "max_in_flight": self.max_in_flight,
+                "requests": self.requests,
+            }
+
+
+def _receive_exactly(sock: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError("connection closed by device")
+        data += chunk
+    return data
+
+
+def _resolve(future: Future, function_code: int, pdu: bytes) -> None:
+    if len(pdu) == 2 and pdu[0] == function_code | 0x80:
+        future.set_exception(ModbusExceptionResponse(function_code, pdu[1]))
+    elif not _well_formed(function_code, pdu):
+        future.set_exception(ValueError(f"Malformed Modbus response for function {function_code:#04x}: {pdu.hex()}"))
+    elif function_code == READ_HOLDING_REGISTERS:
+        future.set_result(list(struct.unpack(f">{pdu[1] // 2}H", pdu[2:])))
+    else:
+        future.set_result(struct.unpack(">H", pdu[3:5])[0])
+
+
+def _well_formed(function_code: int, pdu: bytes) -> bool:
+    if not pdu or pdu[0] != function_code:
+        return False
+    if function_code == READ_HOLDING_REGISTERS:
+        return len(pdu) >= 2 and pdu[1] % 2 == 0 and len(pdu) == 2 + pdu[1]
+    return len(pdu) == 5
+
+
+# ── Registry ───────────────────────────────────────────────────────────────────
+
+_connections: dict[tuple, PipelinedConnection] = {}
+_connections_lock = threading.Lock()
+
+
+def get_connection(ip: str, modbus_port: int) -> PipelinedConnection:
+    key = (ip, modbus_port)
+    with _connections_lock:
+        connection = _connections.get(key)
+        if connection is None:
+            window = device_pipeline_window.get(key, DEFAULT_PIPELINE_WINDOW)
+            connection = _connections[key] = PipelinedConnection(ip, modbus_port, window)
+        return connection
+
+
+def connection_stats() -> list[dict]:
+    with _connections_lock:
+        connections = list(_connections.values())
+    return [connection.stats() for connection in connections]
@@ -0,0 +1,245 @@
+"""
+polling_policy.py
+
+State-aware polling rates for the energy sources (inverters, batteries) and
+the wallboxes.
+
+Every polled device is a PollTarget. After each reading the target picks its
+next interval:
+
+  * woken up by an event          → fast
+  * wallbox without a vehicle     → DISCONNECTED interval
+  * no PV production (night) and
+    nothing going on at the device → IDLE interval
+  * value unchanged               → interval doubles up to the STABLE maximum
+  * otherwise                     → fast
+
+Events that switch targets back to fast polling: a grid-meter jump of more than
+METER_DELTA_W (someone plugged in, a big consumer started), API commands
+for a wallbox and a changed state pushed by a KEBA over UDP (car plugged in
+or unplugged). A device that does not answer is retried after a doubling
+backoff instead of on every pass. A battery that charges or discharges counts as active, so it is
+not slowed down to the idle interval at night. Targets of further sites (see sites.py) are bound to their
+site's state, so idle time and meter jumps are judged per site.
+"""
+
+import threading
+import time
+from typing import Optional
+
+import shared_state
+
+# PV production below this counts as idle (night, heavy overcast)
+IDLE_PV_THRESHOLD_W = 50
+
+# Grid power change that wakes every target up
+METER_DELTA_W = 500
+
+
+class PollTarget:
+    def __init__(
+        self,
+        name: str,
+        fast_interval_s: float,
+        stable_max_interval_s: float,
+        idle_interval_s: float,
+        disconnected_interval_s: float,
+        tolerance: float,
+    ):
+        self.name = name
+        self.fast_interval_s = fast_interval_s
+        self.stable_max_interval_s = stable_max_interval_s
+        self.idle_interval_s = idle_interval_s
+        self.disconnected_interval_s = disconnected_interval_s
+        self.tolerance = tolerance
+
+        self.state = shared_state         # site state for the idle check, see bind_state
+        self.interval_s = fast_interval_s
+        self.next_poll = 0.0
+        self.last_value = None
+        self.polls = 0
+        self.skipped = 0
+        self.failures = 0                 # failed reads in a row
+        self._woken = True
+        self._lock = threading.Lock()
+
+    def due(self) -> bool:
+        """True when the device should be read now. Counts skipped polls otherwise."""
+        with self._lock:
+            if time.monotonic() >= self.next_poll:
+                return True
+            self.skipped += 1
+            return False
+
+    def record(self, value: float, active: bool = True, disconnected: bool = False) -> None:
+        """
+        Register a fresh reading and schedule the next one.
+        active: the device is doing something (e.g. charging) that must not be slowed down for idle time.
+        """
+        with self._lock:
+            stable = self.last_value is not None and abs(value - self.last_value) <= self.tolerance
+            if self._woken:
+                interval = self.fast_interval_s
+            elif disconnected:
+                interval = self.disconnected_interval_s
+            elif not active and is_idle(self.state):
+                interval = self.idle_interval_s
+            elif stable:
+                interval = min(self.interval_s * 2, self.stable_max_interval_s)
+            else:
+                interval = self.fast_interval_s
+
+            self._woken = False
+            self.last_value = value
+            self.interval_s = max(interval, self.fast_interval_s)
+            self.next_poll = time.monotonic() + self.interval_s
+            self.polls += 1
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        """
+        The device did not answer: retry after a backoff that doubles per failure
+        up to the disconnected interval. interval_s (the rate of good readings) is kept.
+        """
+        with self._lock:
+            self.failures += 1
+            backoff = min(self.fast_interval_s * 2 ** self.failures, self.disconnected_interval_s)
+            self.next_poll = time.monotonic() + backoff
+
+    def wake(self) -> None:
+        with self._lock:
+            self._woken = True
+            self.next_poll = 0.0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "name": self.name,
+                "interval_s": self.interval_s,
+                "next_poll_in_s": round(max(self.next_poll - time.monotonic(), 0), 1),
+                "polls": self.polls,
+                "skipped": self.skipped,
+                "failures": self.failures,
+            }
+
+
+# ── Registry ───────────────────────────────────────────────────────────────────
+
+# Target parameters by target name prefix
+TARGET_DEFAULTS = {
+    # energy sources (inverters, batteries): fresh enough for the regulator
+    "source_": dict(
+        fast_interval_s=1,
+        stable_max_interval_s=10,
+        idle_interval_s=60,
+        disconnected_interval_s=60,
+        tolerance=50,            # W
+    ),
+    # wallboxes: fast = every regulation pass / energy sample
+    "wallbox_": dict(
+        fast_interval_s=10,
+        stable_max_interval_s=60,
+        idle_interval_s=300,
+        disconnected_interval_s=120,
+        tolerance=0,             # charging state and current must match exactly
+    ),
+}
+
+_targets: dict[str, PollTarget] = {}
+_targets_lock = threading.Lock()
+# meter scope (site id, "" = default site) → grid power at the last wake-up
+_meter_reference: dict[str, float] = {}
+
+
+def wallbox_target_name(wallbox_id: int) -> str:
+    return f"wallbox_{wallbox_id}"
+
+
+def source_target_name(source_id: str) -> str:
+    return f"source_{source_id}"
+
+
+def get_target(name: str) -> PollTarget:
+    with _targets_lock:
+        target = _targets.get(name)
+        if target is None:
+            prefix = next(prefix for prefix in TARGET_DEFAULTS if name.startswith(prefix))
+            target = _targets[name] = PollTarget(name, **TARGET_DEFAULTS[prefix])
+        return target
+
+
+def wallbox(wallbox_id: int) -> PollTarget:
+    return get_target(wallbox_target_name(wallbox_id))
+
+
+def wallbox_poll_value(wb_state: dict) -> int:
+    """Single comparable value for a wallbox reading (state and current must both be unchanged)."""
+    return wb_state["charging_state"] * 100000 + wb_state["maximum_current"]
+
+
+def source(source_id: str) -> PollTarget:
+    return get_target(source_target_name(source_id))
+
+
+def bind_state(name: str, state) -> None:
+    """Judge the idle time of a target by the state of its site (default: shared_state)."""
+    get_target(name).state = state
+
+
+def wake(name: Optional[str] = None, names: Optional[list[str]] = None) -> None:
+    """Switch one target, the given targets or all of them back to fast polling."""
+    with _targets_lock:
+        if names is not None:
+            targets = [_targets.get(n) for n in names]
+        else:
+            targets = list(_targets.values()) if name is None else [_targets.get(name)]
+    for target in targets:
+        if target is not None:
+            target.wake()
+
+
+def is_idle(state=shared_state) -> bool:
+    return state.pv_power < IDLE_PV_THRESHOLD_W
+
+
+def notify_meter(grid_power_w: float, scope: str = "", names: Optional[list[str]] = None) -> None:
+    """
+    Wake the targets when the grid power jumped since the last wake-up.
+    scope/names: meter of a further site and the targets of that site (default: everything).
+    """
+    reference = _meter_reference.get(scope)
+    if reference is None or abs(grid_power_w - reference) > METER_DELTA_W:
+        _meter_reference[scope] = grid_power_w
+        wake(names=names)
+
+
+def snapshot_targets() -> dict:
+    """Intervals and last values of all targets, for a process handover."""
+    with _targets_lock:
+        targets = list(_targets.values())
+    now = time.monotonic()
+    return {
+        target.name: {
+            "interval_s": target.interval_s,
+            "next_poll_in_s": max(target.next_poll - now, 0),
+            "last_value": target.last_value,
+        }
+        for target in targets
+    }
+
+
+def restore_targets(snapshot: dict) -> None:
+    now = time.monotonic()
+    for name, values in snapshot.items():
+        target = get_target(name)
+        with target._lock:
+            target.interval_s = values["interval_s"]
+            target.next_poll = now + values["next_poll_in_s"]
+            target.last_value = values["last_value"]
+            target._woken = False
+
+
+def stats() -> list[dict]:
+    with _targets_lock:
+        targets = list(_targets.values())
+    return [target.stats() for target in targets]
@@ -0,0 +1,220 @@
+"""
+power_model.py
+
+Learned charging power per wallbox.
+
+The regulator used to assume that a car draws exactly
+ONE_PHASE_VOLTAGE × set current × number_of_phases_used. Many cars draw less
+than the set current (on-board charger limit, battery temperature, end of
+charge), the grid voltage is rarely exactly 230 V, and some cars switch
+between one and three phases mid-session. Every wallbox therefore gets a
+model of the current session:
+
+  charging power = min(watts_per_ma × set current, max_power_w)
+
+  * watts_per_ma – marginal power per mA of set current while the car follows
+                   the set current,
+  * phases       – the phase count that slope stands for (≈ 0.23 W/mA per
+                   phase),
+  * max_power_w  – the power the car does not go beyond however high the
+                   current is set (None: not observed).
+
+Both are learned from the response to current changes: two settled samples
+at set currents at least MIN_STEP_MA apart give the slope. A slope near zero
+means the car does not follow in that range: it limits its own draw, which
+becomes max_power_w; otherwise the slope is fitted (exponentially weighted)
+into watts_per_ma. Samples come from
+
+  * the wallbox's own meter (KEBA register 1020 / UDP report 3) while it is
+    charging and the current has not just been changed (the car ramps), and
+  * the change of the grid power after the regulator raised the current
+    (wallboxes without a meter). The household load is in it, so these count
+    less.
+
+The regulator converts between power and current through the model, so a
+target lands where the car actually draws on the first write, and decides
+on pausing by the minimum power on the phases the car actually uses. A model
+starts from the nominal estimate and is reset when the car is disconnected or
+the configured phase count changes.
+"""
+
+import threading
+import time
+from typing import Optional
+
+ONE_PHASE_VOLTAGE = 230            # V, nominal
+
+# weight of a new slope observation in the fit
+METER_STEP_WEIGHT = 0.5
+GRID_STEP_WEIGHT  = 0.25
+
+# meter samples are ignored this long after a current change (the car ramps)
+SETTLE_S = 8
+# only current changes at least this large give a slope
+MIN_STEP_MA = 1000
+# a slope below this (W per mA) means the car does not follow the set current;
+# one phase at 207 V (230 V - 10 %) is 0.207
+FOLLOW_MIN_WATTS_PER_MA = 0.1
+MAX_WATTS_PER_MA = 3 * 253 / 1000  # three phases at 253 V (230 V + 10 %)
+
+
+class PowerModel:
+    def __init__(self, wallbox_id: int, nominal_phases: int):
+        self.wallbox_id = wallbox_id
+        self._lock = threading.Lock()
+        self.reset(nominal_phases)
+
+    def reset(self, nominal_phases: int) -> None:
+        """Back to the nominal estimate (new session or phase setting)."""
+        with self._lock:
+            self.nominal_phases = nominal_phases
+            self.watts_per_ma = ONE_PHASE_VOLTAGE * nominal_phases / 1000
+            self.max_power_w: Optional[float] = None
+            self.meter_samples = 0
+            self.step_samples = 0
+            self.changed_at = 0.0
+            self._last_sample: Optional[tuple[int, float]] = None     # settled (set current, W)
+
+    @property
+    def phases(self) -> int:
+        """Phases the car draws on, from the slope."""
+        return min(max(round(self.watts_per_ma * 1000 / ONE_PHASE_VOLTAGE), 1), 3)
+
+    @property
+    def learned(self) -> bool:
+        return bool(self.meter_samples or self.step_samples)
+
+    def power_w(self, milliampere: float) -> float:
+        """Charging power (W) at this set current."""
+        watts = self.watts_per_ma * milliampere
+        return watts if self.max_power_w is None else min(watts, self.max_power_w)
+
+    def current_ma(self, watts: float) -> float:
+        """Set current (mA) at which the car draws this power (no upper bound for a capped car)."""
+        return watts / self.watts_per_ma
+
+    def note_current_change(self) -> None:
+        """The set current was just written; the next meter samples show the ramp."""
+        with self._lock:
+            self.changed_at = time.monotonic()
+
+    def observe_meter(self, set_current_ma: int, watts: Optional[float]) -> bool:
+        """Metered power of a charging car at its set current; False when the sample was not used."""
+        if watts is None or set_current_ma <= 0:
+            return False
+        with self._lock:
+            if time.monotonic() - self.changed_at < SETTLE_S:
+                return False
+            self.meter_samples += 1
+            if self.max_power_w is not None and watts > self.max_power_w * 1.1:
+                self.max_power_w = None              # the car takes more again (e.g. warmer battery)
+            previous, self._last_sample = self._last_sample, (set_current_ma, watts)
+            if previous is None or abs(set_current_ma - previous[0]) < MIN_STEP_MA:
+                return True
+            self._fit_step(set_current_ma - previous[0], watts - previous[1], max(watts, previous[1]), METER_STEP_WEIGHT)
+            return True
+
+    def observe_step(self, delta_ma: int, delta_w: float, power_w: Optional[float] = None) -> bool:
+        """
+        Grid response to a current change (positive delta_w: more power drawn).
+        power_w: estimated charging power after the change, for the power cap.
+        """
+        if abs(delta_ma) < MIN_STEP_MA:
+            return False
+        with self._lock:
+            # a wallbox meter is the better source
+            if self.meter_samples:
+                return False
+            self.step_samples += 1
+            self._fit_step(delta_ma, delta_w, power_w, GRID_STEP_WEIGHT)
+            return True
+
+    def _fit_step(self, delta_ma: int, delta_w: float, power_w: Optional[float], weight: float) -> None:
+        slope = delta_w / delta_ma
+        if slope < FOLLOW_MIN_WATTS_PER_MA:
+            # the car did not follow: it limits its own draw
+            if power_w is not None:
+                self.max_power_w = power_w
+            return
+        slope = min(slope, MAX_WATTS_PER_MA)
+        self.watts_per_ma += weight * (slope - self.watts_per_ma)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "nominal_phases": self.nominal_phases,
+                "watts_per_ma": self.watts_per_ma,
+                "max_power_w": self.max_power_w,
+                "meter_samples": self.meter_samples,
+                "step_samples": self.step_samples,
+            }
+
+    def restore(self, snapshot: dict) -> None:
+        with self._lock:
+            self.nominal_phases = snapshot["nominal_phases"]
+            self.watts_per_ma = snapshot["watts_per_ma"]
+            self.max_power_w = snapshot["max_power_w"]
+            self.meter_samples = snapshot["meter_samples"]
+            self.step_samples = snapshot["step_samples"]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "wallbox_id": self.wallbox_id,
+                "watts_per_ma": round(self.watts_per_ma, 4),
+                "phases": self.phases,
+                "max_power_w": round(self.max_power_w) if self.max_power_w is not None else None,
+                "nominal_phases": self.nominal_phases,
+                "meter_samples": self.meter_samples,
+                "step_samples": self.step_samples,
+            }
+
+
+_models: dict[int, PowerModel] = {}
+_models_lock = threading.Lock()
+
+
+def model(wallbox_id: int, nominal_phases: int) -> PowerModel:
+    """
+    Model of the wallbox's current session.
+    nominal_phases: number_of_phases_used of the wallbox state; a changed value resets the model.
+    """
+    with _models_lock:
+        power_model = _models.get(wallbox_id)
+        if power_model is None:
+            power_model = _models[wallbox_id] = PowerModel(wallbox_id, nominal_phases)
+            return power_model
+    if power_model.nominal_phases != nominal_phases:
+        power_model.reset(nominal_phases)
+    return power_model
+
+
+def for_state(wallbox_id: int, wb_state: dict) -> PowerModel:
+    return model(wallbox_id, wb_state["number_of_phases_used"])
+
+
+def observe_state(wallbox_id: int, wb_state: dict) -> None:
+    """A disconnected car ends the session."""
+    if wb_state["charging_state"] == 1:
+        power_model = for_state(wallbox_id, wb_state)
+        if power_model.learned:
+            power_model.reset(wb_state["number_of_phases_used"])
+
+
+def snapshot_models() -> dict:
+    """Models of the running sessions, for a process handover."""
+    with _models_lock:
+        models = list(_models.values())
+    return {power_model.wallbox_id: power_model.snapshot() for power_model in models}
+
+
+def restore_models(snapshot: dict) -> None:
+    """Models of a predecessor process (handover); JSON turned the wallbox ids into strings."""
+    for wallbox_id, values in snapshot.items():
+        model(int(wallbox_id), values["nominal_phases"]).restore(values)
+
+
+def stats() -> list[dict]:
+    with _models_lock:
+        models = list(_models.values())
+    return [power_model.stats() for power_model in models]
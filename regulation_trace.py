@@ -0,0 +1,143 @@
+"""
+regulation_trace.py
+
+Opt-in structured tracing of the solar regulation.
+
+Every regulate_all_wallboxes_solar pass becomes one trace: the input snapshot
+(grid, battery, SoC, excess), every per-wallbox decision, every Modbus call with
+its duration and every sleep. Finished traces go to a bounded in-memory buffer
+(GET /debug/traces) and to a rotating JSON-lines file.
+
+Tracing is off by default. Enable it with PV_BACKEND_TRACE=1 or at runtime via
+POST /debug/traces/enable. When disabled, every hook is a context-variable
+lookup and nothing else.
+"""
+
+import contextvars
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+from typing import Optional
+
+TRACE_FILE           = os.environ.get("PV_BACKEND_TRACE_FILE", "regulation_traces.jsonl")
+TRACE_FILE_MAX_BYTES = 5 * 1024 * 1024
+TRACE_FILE_BACKUPS   = 3
+TRACE_BUFFER_SIZE    = 200
+
+enabled = os.environ.get("PV_BACKEND_TRACE", "0") == "1"
+
+_current: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("regulation_trace", default=None)
+_buffer: deque = deque(maxlen=TRACE_BUFFER_SIZE)
+_buffer_lock = threading.Lock()
+_ids = itertools.count(1)
+
+# dedicated logger so traces do not end up in the application log
+_file_logger = logging.getLogger("regulation_trace.file")
+_file_logger.propagate = False
+_file_logger.setLevel(logging.INFO)
+
+
+def _ensure_file_handler() -> None:
+    if not _file_logger.handlers:
+        handler = RotatingFileHandler(TRACE_FILE, maxBytes=TRACE_FILE_MAX_BYTES, backupCount=TRACE_FILE_BACKUPS)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        _file_logger.addHandler(handler)
+
+
+def set_enabled(value: bool) -> None:
+    global enabled
+    enabled = value
+
+
+# ── Recording ──────────────────────────────────────────────────────────────────
+
+def start_cycle(name: str = "regulation") -> Optional[dict]:
+    """Begin a trace for the current task. Returns None when tracing is disabled."""
+    if not enabled:
+        return None
+    trace = {
+        "id":          next(_ids),
+        "name":        name,
+        "started_at":  time.time(),
+        "duration_ms": None,
+        "inputs":      None,
+        "events":      [],
+        "_t0":         time.perf_counter(),
+    }
+    trace["_token"] = _current.set(trace)
+    return trace
+
+
+def finish_cycle(trace: Optional[dict]) -> None:
+    if trace is None:
+        return
+    _current.reset(trace.pop("_token"))
+    trace["duration_ms"] = round((time.perf_counter() - trace.pop("_t0")) * 1000, 3)
+    with _buffer_lock:
+        _buffer.append(trace)
+    _ensure_file_handler()
+    _file_logger.info(json.dumps(trace, default=str))
+
+
+def _offset_ms(trace: dict) -> float:
+    return round((time.perf_counter() - trace["_t0"]) * 1000, 3)
+
+
+def record_inputs(**inputs) -> None:
+    """Store the input snapshot of the cycle (first call wins) and log it as an event."""
+    trace = _current.get()
+    if trace is None:
+        return
+    if trace["inputs"] is None:
+        trace["inputs"] = inputs
+    trace["events"].append({"type": "inputs", "t_ms": _offset_ms(trace), **inputs})
+
+
+def record(event_type: str, **fields) -> None:
+    trace = _current.get()
+    if trace is None:
+        return
+    trace["events"].append({"type": event_type, "t_ms": _offset_ms(trace), **fields})
+
+
+@contextmanager
+def span(event_type: str, **fields):
+    """Time the enclosed block, e.g. a device call."""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    event = {"type": event_type, "t_ms": _offset_ms(trace), **fields}
+    try:
+        yield
+    except Exception as e:
+        event["error"] = str(e)
+        raise
+    finally:
+        event["duration_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        trace["events"].append(event)
+
+
+# ── Queries ────────────────────────────────────────────────────────────────────
+
+def recent_traces(limit: int = 20, min_duration_ms: float = 0, wallbox: Optional[str] = None) -> list[dict]:
+    """Newest first. wallbox filters on traces that contain a decision for that wallbox name."""
+    with _buffer_lock:
+        traces = list(_buffer)
+    result = []
+    for trace in reversed(traces):
+        if trace["duration_ms"] < min_duration_ms:
+            continue
+        if wallbox is not None and not any(e.get("wallbox") == wallbox for e in trace["events"]):
+            continue
+        result.append(trace)
+        if len(result) >= limit:
+            break
+    return result
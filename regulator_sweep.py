@@ -0,0 +1,254 @@
+"""
+regulator_sweep.py
+
+Offline tuning of the solar regulator against recorded meter history
+(see meter_history.py).
+
+The regulation model (battery excess, excess power, target current, pause /
+max clamp, settle and cycle delays) is replayed for a whole grid of parameter
+combinations at once: every NumPy operation works on one value per
+combination, so the time series is walked only once per chunk. The
+combinations are split into one chunk per worker of a process pool: the
+per-timestep loop dominates, every further chunk walks the series again.
+
+Model assumptions
+─────────────────
+* One car on `--phases` phases, connected always or whenever the history
+  shows wallbox power (`--connected`), needing at most `--daily-demand-kwh`.
+* House load without EV = recorded grid power − recorded wallbox power.
+* The home battery behaves as recorded (its own controller is not simulated).
+
+Run with:
+  python regulator_sweep.py --start 2025-01-01 --end 2025-12-31 --workers 8
+"""
+
+import argparse
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+
+import numpy as np
+
+import meter_history
+import shared_state
+from solar_charging import (
+    HOME_BATTERY_MIN_CHARGING_W,
+    INTER_WALLBOX_INCREASE_DELAY_S,
+    MAX_CHARGING_CURRENT,
+    MIN_CHARGING_CURRENT,
+    ONE_PHASE_VOLTAGE,
+    POWER_DELTA,
+)
+
+# Parameters in the order of the combination columns
+PARAMETERS = ("power_delta", "increase_delay_s", "regulation_delay_s", "home_bat_min_soc", "battery_reserve_w")
+
+PARAMETER_GRID = {
+    "power_delta":        [0, 100, 200, 300, 500],
+    "increase_delay_s":   [0, 5, 10, 20],
+    "regulation_delay_s": [5, 10, 20, 30],
+    "home_bat_min_soc":   [30, 50, 80, 95],
+    "battery_reserve_w":  [0, 500, 1000, 2000],
+}
+
+# Gaps in the history longer than this are not integrated
+MAX_STEP_S = 60
+
+# Current changes smaller than this are not written (KEBA tolerance)
+WRITE_TOLERANCE_MA = 100
+
+RANKINGS = {
+    "grid_import":      ("ev_grid_kwh", False),
+    "self_consumption": ("self_consumption", True),
+    "writes":           ("writes", False),
+}
+
+_history: dict[str, np.ndarray] = {}
+
+
+# ── History preparation (runs once per worker process) ─────────────────────────
+
+def prepare_history(records: np.ndarray, connected: str) -> dict[str, np.ndarray]:
+    timestamps = records["timestamp"]
+    step_s = np.diff(timestamps, append=timestamps[-1] if len(timestamps) else 0)
+    step_s = np.where((step_s > 0) & (step_s <= MAX_STEP_S), step_s, 0)
+
+    # index of the local day each record belongs to
+    day_starts = []
+    if len(timestamps):
+        first = datetime.fromtimestamp(timestamps[0]).date()
+        last = datetime.fromtimestamp(timestamps[-1]).date()
+        day_starts = [
+            datetime.combine(date.fromordinal(ordinal), datetime.min.time()).timestamp()
+            for ordinal in range(first.toordinal(), last.toordinal() + 1)
+        ]
+    return {
+        "t":         timestamps,
+        "step_h":    step_s / 3600,
+        "day":       np.searchsorted(day_starts, timestamps, side="right"),
+        "base_grid": records["grid_w"] - records["wallbox_w"],
+        "pv":        records["pv_w"],
+        "battery":   records["battery_w"],
+        "soc":       records["battery_soc"],
+        "connected": records["wallbox_w"] > 0 if connected == "history" else np.ones(len(timestamps), dtype=bool),
+    }
+
+
+def _init_worker(history_dir: str, start: date, end: date, connected: str) -> None:
+    _history.update(prepare_history(meter_history.load_history(start, end, history_dir), connected))
+
+
+# ── Vectorized regulation model ────────────────────────────────────────────────
+
+def simulate(history: dict[str, np.ndarray], combos: np.ndarray, phases: int, daily_demand_wh: float) -> dict:
+    """Replay the history for every row of combos (columns as in PARAMETERS)."""
+    power_delta, increase_delay, regulation_delay, min_soc, reserve = combos.T.astype(float)
+    count = len(combos)
+    watts_per_ma = ONE_PHASE_VOLTAGE * phases / 1000
+
+    current      = np.zeros(count)          # mA
+    next_regulation = np.zeros(count)
+    demand_left  = np.full(count, daily_demand_wh)
+    writes       = np.zeros(count)
+    ev_wh        = np.zeros(count)
+    ev_grid_wh   = np.zeros(count)
+    import_wh    = np.zeros(count)
+    export_wh    = np.zeros(count)
+    day = None
+
+    t, step_h, days = history["t"], history["step_h"], history["day"]
+    base_grid, battery, soc, connected = history["base_grid"], history["battery"], history["soc"], history["connected"]
+
+    for k in range(len(t)):
+        if days[k] != day:
+            day = days[k]
+            demand_left[:] = daily_demand_wh
+        if not connected[k]:
+            current[:] = 0
+
+        ev_w = current * watts_per_ma
+        grid = base_grid[k] + ev_w
+        grid_import = np.maximum(grid, 0)
+        h = step_h[k]
+        ev_wh       += ev_w * h
+        demand_left -= ev_w * h
+        ev_grid_wh  += np.minimum(ev_w, grid_import) * h
+        import_wh   += grid_import * h
+        export_wh   += np.maximum(-grid, 0) * h
+
+        due = connected[k] & (t[k] >= next_regulation)
+        if not due.any():
+            continue
+
+        # solar_charging._calculate_battery_excess
+        if battery[k] < 0:
+            below_min = soc[k] < min_soc
+            battery_excess = np.where(below_min, np.maximum(-(battery[k] + reserve), 0), -battery[k])
+        else:
+            battery_excess = -battery[k]
+        excess = -grid + battery_excess - power_delta
+
+        # solar_charging._calculate_wallbox_target_current and _set_current clamps
+        target = np.floor(excess / phases / ONE_PHASE_VOLTAGE * 1000) + current
+        target = np.minimum(target, MAX_CHARGING_CURRENT)
+        target[(target < MIN_CHARGING_CURRENT) | (demand_left <= 0)] = 0
+
+        target = np.where(due, target, current)
+        changed = np.abs(target - current) >= WRITE_TOLERANCE_MA
+        increased = changed & (target > current)
+        writes += changed
+        next_regulation = np.where(
+            due, t[k] + regulation_delay + np.where(increased, increase_delay, 0), next_regulation
+        )
+        current = np.where(changed, target, current)
+
+    pv_kwh = float(np.sum(history["pv"] * step_h)) / 1000
+    return {
+        "ev_kwh":           ev_wh / 1000,
+        "ev_grid_kwh":      ev_grid_wh / 1000,
+        "grid_import_kwh":  import_wh / 1000,
+        "grid_export_kwh":  export_wh / 1000,
+        "self_consumption": 1 - export_wh / 1000 / pv_kwh if pv_kwh > 0 else np.zeros(count),
+        "writes":           writes,
+    }
+
+
+def _simulate_chunk(combos: np.ndarray, phases: int, daily_demand_wh: float) -> dict:
+    return simulate(_history, combos, phases, daily_demand_wh)
+
+
+# ── Driver ─────────────────────────────────────────────────────────────────────
+
+def parameter_combinations(grid: dict[str, list]) -> np.ndarray:
+    return np.array(list(itertools.product(*(grid[name] for name in PARAMETERS))), dtype=float)
+
+
+def current_settings() -> list[float]:
+    from rest_api import EV_CHARGING_REGULATION_DELAY
+    return [
+        POWER_DELTA,
+        INTER_WALLBOX_INCREASE_DELAY_S,
+        EV_CHARGING_REGULATION_DELAY,
+        shared_state.home_bat_min_soc,
+        HOME_BATTERY_MIN_CHARGING_W,
+    ]
+
+
+def run_sweep(args) -> tuple[np.ndarray, dict]:
+    combos = parameter_combinations(PARAMETER_GRID)
+    combos = np.unique(np.vstack([combos, current_settings()]), axis=0)
+    chunks = np.array_split(combos, max(min(args.workers, len(combos)), 1))
+
+    with ProcessPoolExecutor(
+        max_workers=args.workers,
+        initializer=_init_worker,
+        initargs=(args.history_dir, args.start, args.end, args.connected),
+    ) as pool:
+        results = list(pool.map(
+            _simulate_chunk, chunks, itertools.repeat(args.phases), itertools.repeat(args.daily_demand_kwh * 1000)
+        ))
+
+    metrics = {name: np.concatenate([r[name] for r in results]) for name in results[0]}
+    return combos, metrics
+
+
+def print_ranking(combos: np.ndarray, metrics: dict, rank_by: str, top: int) -> None:
+    key, descending = RANKINGS[rank_by]
+    order = np.lexsort((metrics["writes"], -metrics[key] if descending else metrics[key]))
+    reference = np.flatnonzero((combos == current_settings()).all(axis=1))
+
+    header = "".join(f"{name:>20}" for name in PARAMETERS) + "".join(f"{name:>18}" for name in metrics)
+    print(header)
+    for index in list(order[:top]) + [None] + list(reference):
+        if index is None:
+            print("-- current settings " + "-" * (len(header) - 20))
+            continue
+        print(
+            "".join(f"{value:>20.0f}" for value in combos[index])
+            + "".join(f"{metrics[name][index]:>18.3f}" for name in metrics)
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--history-dir", default=meter_history.HISTORY_DIR)
+    parser.add_argument("--start", type=date.fromisoformat, default=None)
+    parser.add_argument("--end", type=date.fromisoformat, default=None)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--phases", type=int, default=3, choices=(1, 2, 3))
+    parser.add_argument("--daily-demand-kwh", type=float, default=15)
+    parser.add_argument("--connected", choices=("always", "history"), default="always")
+    parser.add_argument("--rank-by", choices=sorted(RANKINGS), default="grid_import")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    combos, metrics = run_sweep(args)
+    print(f"Evaluated {len(combos)} combinations in {time.monotonic() - started:.1f}s\n")
+    print_ranking(combos, metrics, args.rank_by, args.top)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,40 +5,104 @@ FastAPI backend for solar EV charging management.
 
 Run with:
   uvicorn rest_api:app --host 0.0.0.0 --port 8000 [--reload]
+
+Zero-downtime restarts (the new process takes over sockets and state, see handover.py):
+  python handover.py --host 0.0.0.0 --port 8000
+
+Multi-worker deployment (one controller owns the hardware, see controller.py):
+  python controller.py
+  PV_BACKEND_ROLE=worker uvicorn rest_api:app --host 0.0.0.0 --port 8000 --workers 4
 """
 
 import asyncio
 import logging
+import os
 import socket
-import struct
+import time
 from contextlib import asynccontextmanager
+from typing import Optional
 
-from fastapi import FastAPI, HTTPException, Query
+import anyio.to_thread
+from fastapi import FastAPI, Header, HTTPException, Query
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 from starlette.middleware.cors import CORSMiddleware
 
+import charging_planner
+import command_jobs
+import energy_accounting
+import event_stream
+import handover
+import log_pipeline
+import loop_monitor
+import meter_history
+import modbus_discovery
+import modbus_gateway
+import modbus_pipeline
+import polling_policy
+import power_model
+import regulation_trace
 import shared_state
-from modbus_interaction import (
-    read_sma_modbus_data,
-    sma_devices,
-)
+import sites
+from controller_ipc import ControllerClient
+from energy_sources import source_polling
+from modbus_interaction import read_cache_stats, scheduler_stats
 from solar_charging import (
     regulate_all_wallboxes_solar,
     CHARGING_STATES,
     MAX_CHARGING_CURRENT,
     MIN_CHARGING_CURRENT
 )
-from wallbox.wallbox_config import WALLBOXES
+from sites import DEFAULT_SITE_ID, Site
+from wallbox import keba_udp
 from wallbox.wallbox_base import WallboxBase
 
 # ── Network config ─────────────────────────────────────────────────────────────
 UDP_IP   = "192.168.188.205"
 UDP_PORT = 9522
 
+# SMA energy meters multicast their datagrams to this group. When set, the
+# backend joins the group on UDP_INTERFACE_IP instead of binding to UDP_IP, and
+# any number of local processes can receive the same stream.
+# Leave empty for meters configured to send unicast to UDP_IP.
+UDP_MULTICAST_GROUP = os.environ.get("PV_BACKEND_EMETER_GROUP", "")    # e.g. "239.12.255.254"
+UDP_INTERFACE_IP    = os.environ.get("PV_BACKEND_EMETER_INTERFACE", UDP_IP)
+
+# Kernel receive buffer, large enough to hold bursts while the loop is busy
+UDP_RECEIVE_BUFFER_BYTES = 1024 * 1024
+UDP_DATAGRAM_MAX_BYTES   = 2048
+
+# Seconds between two source samples (poll due sources, aggregate) of a site
+SITE_SAMPLE_INTERVAL_S = 1
+
 # Seconds between full regulation cycles (increase path already has a per-wallbox
 # 10-second wait built in; this is the outer loop cadence)
 EV_CHARGING_REGULATION_DELAY = 10
 
+# Seconds between wallbox power readings for energy accounting, and between
+# saves of the energy rollups to disk
+ENERGY_WALLBOX_SAMPLE_INTERVAL_S = 10
+ENERGY_SAVE_INTERVAL_S           = 60
+
+# A set current counts as verified when the read-back is within this range
+# (Juice only supports whole Ampere)
+MAX_CURRENT_VERIFY_TOLERANCE_MA = 1000
+
+# How often API workers look for new controller events for the push stream
+WORKER_EVENT_POLL_INTERVAL_S = 0.5
+
+# Threads for sync endpoints (anyio default: 40); 0 keeps the default
+THREADPOOL_SIZE = int(os.environ.get("PV_BACKEND_THREADPOOL_SIZE", "0"))
+
+# ── Deployment role ────────────────────────────────────────────────────────────
+# standalone: this process runs the background tasks and serves the API (default)
+# controller: set by controller.py – background tasks run there, no HTTP
+# worker:     stateless API worker; reads the controller's shared-memory snapshot
+#             and forwards write requests to the controller's command queue
+BACKEND_ROLE = os.environ.get("PV_BACKEND_ROLE", "standalone")
+
+controller_client: Optional[ControllerClient] = None
+
 # ── CORS ───────────────────────────────────────────────────────────────────────
 ALLOWED_ORIGINS = [
     "http://localhost:4200",
@@ -46,10 +110,7 @@ ALLOWED_ORIGINS = [
     "http://192.168.188.205:4200",
 ]
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
-)
+log_pipeline.configure()
 logger = logging.getLogger(__name__)
 
 
@@ -57,11 +118,33 @@ logger = logging.getLogger(__name__)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    tasks = [
-        asyncio.create_task(data_collection(), name="data_collection"),
-        asyncio.create_task(ev_charging_regulation(), name="ev_regulation"),
-    ]
+    global controller_client
+    if THREADPOOL_SIZE:
+        anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    if BACKEND_ROLE == "worker":
+        controller_client = ControllerClient()
+        monitor = asyncio.create_task(loop_monitor.monitor_loop_lag(), name="loop_monitor")
+        yield
+        monitor.cancel()
+        controller_client.close()
+        return
+
+    await load_state()
+    tasks = start_background_tasks()
+    handover_tasks = []
+    if handover.enabled():
+        def restart_tasks():
+            tasks[:] = start_background_tasks()
+
+        handover_tasks.append(asyncio.create_task(
+            handover.serve(lambda: _stop_tasks(tasks), restart_tasks, _handover_sockets, handover_snapshot),
+            name="handover",
+        ))
     yield
+    await _stop_tasks(tasks + handover_tasks)
+
+
+async def _stop_tasks(tasks: list[asyncio.Task]) -> None:
     for task in tasks:
         task.cancel()
     for task in tasks:
@@ -71,37 +154,117 @@ async def lifespan(app: FastAPI):
             pass
 
 
+async def load_state() -> None:
+    """
+    Take over the state of a running instance, or load the stored one (once,
+    before start_background_tasks). The predecessor saves its files when it
+    stops, so they are read only after its snapshot arrived.
+    """
+    snapshot = await asyncio.to_thread(handover.take_snapshot)
+    charging_planner.load()
+    if snapshot is not None:
+        restore_handover_snapshot(snapshot)
+    else:
+        energy_accounting.load()
+
+
+def start_background_tasks() -> list[asyncio.Task]:
+    """Start the tasks owning the hardware (standalone process or controller)."""
+    tasks = [
+        asyncio.create_task(emeter_receiver(), name="emeter_receiver"),
+        asyncio.create_task(command_jobs.command_executor(), name="command_executor"),
+        asyncio.create_task(loop_monitor.monitor_loop_lag(), name="loop_monitor"),
+    ]
+    # one set of loops per site; starts are staggered so the sites' device
+    # I/O does not all fall on the same instant
+    for index, site in enumerate(sites.SITES.values()):
+        share = index / len(sites.SITES)
+        tasks += [
+            asyncio.create_task(
+                data_collection(site, share * SITE_SAMPLE_INTERVAL_S), name=f"data_collection_{site.site_id}"
+            ),
+            asyncio.create_task(
+                ev_charging_regulation(site, share * EV_CHARGING_REGULATION_DELAY), name=f"ev_regulation_{site.site_id}"
+            ),
+            asyncio.create_task(
+                energy_accounting_task(site, share * ENERGY_WALLBOX_SAMPLE_INTERVAL_S),
+                name=f"energy_accounting_{site.site_id}",
+            ),
+        ]
+    if modbus_gateway.GATEWAY_ENABLED:
+        tasks.append(asyncio.create_task(modbus_gateway.serve(), name="modbus_gateway"))
+    return tasks
+
+
 app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
-    allow_methods=["GET", "POST"],
+    allow_methods=["GET", "POST", "DELETE"],
     allow_headers=["*"],
 )
 
 
 # ── REST endpoints ─────────────────────────────────────────────────────────────
+# Routes without prefix act on the default site; the same handlers serve
+# /sites/{site_id}/... for every configured site (see sites.py).
+
+def _get_site(site_id: str) -> Site:
+    try:
+        return sites.get_site(site_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Site not found")
+
+
+def _site_wallbox_state(site: Site, wallbox_id: int) -> dict:
+    wb = site.state.wallbox_states.get(wallbox_id)
+    if not wb:
+        raise HTTPException(status_code=404, detail="Wallbox not found")
+    return wb
+
+
+@app.get("/sites")
+def get_sites():
+    """Configured sites with their thread, cycle and Modbus usage."""
+    if BACKEND_ROLE == "worker":
+        return _forward_to_controller("get_sites")
+    return sites.stats()
+
 
 @app.get("/solar-data")
-def get_power_data():
+@app.get("/sites/{site_id}/solar-data")
+def get_power_data(site_id: str = DEFAULT_SITE_ID):
+    if BACKEND_ROLE == "worker":
+        if site_id == DEFAULT_SITE_ID:
+            return _controller_snapshot()["power_data"]
+        return _forward_to_controller("get_power_data", site_id=site_id)
+
+    site = _get_site(site_id)
+    state = site.state
     data: dict = {}
 
-    data["tripower_power"]      = read_sma_modbus_data(**sma_devices["tripower_total_power"])
-    data["tripower_str1_power"] = read_sma_modbus_data(**sma_devices["tripower_str1_power"])
-    data["tripower_str2_power"] = read_sma_modbus_data(**sma_devices["tripower_str2_power"])
-    data["tripower_str3_power"] = read_sma_modbus_data(**sma_devices["tripower_str3_power"])
+    # aggregated once per sample by data_collection – no device I/O here
+    totals = site.totals
+    sources = totals.get("sources", [])
+    strings = [w for reading in sources for w in reading.get("string_powers_w", [])] + [0, 0, 0]
+    data["tripower_power"]      = totals.get("pv_w", 0) - totals.get("pv_meters_w", 0)
+    data["tripower_str1_power"] = strings[0]
+    data["tripower_str2_power"] = strings[1]
+    data["tripower_str3_power"] = strings[2]
+    data["pv_power"]            = totals.get("pv_w", 0)
+    data["sources"]             = sources
 
-    data["battery_power"] = shared_state.battery_power
-    data["battery_SoC"]   = shared_state.battery_SoC
-    data["grid_power"]    = round(shared_state.grid_power / 10)
-    data["emeter_power"]  = round(shared_state.emeter_power / 10)
+    data["battery_power"] = state.battery_power
+    data["battery_SoC"]   = state.battery_SoC
+    data["grid_power"]    = round(state.grid_power / 10)
+    data["emeter_power"]  = round(state.emeter_power / 10)
 
     data["wallboxes"] = [
         {
             "id":                    wb_id,
-            "name":                  WALLBOXES[wb_id].name,
+            "name":                  site.wallboxes[wb_id].name,
             "charging_state":        CHARGING_STATES.get(wb["charging_state"], "Unknown"),
             "maximum_current":       wb["maximum_current"],
             "solar_only_charging":   wb["solar_only_charging"],
@@ -109,8 +272,8 @@ def get_power_data():
             "priority":              wb["priority"],
             "paused":                wb["paused"],
         }
-        for wb_id, wb in shared_state.wallbox_states.items()
-        if wb_id in WALLBOXES
+        for wb_id, wb in state.wallbox_states.items()
+        if wb_id in site.wallboxes
     ]
 
     data["consumption"] = (
@@ -119,24 +282,30 @@ def get_power_data():
         + (data["grid_power"]    or 0)
         + (data["battery_power"] or 0)
     )
-    data["home_bat_min_soc"] = shared_state.home_bat_min_soc
+    data["home_bat_min_soc"] = state.home_bat_min_soc
 
     return data
 
 
 @app.post("/solar-only-charging")
+@app.post("/sites/{site_id}/solar-only-charging")
 def set_solar_only_charging(
     wallbox: int = Query(..., description="Wallbox ID"),
     enable: bool = Query(..., description="True = solar-only, False = instant charging"),
+    site_id: str = DEFAULT_SITE_ID,
 ):
-    wb = shared_state.wallbox_states.get(wallbox)
-    if not wb:
-        raise HTTPException(status_code=404, detail="Wallbox not found")
+    if BACKEND_ROLE == "worker":
+        return _forward_to_controller("set_solar_only_charging", wallbox=wallbox, enable=enable, site_id=site_id)
+
+    wb = _site_wallbox_state(_get_site(site_id), wallbox)
     wb["solar_only_charging"] = enable
+    polling_policy.wake(polling_policy.wallbox_target_name(wallbox))
     
     if not enable:
         # set current to max current
-        set_max_current(wallbox, MAX_CHARGING_CURRENT)
+        set_max_current(
+            wallbox, SetMaxCurrentRequest(value=MAX_CHARGING_CURRENT), asynchronous=False, site_id=site_id
+        )
     
     return {"success": True, "solar_only_charging": enable}
 
@@ -146,47 +315,71 @@ class HomeBatMinSocRequest(BaseModel):
 
 
 @app.post("/home-bat-min-soc")
-def set_home_bat_min_soc(payload: HomeBatMinSocRequest):
-    shared_state.home_bat_min_soc = payload.value
-    return {"home_bat_min_soc": shared_state.home_bat_min_soc}
+@app.post("/sites/{site_id}/home-bat-min-soc")
+def set_home_bat_min_soc(payload: HomeBatMinSocRequest, site_id: str = DEFAULT_SITE_ID):
+    if BACKEND_ROLE == "worker":
+        return _forward_to_controller("set_home_bat_min_soc", value=payload.value, site_id=site_id)
+
+    state = _get_site(site_id).state
+    state.home_bat_min_soc = payload.value
+    return {"home_bat_min_soc": state.home_bat_min_soc}
 
 
 @app.post("/wallbox/{wallbox_id}/number_of_phases_used")
+@app.post("/sites/{site_id}/wallbox/{wallbox_id}/number_of_phases_used")
 def set_number_of_phases_used(
     wallbox_id: int,
     number_of_phases_used: int = Query(..., description="1, 2, or 3 phases"),
+    site_id: str = DEFAULT_SITE_ID,
 ):
+    if BACKEND_ROLE == "worker":
+        return _forward_to_controller(
+            "set_number_of_phases_used",
+            wallbox_id=wallbox_id,
+            number_of_phases_used=number_of_phases_used,
+            site_id=site_id,
+        )
+
     if number_of_phases_used not in (1, 2, 3):
         raise HTTPException(status_code=400, detail="number_of_phases_used must be 1, 2, or 3")
-    wb = shared_state.wallbox_states.get(wallbox_id)
-    if not wb:
-        raise HTTPException(status_code=404, detail="Wallbox not found")
+    wb = _site_wallbox_state(_get_site(site_id), wallbox_id)
     wb["number_of_phases_used"] = number_of_phases_used
+    polling_policy.wake(polling_policy.wallbox_target_name(wallbox_id))
     return {"wallbox_id": wallbox_id, "number_of_phases_used": number_of_phases_used}
 
 
 @app.post("/wallbox/{wallbox_id}/increase_priority")
-def increase_priority(wallbox_id: int):
-    wb = shared_state.wallbox_states.get(wallbox_id)
+@app.post("/sites/{site_id}/wallbox/{wallbox_id}/increase_priority")
+def increase_priority(wallbox_id: int, site_id: str = DEFAULT_SITE_ID):
+    if BACKEND_ROLE == "worker":
+        return _forward_to_controller("increase_priority", wallbox_id=wallbox_id, site_id=site_id)
+
+    wallbox_states = _get_site(site_id).state.wallbox_states
+    wb = wallbox_states.get(wallbox_id)
     if not wb:
         raise HTTPException(status_code=404, detail="Wallbox not found")
     if wb["priority"] > 1:
         wb["priority"] -= 1
-        for oid, owb in shared_state.wallbox_states.items():
+        for oid, owb in wallbox_states.items():
             if oid != wallbox_id and owb["priority"] == wb["priority"]:
                 owb["priority"] += 1
     return {"wallbox_id": wallbox_id, "priority": wb["priority"]}
 
 
 @app.post("/wallbox/{wallbox_id}/decrease_priority")
-def decrease_priority(wallbox_id: int):
-    wb = shared_state.wallbox_states.get(wallbox_id)
+@app.post("/sites/{site_id}/wallbox/{wallbox_id}/decrease_priority")
+def decrease_priority(wallbox_id: int, site_id: str = DEFAULT_SITE_ID):
+    if BACKEND_ROLE == "worker":
+        return _forward_to_controller("decrease_priority", wallbox_id=wallbox_id, site_id=site_id)
+
+    wallbox_states = _get_site(site_id).state.wallbox_states
+    wb = wallbox_states.get(wallbox_id)
     if not wb:
         raise HTTPException(status_code=404, detail="Wallbox not found")
-    max_prio = len(shared_state.wallbox_states)
+    max_prio = len(wallbox_states)
     if wb["priority"] < max_prio:
         wb["priority"] += 1
-        for oid, owb in shared_state.wallbox_states.items():
+        for oid, owb in wallbox_states.items():
             if oid != wallbox_id and owb["priority"] == wb["priority"]:
                 owb["priority"] -= 1
     return {"wallbox_id": wallbox_id, "priority": wb["priority"]}
@@ -197,10 +390,36 @@ class SetMaxCurrentRequest(BaseModel):
 
 
 @app.post("/wallbox/{wallbox_id}/max_current")
-def set_max_current(wallbox_id: int, payload: SetMaxCurrentRequest):
-    wb = shared_state.wallbox_states.get(wallbox_id)
-    if not wb:
-        raise HTTPException(status_code=404, detail="Wallbox not found")
+@app.post("/sites/{site_id}/wallbox/{wallbox_id}/max_current")
+def set_max_current(
+    wallbox_id: int,
+    payload: SetMaxCurrentRequest,
+    asynchronous: bool = Query(False, description="Return 202 with a command ID instead of waiting for the device"),
+    site_id: str = DEFAULT_SITE_ID,
+):
+    if BACKEND_ROLE == "worker":
+        if asynchronous:
+            job = _forward_to_controller(
+                "submit_max_current", wallbox_id=wallbox_id, value=payload.value, site_id=site_id
+            )
+            return JSONResponse(status_code=202, content=job)
+        return _forward_to_controller("set_max_current", wallbox_id=wallbox_id, value=payload.value, site_id=site_id)
+
+    wallbox, wb = _max_current_target(wallbox_id, site_id)
+
+    if asynchronous:
+        return JSONResponse(status_code=202, content=_submit_max_current(wallbox_id, payload.value, site_id))
+
+    try:
+        return _apply_max_current(wallbox, wb, payload.value)
+    except Exception as e:
+        logger.error(f"Error setting max current: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def _max_current_target(wallbox_id: int, site_id: str = DEFAULT_SITE_ID) -> tuple[WallboxBase, dict]:
+    site = _get_site(site_id)
+    wb = _site_wallbox_state(site, wallbox_id)
 
     # Only allow for instant charging
     if wb.get("solar_only_charging", False):
@@ -209,34 +428,356 @@ def set_max_current(wallbox_id: int, payload: SetMaxCurrentRequest):
             detail="Cannot set max current while solar-only charging is enabled"
         )
 
-    wallbox: WallboxBase = WALLBOXES.get(wallbox_id)
+    wallbox: WallboxBase = site.wallboxes.get(wallbox_id)
     if wallbox is None:
         raise HTTPException(status_code=500, detail="Wallbox config missing")
+    return wallbox, wb
 
-    try:
-        if (payload.value < MIN_CHARGING_CURRENT):
+
+def _submit_max_current(wallbox_id: int, value: int, site_id: str = DEFAULT_SITE_ID) -> dict:
+    """Validate and enqueue a max-current change; returns the job."""
+    wallbox, wb = _max_current_target(wallbox_id, site_id)
+    return command_jobs.submit(
+        wallbox_id,
+        "set_max_current",
+        {"value": value},
+        apply=lambda: _apply_max_current(wallbox, wb, value),
+        verify=lambda: abs(wallbox.read_max_current() - value) < MAX_CURRENT_VERIFY_TOLERANCE_MA,
+    )
+
+
+def _apply_max_current(wallbox: WallboxBase, wb: dict, value: int) -> dict:
+    with wallbox.exclusive_access():
+        if (value < MIN_CHARGING_CURRENT):
             wallbox.pause_charging()
-        wallbox.write_max_current(payload.value)
+        wallbox.write_max_current(value)
 
-        # Update shared state (important so background loop keeps it)
-        wb["maximum_current"] = payload.value
+    # Update shared state (important so background loop keeps it)
+    wb["maximum_current"] = value
+    polling_policy.wake(polling_policy.wallbox_target_name(wallbox.wallbox_id))
 
-        return {
-            "wallbox_id": wallbox_id,
-            "maximum_current": payload.value,
-        }
+    return {
+        "wallbox_id": wallbox.wallbox_id,
+        "maximum_current": value,
+    }
+
+
+@app.get("/commands/{command_id}")
+def get_command_status(command_id: str):
+    if BACKEND_ROLE == "worker":
+        return _forward_to_controller("get_command_status", command_id=command_id)
+    job = command_jobs.get_job(command_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Command not found")
+    return job
+
+
+@app.get("/events")
+async def get_events(last_event_id: Optional[int] = Header(None)):
+    """Server-sent events push stream (command status updates)."""
+    if BACKEND_ROLE == "worker":
+        stream = _replay_controller_events(last_event_id or 0)
+    else:
+        stream = event_stream.subscribe(last_event_id or 0)
+    return StreamingResponse(stream, media_type="text/event-stream")
+
+
+async def _replay_controller_events(after_id: int):
+    """Worker role: relay the events the controller publishes in its snapshot."""
+    while True:
+        try:
+            snapshot = await asyncio.to_thread(controller_client.read_snapshot)
+        except RuntimeError:
+            # controller down or restarting: nothing new to relay
+            await asyncio.sleep(WORKER_EVENT_POLL_INTERVAL_S)
+            continue
+        for event in snapshot.get("events", []):
+            if event["id"] > after_id:
+                after_id = event["id"]
+                yield event_stream.format_sse(event)
+        await asyncio.sleep(WORKER_EVENT_POLL_INTERVAL_S)
+
+
+class ChargingPlanRequest(BaseModel):
+    target_energy_kwh: float = Field(..., gt=0, le=200, description="Energy the car needs by departure (kWh)")
+    departure: float = Field(..., description="Departure time (epoch s)")
+
+
+@app.post("/wallbox/{wallbox_id}/plan")
+def set_charging_plan(wallbox_id: int, payload: ChargingPlanRequest):
+    """
+    Charge target_energy_kwh by departure: solar-only regulation plus the
+    smallest grid top-up the PV forecast requires.
+    """
+    if BACKEND_ROLE == "worker":
+        return _forward_to_controller(
+            "set_charging_plan",
+            wallbox_id=wallbox_id,
+            target_energy_kwh=payload.target_energy_kwh,
+            departure=payload.departure,
+        )
+    if wallbox_id not in shared_state.wallbox_states:
+        raise HTTPException(status_code=404, detail="Wallbox not found")
+    if not shared_state.wallbox_states[wallbox_id].get("solar_only_charging", False):
+        # the plan's floor current is applied by the solar-only regulation only
+        raise HTTPException(
+            status_code=409,
+            detail="Charging plans require solar-only charging to be enabled"
+        )
+    if payload.departure <= time.time():
+        raise HTTPException(status_code=400, detail="departure must be in the future")
+    return charging_planner.set_plan(wallbox_id, payload.target_energy_kwh * 1000, payload.departure)
+
+
+@app.get("/wallbox/{wallbox_id}/plan")
+def get_charging_plan(wallbox_id: int):
+    if BACKEND_ROLE == "worker":
+        return _forward_to_controller("get_charging_plan", wallbox_id=wallbox_id)
+    plan = charging_planner.get_plan(wallbox_id)
+    if plan is None:
+        raise HTTPException(status_code=404, detail="No charging plan for this wallbox")
+    return plan
+
+
+@app.delete("/wallbox/{wallbox_id}/plan")
+def cancel_charging_plan(wallbox_id: int):
+    if BACKEND_ROLE == "worker":
+        return _forward_to_controller("cancel_charging_plan", wallbox_id=wallbox_id)
+    if not charging_planner.cancel_plan(wallbox_id):
+        raise HTTPException(status_code=404, detail="No charging plan for this wallbox")
+    return {"wallbox_id": wallbox_id, "cancelled": True}
+
+
+@app.get("/energy")
+def get_energy_totals(
+    start: Optional[float] = Query(None, description="Period start (epoch s), default: today 00:00"),
+    end: Optional[float] = Query(None, description="Period end (epoch s), default: now"),
+):
+    """Energy per channel (Wh) for a period, answered from the rollups."""
+    if BACKEND_ROLE == "worker":
+        return _forward_to_controller("get_energy_totals", start=start, end=end)
+    # nothing is recorded after now; a far-future end would walk empty days under the lock
+    end = min(end, time.time()) if end is not None else time.time()
+    start = start if start is not None else energy_accounting.local_day_start(end)
+    return {"start": start, "end": end, "energy_wh": energy_accounting.period_totals(start, end)}
+
+
+@app.get("/energy/rollups")
+def get_energy_rollups(
+    resolution: str = Query("hour", description="minute, hour or day"),
+    start: float = Query(0, description="First bucket start (epoch s)"),
+    end: Optional[float] = Query(None, description="Last bucket start, exclusive (epoch s)"),
+):
+    if BACKEND_ROLE == "worker":
+        return _forward_to_controller("get_energy_rollups", resolution=resolution, start=start, end=end)
+    if resolution not in ("minute", "hour", "day"):
+        raise HTTPException(status_code=400, detail="resolution must be minute, hour or day")
+    end = end if end is not None else time.time()
+    return energy_accounting.rollup_buckets(resolution, start, end)
+
+
+@app.get("/energy/sessions")
+def get_charging_sessions(wallbox: Optional[int] = Query(None, description="Wallbox ID")):
+    if BACKEND_ROLE == "worker":
+        return _forward_to_controller("get_charging_sessions", wallbox=wallbox)
+    return energy_accounting.sessions(wallbox)
+
+
+@app.get("/modbus/schedulers")
+def get_modbus_schedulers():
+    """Queue depth and request counters of the per-device Modbus schedulers."""
+    if BACKEND_ROLE == "worker":
+        return _controller_snapshot()["modbus_schedulers"]
+    return scheduler_stats()
+
+
+@app.get("/modbus/pipelines")
+def get_modbus_pipelines():
+    """In-flight window and request counters of the pipelined Modbus connections."""
+    if BACKEND_ROLE == "worker":
+        return _forward_to_controller("get_modbus_pipelines")
+    return modbus_pipeline.connection_stats()
+
+
+@app.get("/modbus/read_cache")
+def get_modbus_read_cache():
+    """Entries and hit/miss/shared counters of the Modbus read cache."""
+    if BACKEND_ROLE == "worker":
+        return _forward_to_controller("get_modbus_read_cache")
+    return read_cache_stats()
 
+
+@app.post("/discovery/scan")
+async def scan_for_wallboxes(
+    subnet: str = Query(modbus_discovery.DISCOVERY_SUBNET, description="e.g. 192.168.188.0/24"),
+    ports: list[int] = Query(list(modbus_discovery.DISCOVERY_PORTS), description="Modbus TCP ports to try"),
+):
+    """
+    Scan a subnet for wallboxes and propose config entries for the new ones.
+    Read-only probing, runs in the process that received the request.
+    """
+    try:
+        return await modbus_discovery.scan(subnet, ports)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/debug/traces")
+def get_regulation_traces(
+    limit: int = Query(20, ge=1, le=regulation_trace.TRACE_BUFFER_SIZE),
+    min_duration_ms: float = Query(0, description="Only cycles that took at least this long"),
+    wallbox: Optional[str] = Query(None, description="Only cycles with a decision for this wallbox name"),
+):
+    """Recent regulation traces, newest first."""
+    if BACKEND_ROLE == "worker":
+        return _forward_to_controller(
+            "get_regulation_traces", limit=limit, min_duration_ms=min_duration_ms, wallbox=wallbox
+        )
+    return {
+        "enabled": regulation_trace.enabled,
+        "traces": regulation_trace.recent_traces(limit, min_duration_ms, wallbox),
+    }
+
+
+@app.get("/polling")
+def get_polling_stats():
+    """Current polling interval and poll/skip counters per device."""
+    if BACKEND_ROLE == "worker":
+        return _forward_to_controller("get_polling_stats")
+    return polling_policy.stats()
+
+
+@app.get("/power_model")
+def get_power_models():
+    """Learned charging power per mA and effective phase count per wallbox (current sessions)."""
+    if BACKEND_ROLE == "worker":
+        return _forward_to_controller("get_power_models")
+    return power_model.stats()
+
+
+@app.get("/debug/keba_udp")
+def get_keba_udp_stats():
+    """KEBA UDP report transport: registered wallboxes, datagrams received, reports requested."""
+    if BACKEND_ROLE == "worker":
+        return _forward_to_controller("get_keba_udp_stats")
+    return keba_udp.get_transport().stats()
+
+
+@app.get("/debug/loop")
+def get_loop_stats():
+    """Event-loop lag percentiles and (debug mode) stacks of blocking calls."""
+    stats = {"lag": loop_monitor.lag_stats(), "blocking_calls": loop_monitor.blocking_reports()}
+    if BACKEND_ROLE == "worker":
+        stats["controller"] = _forward_to_controller("get_loop_stats")
+    return stats
+
+
+@app.get("/debug/threadpool")
+async def get_threadpool_stats():
+    """Usage of the threadpool that runs the sync endpoints (of this process)."""
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    return {
+        "total_tokens":    limiter.total_tokens,
+        "borrowed_tokens": limiter.borrowed_tokens,
+        "tasks_waiting":   limiter.statistics().tasks_waiting,
+    }
+
+
+@app.get("/debug/logging")
+def get_logging_stats():
+    """Log queue depth, records dropped on a full queue and rate-limited call sites."""
+    return log_pipeline.stats()
+
+
+@app.post("/debug/traces/enable")
+def set_regulation_tracing(enable: bool = Query(..., description="True = record regulation traces")):
+    if BACKEND_ROLE == "worker":
+        return _forward_to_controller("set_regulation_tracing", enable=enable)
+    regulation_trace.set_enabled(enable)
+    return {"enabled": regulation_trace.enabled}
+
+
+# ── Controller command forwarding (worker role) ────────────────────────────────
+
+# Commands the controller executes on behalf of API workers.
+# Parameters are plain JSON values so they can travel over the command queue.
+CONTROLLER_COMMANDS = {
+    "get_sites":                 lambda: get_sites(),
+    "get_power_data":            lambda site_id: get_power_data(site_id),
+    "set_solar_only_charging":   lambda wallbox, enable, site_id: set_solar_only_charging(wallbox, enable, site_id),
+    "set_home_bat_min_soc":      lambda value, site_id: set_home_bat_min_soc(
+        HomeBatMinSocRequest(value=value), site_id
+    ),
+    "set_number_of_phases_used": lambda wallbox_id, number_of_phases_used, site_id: set_number_of_phases_used(
+        wallbox_id, number_of_phases_used, site_id
+    ),
+    "increase_priority":         lambda wallbox_id, site_id: increase_priority(wallbox_id, site_id),
+    "decrease_priority":         lambda wallbox_id, site_id: decrease_priority(wallbox_id, site_id),
+    "set_max_current":           lambda wallbox_id, value, site_id: set_max_current(
+        wallbox_id, SetMaxCurrentRequest(value=value), asynchronous=False, site_id=site_id
+    ),
+    "submit_max_current":        lambda wallbox_id, value, site_id: _submit_max_current(wallbox_id, value, site_id),
+    "get_command_status":        lambda command_id: get_command_status(command_id),
+    "set_charging_plan":         lambda wallbox_id, target_energy_kwh, departure: set_charging_plan(
+        wallbox_id, ChargingPlanRequest(target_energy_kwh=target_energy_kwh, departure=departure)
+    ),
+    "get_charging_plan":         lambda wallbox_id: get_charging_plan(wallbox_id),
+    "cancel_charging_plan":      lambda wallbox_id: cancel_charging_plan(wallbox_id),
+    "get_energy_totals":         lambda start, end: get_energy_totals(start, end),
+    "get_energy_rollups":        lambda resolution, start, end: get_energy_rollups(resolution, start, end),
+    "get_charging_sessions":     lambda wallbox: get_charging_sessions(wallbox),
+    "get_regulation_traces":     lambda limit, min_duration_ms, wallbox: get_regulation_traces(
+        limit, min_duration_ms, wallbox
+    ),
+    "set_regulation_tracing":    lambda enable: set_regulation_tracing(enable),
+    "get_loop_stats":            lambda: get_loop_stats(),
+    "get_polling_stats":         lambda: get_polling_stats(),
+    "get_power_models":          lambda: get_power_models(),
+    "get_keba_udp_stats":        lambda: get_keba_udp_stats(),
+    "get_modbus_pipelines":      lambda: get_modbus_pipelines(),
+    "get_modbus_read_cache":     lambda: get_modbus_read_cache(),
+}
+
+
+def _controller_snapshot() -> dict:
+    try:
+        return controller_client.read_snapshot()
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+def _forward_to_controller(command: str, **params):
+    try:
+        reply = controller_client.send_command(command, params)
+    except TimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    if reply["status_code"] != 200:
+        raise HTTPException(status_code=reply["status_code"], detail=reply["detail"])
+    return reply["result"]
+
+
+def execute_controller_command(command: str, params: dict) -> dict:
+    """Run a forwarded command in the controller and build the reply for the worker."""
+    handler = CONTROLLER_COMMANDS.get(command)
+    if handler is None:
+        return {"status_code": 400, "detail": f"Unknown command {command}", "result": None}
+    try:
+        return {"status_code": 200, "detail": None, "result": handler(**params)}
+    except HTTPException as e:
+        return {"status_code": e.status_code, "detail": e.detail, "result": None}
     except Exception as e:
-        logger.error(f"Error setting max current: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.error(f"Error executing controller command {command}: {e}")
+        return {"status_code": 500, "detail": str(e), "result": None}
+
 
 # ── Background tasks ───────────────────────────────────────────────────────────
 
-async def data_collection():
+async def emeter_receiver():
     """
-    background task to get get grid, emeter, battery power and battery soc data and write it to the shared state
+    background task to receive the SMA meter datagrams of all sites and hand them to their sources
     """
-    logger.info("✅ Data collection task started")
+    global _emeter_socket
+    logger.info("✅ Meter receiver task started")
     loop = asyncio.get_running_loop()
     sock = None
 
@@ -244,10 +785,7 @@ async def data_collection():
         try:
             if sock is None:
                 try:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                    sock.setblocking(False)
-                    sock.bind((UDP_IP, UDP_PORT))
-                    logger.info(f"✅ UDP server on {UDP_IP}:{UDP_PORT}")
+                    sock = _emeter_socket = _open_emeter_socket()
                 except OSError as e:
                     logger.error(f"⚠️ UDP bind failed: {e} – retrying in 10 s")
                     if sock:
@@ -257,67 +795,279 @@ async def data_collection():
                     continue
 
             await _get_grid_and_emeter_power(loop, sock)
-            _get_battery_power_and_soc()
 
         except asyncio.CancelledError:
-            logger.warning("🛑 Data collection cancelled")
+            logger.warning("🛑 Meter receiver cancelled")
             if sock:
                 sock.close()
+            _emeter_socket = None
+            raise
+        except Exception as e:
+            logger.error(f"⚠️ Meter receiver error: {e}")
+            await asyncio.sleep(1)
+
+
+async def data_collection(site: Site, start_delay: float = 0):
+    """
+    background task to poll the energy sources of a site and write the totals to its state
+    (grid, emeter, battery power and battery soc; shared_state for the default site)
+    """
+    logger.info(f"✅ Data collection task started ({site.name})")
+    await asyncio.sleep(start_delay)
+
+    while True:
+        try:
+            started = time.perf_counter()
+
+            # inverters and batteries that are due, all in parallel
+            due = source_polling.due_sources(site.sources)
+            if due:
+                await site.run(source_polling.poll, due, site.poll_executor)
+            site.totals = source_polling.aggregate(site.sources, site.state)
+            polling_policy.notify_meter(site.state.grid_power / 10, site.site_id, site.poll_target_names())
+
+            # energy rollups and the meter history cover the default site
+            if site.is_default:
+                energy_accounting.record_meter_sample()
+                meter_history.record_sample()
+
+            site.record_cycle("sample", time.perf_counter() - started)
+            await asyncio.sleep(SITE_SAMPLE_INTERVAL_S)
+
+        except asyncio.CancelledError:
+            logger.warning(f"🛑 Data collection cancelled ({site.name})")
             raise
         except Exception as e:
-            logger.error(f"⚠️ Data collection error: {e}")
+            logger.error(f"⚠️ Data collection error ({site.name}): {e}")
             await asyncio.sleep(1)
 
 
-async def ev_charging_regulation():
+async def ev_charging_regulation(site: Site, start_delay: float = 0):
     """
-    background task to 
+    background task to regulate the solar-only wallboxes of a site
     """
-    logger.info("✅ EV charging regulation task started")
+    logger.info(f"✅ EV charging regulation task started ({site.name})")
+    await asyncio.sleep(start_delay)
     while True:
         try:
             # ── Solar-only wallboxes ───────────────────────────────────
-            await regulate_all_wallboxes_solar(WALLBOXES, shared_state.wallbox_states)
+            started = time.perf_counter()
+            await regulate_all_wallboxes_solar(site.wallboxes, site.state.wallbox_states, site.state, site.executor)
+            site.record_cycle("regulation", time.perf_counter() - started)
 
             await asyncio.sleep(EV_CHARGING_REGULATION_DELAY)
 
         except asyncio.CancelledError:
-            logger.warning("🛑 EV charging regulation cancelled")
+            logger.warning(f"🛑 EV charging regulation cancelled ({site.name})")
+            raise
+        except Exception as e:
+            logger.error(f"⚠️ EV charging regulation error ({site.name}): {e}")
+            await asyncio.sleep(1)
+
+
+async def energy_accounting_task(site: Site, start_delay: float = 0):
+    """
+    background task to sample the wallboxes of a site; for the default site the
+    wallbox power is integrated into the energy rollups, which are saved periodically
+    """
+    logger.info(f"✅ Energy accounting task started ({site.name})")
+    await asyncio.sleep(start_delay)
+    last_save = time.monotonic()
+    while True:
+        try:
+            samples = await site.run(_read_wallbox_power, site)
+            if site.is_default:
+                energy_accounting.record_wallbox_samples(samples)
+                meter_history.set_wallbox_power(sum(watts for watts, _ in samples.values()))
+
+                if time.monotonic() - last_save >= ENERGY_SAVE_INTERVAL_S:
+                    await asyncio.to_thread(energy_accounting.save)
+                    last_save = time.monotonic()
+
+            await asyncio.sleep(ENERGY_WALLBOX_SAMPLE_INTERVAL_S)
+
+        except asyncio.CancelledError:
+            logger.warning(f"🛑 Energy accounting cancelled ({site.name})")
+            if site.is_default:
+                energy_accounting.save()
             raise
         except Exception as e:
-            logger.error(f"⚠️ EV charging regulation error: {e}")
+            logger.error(f"⚠️ Energy accounting error ({site.name}): {e}")
             await asyncio.sleep(1)
 
 
+def _read_wallbox_power(site: Site) -> dict[int, tuple[float, int]]:
+    """
+    Read charging state and power of every wallbox of the site that is due for
+    polling; the others keep their last reading.
+    Wallboxes without a meter are estimated from the set current while charging
+    (through their power model); metered readings train the model.
+    """
+    samples = {}
+    for wb_id, wallbox in site.wallboxes.items():
+        wb_state = site.state.wallbox_states[wb_id]
+        poll = polling_policy.wallbox(wb_id)
+        if poll.due():
+            wb_state["charging_state"] = wallbox.read_charging_state()
+            _metered_wallbox_power[wb_id] = wallbox.read_active_power_w()
+            power_model.observe_state(wb_id, wb_state)
+            if wb_state["charging_state"] == 3:
+                power_model.for_state(wb_id, wb_state).observe_meter(
+                    wb_state["maximum_current"], _metered_wallbox_power[wb_id]
+                )
+            poll.record(
+                polling_policy.wallbox_poll_value(wb_state),
+                active=wb_state["charging_state"] in (3, 4),
+                disconnected=wb_state["charging_state"] == 1,
+            )
+
+        charging_state = wb_state["charging_state"]
+        watts = _metered_wallbox_power.get(wb_id)
+        if watts is None:
+            watts = (
+                power_model.for_state(wb_id, wb_state).power_w(wb_state["maximum_current"])
+                if charging_state == 3 else 0
+            )
+        samples[wb_id] = (watts, charging_state)
+    return samples
+
+
+# last metered power per wallbox id (None = wallbox has no meter)
+_metered_wallbox_power: dict[int, Optional[float]] = {}
+
+# socket of the meter receiver, passed on at a handover
+_emeter_socket: Optional[socket.socket] = None
+
+
+def _open_emeter_socket() -> socket.socket:
+    """
+    Open the non-blocking UDP socket for the SMA meter stream (unicast bind or
+    multicast membership). In multicast mode port reuse lets other local
+    consumers join too.
+    A socket handed over by the previous process is used as it is.
+    """
+    inherited = handover.take_socket("udp")
+    if inherited is not None:
+        inherited.setblocking(False)
+        logger.info(f"✅ UDP socket on port {UDP_PORT} taken over")
+        return inherited
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # multicast only: unicast datagrams are load-balanced over the sockets
+        # sharing a port, a second consumer would take part of the meter stream
+        if UDP_MULTICAST_GROUP and hasattr(socket, "SO_REUSEPORT"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RECEIVE_BUFFER_BYTES)
+        granted = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        if granted < UDP_RECEIVE_BUFFER_BYTES:
+            logger.warning(
+                f"⚠️ UDP receive buffer limited to {granted} bytes by the OS "
+                f"(requested {UDP_RECEIVE_BUFFER_BYTES}, see net.core.rmem_max)"
+            )
+        sock.setblocking(False)
+
+        if UDP_MULTICAST_GROUP:
+            sock.bind(("", UDP_PORT))
+            membership = socket.inet_aton(UDP_MULTICAST_GROUP) + socket.inet_aton(UDP_INTERFACE_IP)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            logger.info(f"✅ UDP multicast {UDP_MULTICAST_GROUP}:{UDP_PORT} joined on {UDP_INTERFACE_IP}")
+        else:
+            sock.bind((UDP_IP, UDP_PORT))
+            logger.info(f"✅ UDP server on {UDP_IP}:{UDP_PORT}")
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
 async def _get_grid_and_emeter_power(loop, sock):
     try:
-        data, addr = await asyncio.wait_for(loop.sock_recvfrom(sock, 1024), timeout=1)
+        data, addr = await asyncio.wait_for(loop.sock_recvfrom(sock, UDP_DATAGRAM_MAX_BYTES), timeout=1)
     except asyncio.TimeoutError:
         return
     except OSError as e:
         logger.warning(f"⚠️ UDP socket error: {e}")
         return
 
-    try:
-        if data[:3] != b"SMA":
+    _parse_emeter_datagram(data, addr)
+
+    # Drain everything else that queued up meanwhile (bursts from the meters
+    # of several sites), so the kernel buffer never fills
+    while True:
+        try:
+            data, addr = sock.recvfrom(UDP_DATAGRAM_MAX_BYTES)
+        except (BlockingIOError, InterruptedError):
             return
+        except OSError as e:
+            logger.warning(f"⚠️ UDP socket error: {e}")
+            return
+        _parse_emeter_datagram(data, addr)
+
+
+def _parse_emeter_datagram(data: bytes, addr) -> None:
+    try:
         ip, _ = addr
-        if ip == "192.168.188.54":       # Grid meter
-            feed_in = struct.unpack(">I", data[52:56])[0]
-            shared_state.grid_power = (
-                struct.unpack(">I", data[32:36])[0] if feed_in == 0 else -feed_in
-            )
-        elif ip == "192.168.188.87":     # Energy meter / PV
-            shared_state.emeter_power = struct.unpack(">I", data[52:56])[0]
+        sites.handle_datagram(data, ip)
     except Exception as e:
         logger.error(f"⚠️ UDP parse error: {e}")
 
 
-def _get_battery_power_and_soc():
-    try:
-        bp  = read_sma_modbus_data(**sma_devices["battery_power"])
-        soc = read_sma_modbus_data(**sma_devices["battery_SoC"])
-        if bp  is not None: shared_state.battery_power = bp
-        if soc is not None: shared_state.battery_SoC   = soc
-    except Exception as e:
-        logger.warning(f"⚠️ Battery Modbus error: {e}")
+# ── Handover (zero-downtime restart, see handover.py) ──────────────────────────
+
+_HANDOVER_STATE_FIELDS = ("grid_power", "emeter_power", "battery_power", "battery_SoC", "pv_power", "home_bat_min_soc")
+
+
+def _handover_sockets() -> dict[str, socket.socket]:
+    return {"udp": _emeter_socket} if _emeter_socket is not None else {}
+
+
+def handover_snapshot() -> dict:
+    """In-memory state for the next process (JSON; taken after the control tasks stopped)."""
+    return {
+        "sites": {
+            site.site_id: {
+                "state": {field: getattr(site.state, field) for field in _HANDOVER_STATE_FIELDS},
+                "wallbox_states": site.state.wallbox_states,
+                "wallboxes": {wb_id: wallbox.handover_state() for wb_id, wallbox in site.wallboxes.items()},
+                "totals": site.totals,
+            }
+            for site in sites.SITES.values()
+        },
+        "metered_wallbox_power": _metered_wallbox_power,
+        "energy": energy_accounting.snapshot_state(),
+        "source_readings": source_polling.snapshot_readings(),
+        "poll_targets": polling_policy.snapshot_targets(),
+        "power_models": power_model.snapshot_models(),
+        "charging_plans": charging_planner.snapshot_plans(),
+    }
+
+
+def restore_handover_snapshot(snapshot: dict) -> None:
+    """Continue with the state of the previous process; JSON turned the wallbox ids into strings."""
+    for site_id, site_snapshot in snapshot["sites"].items():
+        site = sites.SITES.get(site_id)
+        if site is None:
+            logger.warning(f"⚠️ Handover: site {site_id} is not configured any more – skipped")
+            continue
+        for field, value in site_snapshot["state"].items():
+            setattr(site.state, field, value)
+        for wb_id, wb_state in site_snapshot["wallbox_states"].items():
+            if int(wb_id) in site.state.wallbox_states:
+                site.state.wallbox_states[int(wb_id)].update(wb_state)
+        for wb_id, wallbox_state in site_snapshot["wallboxes"].items():
+            if int(wb_id) in site.wallboxes:
+                site.wallboxes[int(wb_id)].restore_handover_state(wallbox_state)
+        site.totals = site_snapshot["totals"]
+
+    _metered_wallbox_power.update(
+        {int(wb_id): watts for wb_id, watts in snapshot["metered_wallbox_power"].items()}
+    )
+    # before the plans: a plan counts the energy of the open session
+    energy_accounting.restore_state(snapshot["energy"])
+    source_polling.restore_readings(snapshot["source_readings"])
+    polling_policy.restore_targets(snapshot["poll_targets"])
+    power_model.restore_models(snapshot.get("power_models", {}))
+    charging_planner.restore_plans(snapshot["charging_plans"])
+    logger.info(f"✅ Restored the state of {len(snapshot['sites'])} sites from the previous process")
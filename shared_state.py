@@ -3,6 +3,10 @@ shared_state.py
 
 Global variables updated by the background data-collection task and
 read by the solar charging regulator and REST API.
+
+The module globals are the state of the default site. Further sites (see
+sites.py) each get a SiteState with the same attributes; code that serves
+any site takes the state as a parameter and defaults to this module.
 """
 
 # ── Energy meters ──────────────────────────────────────────────────────────────
@@ -10,6 +14,7 @@ grid_power    = 0   # W; negative = feed-in to grid, positive = consumption from
 emeter_power  = 0   # W; positive = PV production
 battery_power = 0   # W; negative = charging battery, positive = discharging
 battery_SoC   = 0   # %, integer
+pv_power      = 0   # W; total production of all PV sources (see energy_sources)
 
 # ── Home battery control ───────────────────────────────────────────────────────
 # SoC the home battery must reach before its charging power is counted as
@@ -43,4 +48,29 @@ wallbox_states: dict[int, dict] = {
         "solar_only_charging": False,
         "paused": False,
     },
-}
\ No newline at end of file
+}
+
+# ── Further sites ──────────────────────────────────────────────────────────────
+
+class SiteState:
+    """State of one additional site; same attributes and units as the module globals above."""
+
+    def __init__(self, wallbox_states: dict[int, dict], home_bat_min_soc: int = 80):
+        self.grid_power    = 0
+        self.emeter_power  = 0
+        self.battery_power = 0
+        self.battery_SoC   = 0
+        self.pv_power      = 0
+        self.home_bat_min_soc = home_bat_min_soc
+        self.wallbox_states = wallbox_states
+
+
+def initial_wallbox_state(number_of_phases_used: int, priority: int) -> dict:
+    return {
+        "number_of_phases_used": number_of_phases_used,
+        "priority": priority,
+        "charging_state": 0,
+        "maximum_current": 16000,
+        "solar_only_charging": False,
+        "paused": False,
+    }
@@ -0,0 +1,238 @@
+"""
+sites.py
+
+Several sites – homes with their own meters, inverters, batteries and
+wallboxes – served by one backend process.
+
+The default site is the installation of source_config / wallbox_config with
+its state in shared_state; the API routes without /sites/{site_id} prefix act
+on it. Further sites are read from the JSON file named by
+PV_BACKEND_SITES_CONFIG, a list of entries like
+  {"id": "lake", "name": "Lake house", "home_bat_min_soc": 60,
+   "sources":   [{"id": "lake_grid", "type": "sma_emeter", "name": "Grid meter",
+                  "kind": "grid", "ip": "10.0.2.54"}, ...],
+   "wallboxes": [{"id": 3, "type": "keba", "name": "Carport", "number_of_phases": 3,
+                  "ip": "10.0.2.20", "modbus_port": 502}]}
+Source and wallbox ids must be unique over all sites: polling targets,
+commands, charging plans and energy sessions are keyed by them.
+
+Meter datagrams of all sites arrive on the one UDP socket and are assigned
+by sender IP. Everything else runs per site: every site has its own
+background tasks (data collection, regulation, wallbox sampling) and its own
+thread pools for device I/O, so a slow or unreachable device only delays its
+own site. The pools count the thread time every site consumes (GET /sites).
+"""
+
+import asyncio
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import polling_policy
+import shared_state
+from energy_sources import source_polling
+from energy_sources.source_base import EnergySourceBase
+from energy_sources.source_config import ENERGY_SOURCES, build_sources
+from modbus_interaction import scheduler_stats
+from wallbox.wallbox_base import WallboxBase
+from wallbox.wallbox_config import WALLBOXES, build_wallboxes
+
+SITES_CONFIG_PATH = os.environ.get("PV_BACKEND_SITES_CONFIG", "")
+
+DEFAULT_SITE_ID   = "home"
+DEFAULT_SITE_NAME = "Home"
+
+# Threads per site for blocking control work: source polling round,
+# regulation steps and wallbox sampling may all be busy at the same time
+SITE_WORKER_THREADS = 3
+
+logger = logging.getLogger(__name__)
+
+
+class SiteExecutor(ThreadPoolExecutor):
+    """Thread pool of one site that accounts the time its jobs take."""
+
+    def __init__(self, max_workers: int, thread_name_prefix: str):
+        super().__init__(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._usage_lock = threading.Lock()
+        self.jobs = 0
+        self.pending = 0
+        self.busy_s = 0.0
+        self.cpu_s = 0.0
+        self.queue_wait_s = 0.0
+        self.max_queue_wait_s = 0.0
+
+    def submit(self, fn, /, *args, **kwargs):
+        submitted = time.perf_counter()
+        with self._usage_lock:
+            self.pending += 1
+
+        def job():
+            started, cpu_started = time.perf_counter(), time.thread_time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._usage_lock:
+                    self.pending -= 1
+                    self.jobs += 1
+                    self.busy_s += time.perf_counter() - started
+                    self.cpu_s += time.thread_time() - cpu_started
+                    self.queue_wait_s += started - submitted
+                    self.max_queue_wait_s = max(self.max_queue_wait_s, started - submitted)
+
+        return super().submit(job)
+
+    def stats(self) -> dict:
+        with self._usage_lock:
+            return {
+                "threads": self._max_workers,
+                "jobs": self.jobs,
+                "pending": self.pending,
+                "busy_s": round(self.busy_s, 3),
+                "cpu_s": round(self.cpu_s, 3),
+                "avg_queue_wait_ms": round(self.queue_wait_s / self.jobs * 1000, 1) if self.jobs else 0.0,
+                "max_queue_wait_ms": round(self.max_queue_wait_s * 1000, 1),
+            }
+
+
+class Site:
+    def __init__(
+        self,
+        site_id: str,
+        name: str,
+        sources: dict[str, EnergySourceBase],
+        wallboxes: dict[int, WallboxBase],
+        state,
+    ):
+        self.site_id = site_id
+        self.name = name
+        self.sources = sources
+        self.wallboxes = wallboxes
+        self.state = state              # shared_state module for the default site, else a SiteState
+        self.push_sources = source_polling.push_sources(sources)
+        self.totals: dict = {}
+
+        polled = sum(1 for source in sources.values() if source.polled)
+        self.executor = SiteExecutor(SITE_WORKER_THREADS, f"site_{site_id}")
+        self.poll_executor = SiteExecutor(
+            min(max(polled, 1), source_polling.SOURCE_POLL_WORKERS), f"site_{site_id}_poll"
+        )
+
+        self._cycles_lock = threading.Lock()
+        self.cycles = {
+            "sample":     {"count": 0, "last_ms": None, "max_ms": 0.0},
+            "regulation": {"count": 0, "last_ms": None, "max_ms": 0.0},
+        }
+
+    @property
+    def is_default(self) -> bool:
+        return self.site_id == DEFAULT_SITE_ID
+
+    def poll_target_names(self) -> list[str]:
+        return (
+            [polling_policy.source_target_name(source_id) for source_id in self.sources]
+            + [polling_policy.wallbox_target_name(wallbox_id) for wallbox_id in self.wallboxes]
+        )
+
+    def device_ips(self) -> set[str]:
+        return {
+            device.ip for device in [*self.sources.values(), *self.wallboxes.values()] if hasattr(device, "ip")
+        }
+
+    async def run(self, fn, *args):
+        """Run a blocking call in this site's threads."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(fn, *args))
+
+    def record_cycle(self, kind: str, seconds: float) -> None:
+        with self._cycles_lock:
+            cycle = self.cycles[kind]
+            cycle["count"] += 1
+            cycle["last_ms"] = round(seconds * 1000, 1)
+            cycle["max_ms"] = max(cycle["max_ms"], cycle["last_ms"])
+
+    def stats(self) -> dict:
+        ips = self.device_ips()
+        schedulers = [scheduler for scheduler in scheduler_stats() if scheduler["ip"] in ips]
+        with self._cycles_lock:
+            cycles = {kind: dict(cycle) for kind, cycle in self.cycles.items()}
+        return {
+            "id": self.site_id,
+            "name": self.name,
+            "default": self.is_default,
+            "sources": len(self.sources),
+            "wallboxes": len(self.wallboxes),
+            "threads": {"control": self.executor.stats(), "source_polling": self.poll_executor.stats()},
+            "cycles": cycles,
+            "modbus": {
+                "devices": len(schedulers),
+                "requests": sum(scheduler["requests"] for scheduler in schedulers),
+                "queue_depth": sum(scheduler["queue_depth"] for scheduler in schedulers),
+            },
+        }
+
+
+# ── Registry ───────────────────────────────────────────────────────────────────
+
+def build_site(entry: dict) -> Site:
+    wallboxes = build_wallboxes(entry.get("wallboxes", []))
+    wallbox_states = {
+        wallbox_id: shared_state.initial_wallbox_state(wallbox.number_of_phases, priority)
+        for priority, (wallbox_id, wallbox) in enumerate(wallboxes.items(), start=1)
+    }
+    state = shared_state.SiteState(wallbox_states, entry.get("home_bat_min_soc", 80))
+    return Site(entry["id"], entry.get("name", entry["id"]), build_sources(entry.get("sources", [])), wallboxes, state)
+
+
+def bind_poll_targets(site: Site) -> None:
+    """Judge the idle time of the site's poll targets by its state; only for a validated site."""
+    for name in site.poll_target_names():
+        polling_policy.bind_state(name, site.state)
+
+
+def load_sites(path: str = SITES_CONFIG_PATH) -> dict[str, Site]:
+    sites = {DEFAULT_SITE_ID: Site(DEFAULT_SITE_ID, DEFAULT_SITE_NAME, ENERGY_SOURCES, WALLBOXES, shared_state)}
+    if not path:
+        return sites
+    with open(path) as f:
+        entries = json.load(f)
+
+    source_ids, wallbox_ids = set(ENERGY_SOURCES), set(WALLBOXES)
+    for entry in entries:
+        if entry["id"] in sites:
+            raise ValueError(f"Site {entry['id']}: duplicate site id")
+        site = build_site(entry)
+        if source_ids & set(site.sources) or wallbox_ids & set(site.wallboxes):
+            raise ValueError(f"Site {site.site_id}: source and wallbox ids must be unique over all sites")
+        bind_poll_targets(site)
+        source_ids |= set(site.sources)
+        wallbox_ids |= set(site.wallboxes)
+        sites[site.site_id] = site
+    logger.info(f"Loaded {len(entries)} further sites from {path}")
+    return sites
+
+
+SITES: dict[str, Site] = load_sites()
+
+_push_sources = [source for site in SITES.values() for source in site.push_sources]
+
+
+def get_site(site_id: str) -> Site:
+    """KeyError for unknown site ids."""
+    return SITES[site_id]
+
+
+def default_site() -> Site:
+    return SITES[DEFAULT_SITE_ID]
+
+
+def handle_datagram(data: bytes, ip: str) -> bool:
+    """Hand a meter datagram to the push source (of any site) it belongs to."""
+    return source_polling.handle_datagram(data, ip, _push_sources)
+
+
+def stats() -> list[dict]:
+    return [site.stats() for site in SITES.values()]
@@ -12,12 +12,23 @@ Key design decisions
 * Decreases are applied immediately, lowest-priority wallbox first.
 * If a Wallbox (e.g. KEBA) reports the car is fully charged (meter = ~0 W) we skip increases
   for that wallbox.
+* Power and current are converted through the learned model of each wallbox
+  (see power_model.py), not the nominal 230 V × A × phases.
 """
 
 import asyncio
+import contextvars
 import logging
 import math
+from concurrent.futures import Executor
+from typing import Optional
+
+from modbus_interaction import ModbusWriteError
 from wallbox.wallbox_base import WallboxBase, CHARGING_STATES
+import charging_planner
+import polling_policy
+import power_model
+import regulation_trace
 import shared_state
 
 ONE_PHASE_VOLTAGE   = 230          # V
@@ -25,6 +36,10 @@ POWER_DELTA         = 200          # W always kept as buffer
 MIN_CHARGING_CURRENT = 6000        # mA  (IEC 61851 minimum)
 MAX_CHARGING_CURRENT = 16000       # mA
 
+# Below home_bat_min_soc the home battery keeps at least this charging power (W);
+# only charging power above it counts as excess
+HOME_BATTERY_MIN_CHARGING_W = 1000
+
 # How long to wait after a current *increase* before re-reading excess power
 # for the next wallbox in the queue.
 INTER_WALLBOX_INCREASE_DELAY_S = 10
@@ -39,48 +54,56 @@ def _min_start_power(number_of_phases: int) -> int:
     return math.floor(number_of_phases * ONE_PHASE_VOLTAGE * MIN_CHARGING_CURRENT / 1000)
 
 
-def _calculate_battery_excess() -> int:
+def _calculate_battery_excess(state=shared_state) -> int:
     """
     Return battery contribution to excess power (W).
     Negative → battery is still absorbing power (priority: charge battery first).
     Positive → battery is discharging or above min-SoC threshold.
     """
     if (
-        shared_state.battery_SoC < shared_state.home_bat_min_soc
-        and shared_state.battery_power < 0
+        state.battery_SoC < state.home_bat_min_soc
+        and state.battery_power < 0
     ):
-        if (shared_state.battery_power < -1000):
-            # battery should at least charge with 1000W - rest can be counted as exceeding power
-            excess = -(shared_state.battery_power + 1000)
+        if (state.battery_power < -HOME_BATTERY_MIN_CHARGING_W):
+            # battery should at least charge with HOME_BATTERY_MIN_CHARGING_W - rest can be counted as exceeding power
+            excess = -(state.battery_power + HOME_BATTERY_MIN_CHARGING_W)
             logger.debug(
-                f"Home battery charging below min SoC "
-                f"({shared_state.battery_SoC}% < {shared_state.home_bat_min_soc}%). "
-                f"Battery charging with {shared_state.battery_power}. "
-                f"Counting {excess} W as excess poewr. "
+                "Home battery charging below min SoC (%s%% < %s%%). "
+                "Battery charging with %s. Counting %s W as excess power.",
+                state.battery_SoC, state.home_bat_min_soc, state.battery_power, excess,
             )
             return excess
         else:
             logger.debug(
-                f"Home battery charging below min SoC "
-                f"({shared_state.battery_SoC}% < {shared_state.home_bat_min_soc}%). "
-                f"Not counting battery power as excess."
+                "Home battery charging below min SoC (%s%% < %s%%). Not counting battery power as excess.",
+                state.battery_SoC, state.home_bat_min_soc,
             )
             return 0
-    logger.debug(f"Battery excess power: {-shared_state.battery_power} W")
-    return (-shared_state.battery_power)
+    logger.debug("Battery excess power: %s W", -state.battery_power)
+    return (-state.battery_power)
 
 
-def _current_excess_power() -> int:
+def _current_excess_power(state=shared_state) -> int:
     """
     Total excess solar power available right now (W).
     grid_power is in 0.1 W units: negative = feed-in.
+    state: shared_state (default site) or a SiteState.
     """
-    grid_excess  = shared_state.grid_power / -10   # positive when feeding in
-    batt_excess  = _calculate_battery_excess()
+    grid_excess  = state.grid_power / -10   # positive when feeding in
+    batt_excess  = _calculate_battery_excess(state)
     excess       = grid_excess + batt_excess - POWER_DELTA
+    regulation_trace.record_inputs(
+        grid_power=state.grid_power / 10,
+        battery_power=state.battery_power,
+        battery_SoC=state.battery_SoC,
+        home_bat_min_soc=state.home_bat_min_soc,
+        grid_excess=grid_excess,
+        battery_excess=batt_excess,
+        excess=excess,
+    )
     logger.debug(
-        f"Excess power: grid={grid_excess:.0f}W  batt={batt_excess:.0f}W  "
-        f"delta={POWER_DELTA}W  → net={excess:.0f}W"
+        "Excess power: grid=%.0fW  batt=%.0fW  delta=%sW  → net=%.0fW",
+        grid_excess, batt_excess, POWER_DELTA, excess,
     )
     return excess
 
@@ -93,34 +116,50 @@ def _set_current(wallbox: WallboxBase, wb_state: dict, new_current: int) -> int:
     - new_current == 0  → pause_charging()
     - new_current > 0   → resume if paused, then write current with appropriate precision
 
-    Returns the power actually changed in W, or 0 for no change.
+    Returns the power actually changed in W (estimated by the wallbox's power
+    model), or 0 for no change. A failed write counts as no change and leaves
+    wb_state as the device has it.
     Negative return value -> more power available now.
     Positive return value -> more power used now.
     """
+    try:
+        return _write_current(wallbox, wb_state, new_current)
+    except ModbusWriteError as e:
+        logger.warning(f"⚠️ [{wallbox.name}] Setting {new_current} mA failed: {e}")
+        regulation_trace.record("decision", wallbox=wallbox.name, action="write_failed", target=new_current)
+        return 0
+
+
+def _write_current(wallbox: WallboxBase, wb_state: dict, new_current: int) -> int:
     current_val = wb_state["maximum_current"]
+    model = power_model.for_state(wallbox.wallbox_id, wb_state)
+
+    with wallbox.exclusive_access():
+        # Treat "pause" specially
+        if new_current < MIN_CHARGING_CURRENT:
+            if not wb_state["paused"]:
+                logger.info(f"[{wallbox.name}] Pausing charging.")
+                wallbox.pause_charging()
+                wb_state["maximum_current"] = 0
+                wb_state["paused"] = True
+                model.note_current_change()
+                return math.floor(model.power_w(0) - model.power_w(current_val))
+            return 0  # already paused
+
+        # Resume if previously paused
+        if wb_state["paused"]:
+            logger.info(f"[{wallbox.name}] Resuming charging.")
+            wallbox.resume_charging()
+            wb_state["paused"] = False
 
-    # Treat "pause" specially
-    if new_current < MIN_CHARGING_CURRENT:
-        if not wb_state["paused"]:
-            logger.info(f"[{wallbox.name}] Pausing charging.")
-            wallbox.pause_charging()
-            wb_state["maximum_current"] = 0
-            wb_state["paused"] = True
-            return _calculate_power_from_current(0 - current_val, wb_state['number_of_phases_used'])
-        return 0  # already paused
-    
-    # Resume if previously paused
-    if wb_state["paused"]:
-        logger.info(f"[{wallbox.name}] Resuming charging.")
-        wallbox.resume_charging()
-        wb_state["paused"] = False
-
-    logger.info(
-        f"[{wallbox.name}] Setting current: {current_val} A → {new_current} A"
-    )
-    wallbox.write_max_current(new_current)
+        logger.info(
+            f"[{wallbox.name}] Setting current: {current_val} mA → {new_current} mA"
+        )
+        wallbox.write_max_current(new_current)
     wb_state["maximum_current"] = new_current
-    return _calculate_power_from_current(new_current - current_val, wb_state['number_of_phases_used'])
+    if new_current != current_val:
+        model.note_current_change()
+    return math.floor(model.power_w(new_current) - model.power_w(current_val))
 
 
 def _update_wb_state(wallbox: WallboxBase, wb_state: dict):
@@ -141,12 +180,18 @@ def _calculate_power_from_current(milliampere: int, number_of_phases_used: int)
     """
     return math.floor(ONE_PHASE_VOLTAGE * (milliampere/1000) * number_of_phases_used)
 
-def _calculate_wallbox_target_current(current_current: int, excess_power: int, number_of_phases_used: int) -> int:
+def _calculate_wallbox_target_current(
+    current_current: int, excess_power: int, number_of_phases_used: int, model: Optional[power_model.PowerModel] = None
+) -> int:
     """
     calculate target current for wallbox based on excess power and number of phases used plus the current value for charging
+    model: learned power model of the wallbox (None: nominal 230 V per phase); the
+    target is the current at which the car draws its present power plus the excess
     returns the value in mA
     """
-    return math.floor(excess_power / number_of_phases_used / ONE_PHASE_VOLTAGE) + current_current
+    if model is not None:
+        return math.floor(model.current_ma(model.power_w(current_current) + excess_power))
+    return math.floor(excess_power / number_of_phases_used / ONE_PHASE_VOLTAGE * 1000) + current_current
 
 
 def regulate_single_wallbox(wallbox: WallboxBase, wb_state: dict, excess_power: int) -> int:
@@ -162,30 +207,73 @@ def regulate_single_wallbox(wallbox: WallboxBase, wb_state: dict, excess_power:
     """
     phases = wb_state["number_of_phases_used"]
 
-    _update_wb_state(wallbox, wb_state)
+    # Disconnected / idle / unchanged wallboxes are re-read less often (see polling_policy);
+    # in between the cached state is used
+    poll = polling_policy.wallbox(wallbox.wallbox_id)
+    if poll.due():
+        with regulation_trace.span("update_wb_state", wallbox=wallbox.name):
+            _update_wb_state(wallbox, wb_state)
+        power_model.observe_state(wallbox.wallbox_id, wb_state)
+        poll.record(
+            polling_policy.wallbox_poll_value(wb_state),
+            active=wb_state["charging_state"] in (3, 4),
+            disconnected=wb_state["charging_state"] == 1,
+        )
 
     # Only regulate when a vehicle is connected (states 2, 3, 4)
     if wb_state["charging_state"] not in (2, 3, 4):
         logger.debug(
-            f"[{wallbox.name}] State {CHARGING_STATES.get(wb_state['charging_state'])} – skipping regulation."
+            "[%s] State %s – skipping regulation.", wallbox.name, CHARGING_STATES.get(wb_state["charging_state"])
+        )
+        regulation_trace.record(
+            "decision", wallbox=wallbox.name, action="skip", charging_state=wb_state["charging_state"]
         )
         return 0
 
-    target_current = _calculate_wallbox_target_current(wb_state["maximum_current"], excess_power, wb_state["number_of_phases_used"])
+    model = power_model.for_state(wallbox.wallbox_id, wb_state)
+    available_power = model.power_w(wb_state["maximum_current"]) + excess_power
+    if available_power < _min_start_power(model.phases):
+        # not enough for the minimum current on the phases the car actually draws on → pause
+        target_current = 0
+    else:
+        target_current = min(
+            max(
+                _calculate_wallbox_target_current(wb_state["maximum_current"], excess_power, phases, model),
+                MIN_CHARGING_CURRENT,
+            ),
+            MAX_CHARGING_CURRENT,
+        )
+
+    # A departure-time plan may need grid top-up: never go below its floor current
+    plan_floor = charging_planner.floor_current(wallbox.wallbox_id)
+    if target_current < plan_floor:
+        logger.debug("[%s] Charging plan floor %s mA above solar target %s mA", wallbox.name, plan_floor, target_current)
+        target_current = plan_floor
 
     if wallbox.is_car_fully_charged():
         logger.info(
         f"[{wallbox.name}] Car fully charged (meter reads ~0 W). "
         "Setting current to default value."
         )
+        regulation_trace.record(
+            "decision", wallbox=wallbox.name, action="fully_charged",
+            current=wb_state["maximum_current"], target=MAX_CHARGING_CURRENT,
+        )
         return _set_current(wallbox, wb_state, MAX_CHARGING_CURRENT)
-    
+
+    regulation_trace.record(
+        "decision", wallbox=wallbox.name, action="set_current", excess=excess_power, phases=phases,
+        current=wb_state["maximum_current"], target=target_current, paused=wb_state["paused"],
+        plan_floor=plan_floor, watts_per_ma=round(model.watts_per_ma, 4), model_phases=model.phases,
+    )
     return _set_current(wallbox, wb_state, target_current)
 
 
 # ── Multi-wallbox regulation loop (called by rest_api background task) ─────────
 
-async def regulate_all_wallboxes_solar(wallboxes: dict, wb_states: dict):
+async def regulate_all_wallboxes_solar(
+    wallboxes: dict, wb_states: dict, state=shared_state, executor: Optional[Executor] = None
+):
     """
     Full regulation pass over all solar-only wallboxes.
 
@@ -199,9 +287,30 @@ async def regulate_all_wallboxes_solar(wallboxes: dict, wb_states: dict):
       Apply highest priority first.
       After each increase, wait INTER_WALLBOX_INCREASE_DELAY_S seconds so the
       grid meter can reflect the new load before we allocate power to the next.
+
+    state: shared_state or the SiteState of the site the wallboxes belong to.
+    executor: runs the wallbox I/O, so a slow device blocks only this site's
+    threads and not the event loop (None: the default thread pool).
     """
-    from wallbox.wallbox_config import WALLBOXES
+    trace = regulation_trace.start_cycle()
+    try:
+        await _regulate_all_wallboxes_solar(wallboxes, wb_states, state, executor)
+    finally:
+        regulation_trace.finish_cycle(trace)
+
+
+async def _regulate_single_wallbox(executor: Optional[Executor], wallbox: WallboxBase, wb_state: dict, excess: int) -> int:
+    if executor is None:
+        # asyncio.to_thread copies the context as well
+        return await asyncio.to_thread(regulate_single_wallbox, wallbox, wb_state, excess)
+    # copy the context so the wallbox's decisions land in this cycle's trace
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, context.run, regulate_single_wallbox, wallbox, wb_state, excess
+    )
+
 
+async def _regulate_all_wallboxes_solar(wallboxes: dict, wb_states: dict, state, executor: Optional[Executor]):
     solar_wbs = [
         (wb_id, wb_states[wb_id])
         for wb_id in wallboxes
@@ -209,30 +318,45 @@ async def regulate_all_wallboxes_solar(wallboxes: dict, wb_states: dict):
     ]
 
     if not solar_wbs:
+        regulation_trace.record("decision", action="no_solar_only_wallboxes")
         return
 
-    excess = _current_excess_power()
+    excess = _current_excess_power(state)
 
     if excess <= 0:
         # ── Decrease pass: lowest priority first ──────────────────────
         sorted_decrease = sorted(solar_wbs, key=lambda x: -x[1]["priority"])
+        regulation_trace.record("pass", direction="decrease")
         for wb_id, wb_state in sorted_decrease:
-            wb = WALLBOXES[wb_id]
-            delta = regulate_single_wallbox(wb, wb_state, excess)
+            wb = wallboxes[wb_id]
+            delta = await _regulate_single_wallbox(executor, wb, wb_state, excess)
             if delta != 0.0:
                 # Immediately recalculate for next wallbox
-                excess = _current_excess_power()
+                excess = _current_excess_power(state)
     else:
         # ── Increase pass: highest priority first ─────────────────────
         sorted_increase = sorted(solar_wbs, key=lambda x: x[1]["priority"])
+        regulation_trace.record("pass", direction="increase")
         for wb_id, wb_state in sorted_increase:
-            wb = WALLBOXES[wb_id]
-            delta = regulate_single_wallbox(wb, wb_state, excess)
+            wb = wallboxes[wb_id]
+            current_before = wb_state["maximum_current"]
+            delta = await _regulate_single_wallbox(executor, wb, wb_state, excess)
             if delta > 0:
                 logger.info(
                     f"[{wb.name}] Increased by ~{delta:.0f} W. "
                     f"Waiting {INTER_WALLBOX_INCREASE_DELAY_S}s for grid meter to settle…"
                 )
+                regulation_trace.record(
+                    "sleep", wallbox=wb.name, seconds=INTER_WALLBOX_INCREASE_DELAY_S, reason="grid meter settle"
+                )
                 await asyncio.sleep(INTER_WALLBOX_INCREASE_DELAY_S)
-                excess = _current_excess_power()
+                settled_excess = _current_excess_power(state)
+                # the grid response teaches the power model of wallboxes without a meter
+                model = power_model.for_state(wb_id, wb_state)
+                model.observe_step(
+                    wb_state["maximum_current"] - current_before,
+                    excess - settled_excess,
+                    model.power_w(current_before) + excess - settled_excess,
+                )
+                excess = settled_excess
             # If no change or decrease happened, continue without waiting
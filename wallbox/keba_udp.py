@@ -0,0 +1,161 @@
+"""
+keba_udp.py
+
+UDP report transport for the KEBA P30 family (optional, see KebaP30X udp=True).
+
+The KEBA UDP interface (enable it in the wallbox's web interface) listens on
+port 7090 and answers to port 7090 of the sender, so one socket serves every
+KEBA of the process:
+  "report 2"  → JSON with "State" (same codes as Modbus 1000), "Max curr" (mA), ...
+  "report 3"  → JSON with "P" (active power, mW), "E pres", ...
+Between reports the wallbox pushes changes on its own ({"State": 3},
+{"Max curr": 16000}, {"E pres": ...}).
+
+A background thread requests both reports from every registered wallbox
+every KEBA_UDP_REPORT_INTERVAL_S and hands every received value to the driver,
+which answers reads from memory while the value is fresh and falls back to
+Modbus otherwise.
+"""
+
+import json
+import logging
+import socket
+import threading
+import time
+from typing import Optional
+
+KEBA_UDP_PORT = 7090
+
+KEBA_UDP_REPORT_INTERVAL_S = 5
+# values older than this are not used (two reports lost); reads go to Modbus then
+KEBA_UDP_MAX_AGE_S = 2 * KEBA_UDP_REPORT_INTERVAL_S + 1
+# the KEBA needs at least 100 ms between two commands
+KEBA_UDP_COMMAND_GAP_S = 0.1
+# answers to reports requested before a write can arrive after it: this long
+# after a write, values of the written fields are only taken when they show
+# the written value
+KEBA_UDP_WRITE_SETTLE_S = 1.5
+KEBA_UDP_DATAGRAM_MAX_BYTES = 2048
+
+# report key → driver cache field
+REPORT_FIELDS = {
+    "State":    "charging_state",
+    "Max curr": "max_current",
+    "P":        "active_power",
+}
+
+logger = logging.getLogger(__name__)
+
+
+class KebaUdpTransport:
+    def __init__(self, port: int = KEBA_UDP_PORT):
+        self.port = port
+        self._wallboxes: dict[str, object] = {}      # ip → KebaP30X
+        self._lock = threading.Lock()
+        self._sock: Optional[socket.socket] = None
+        self._started = False
+        self.datagrams = 0
+        self.requests = 0
+
+    def register(self, wallbox) -> bool:
+        """Receive the reports of this wallbox; False when the UDP port is not available."""
+        with self._lock:
+            self._wallboxes[wallbox.ip] = wallbox
+            if not self._started:
+                self._started = True
+                try:
+                    self._sock = self._open_socket()
+                except OSError as e:
+                    logger.warning(f"⚠️ KEBA UDP port {self.port} not available ({e}) – using Modbus only")
+                    return False
+                threading.Thread(target=self._run, name="keba_udp", daemon=True).start()
+                logger.info(f"✅ KEBA UDP reports on port {self.port}")
+            return self._sock is not None
+
+    def request_reports(self, ip: str, reports: tuple[int, ...] = (2, 3)) -> None:
+        """Ask one wallbox for fresh reports now (e.g. report 2 after a write)."""
+        if self._sock is None:
+            return
+        try:
+            for index, report in enumerate(reports):
+                if index:
+                    time.sleep(KEBA_UDP_COMMAND_GAP_S)
+                self._sock.sendto(f"report {report}".encode(), (ip, self.port))
+                self.requests += 1
+        except OSError as e:
+            logger.warning("⚠️ KEBA UDP request to %s failed: %s", ip, e)
+
+    def _open_socket(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(("", self.port))
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _run(self) -> None:
+        next_request = 0.0
+        while True:
+            now = time.monotonic()
+            if now >= next_request:
+                with self._lock:
+                    ips = list(self._wallboxes)
+                for ip in ips:
+                    self.request_reports(ip)
+                    time.sleep(KEBA_UDP_COMMAND_GAP_S)
+                next_request = time.monotonic() + KEBA_UDP_REPORT_INTERVAL_S
+
+            self._sock.settimeout(max(next_request - time.monotonic(), 0.01))
+            try:
+                data, (ip, _) = self._sock.recvfrom(KEBA_UDP_DATAGRAM_MAX_BYTES)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                logger.warning("⚠️ KEBA UDP socket error: %s", e)
+                time.sleep(1)
+                continue
+            self._handle_datagram(data, ip)
+
+    def _handle_datagram(self, data: bytes, ip: str) -> None:
+        wallbox = self._wallboxes.get(ip)
+        if wallbox is None:
+            return
+        try:
+            report = json.loads(data)
+        except ValueError:
+            return   # command acknowledgements ("TCH-OK :done") and other text
+        if not isinstance(report, dict):
+            return
+        self.datagrams += 1
+        received_at = time.monotonic()
+        for key, field in REPORT_FIELDS.items():
+            if key in report:
+                try:
+                    wallbox.update_udp_value(field, int(report[key]), received_at)
+                except (TypeError, ValueError):
+                    logger.debug("KEBA UDP %s: bad %s value %r", ip, key, report[key])
+
+    def stats(self) -> dict:
+        with self._lock:
+            wallboxes = list(self._wallboxes)
+        return {
+            "port": self.port,
+            "active": self._sock is not None,
+            "wallboxes": wallboxes,
+            "datagrams": self.datagrams,
+            "requests": self.requests,
+        }
+
+
+_transport: Optional[KebaUdpTransport] = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> KebaUdpTransport:
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = KebaUdpTransport()
+        return _transport
@@ -6,6 +6,7 @@ Each wallbox type subclasses this and overrides hardware-specific methods.
 """
 
 from abc import ABC, abstractmethod
+from contextlib import nullcontext
 import logging
 
 logger = logging.getLogger(__name__)
@@ -37,6 +38,13 @@ class WallboxBase(ABC):
     Optional override:
       - is_car_fully_charged() -> bool (True if meter shows ~0 W draw while cable connected)
         Default returns False (no meter available).
+      - read_active_power_w() -> float | None (metered charging power in W).
+        Default returns None (no meter available).
+      - exclusive_access()             (context manager holding the device for a
+        multi-step command, e.g. resume + write). Default does nothing.
+      - handover_state() / restore_handover_state(state)
+                                       driver state a restarted process must keep
+                                       (JSON values). Default: none.
     """
 
     def __init__(self, wallbox_id: int, name: str, number_of_phases: int):
@@ -83,6 +91,26 @@ class WallboxBase(ABC):
         """
         return False
 
+    def read_active_power_w(self):
+        """
+        Return the charging power in W measured by the wallbox.
+        Wallboxes without a power meter return None.
+        """
+        return None
+
+    def exclusive_access(self):
+        """
+        Context manager that keeps other callers off the device while a
+        sequence of reads/writes is executed.
+        """
+        return nullcontext()
+
+    def handover_state(self) -> dict:
+        return {}
+
+    def restore_handover_state(self, state: dict) -> None:
+        pass
+
 
     # ------------------------------------------------------------------
     # Convenience
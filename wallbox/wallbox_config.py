@@ -4,16 +4,29 @@ wallbox_config.py
 Central registry of all configured wallboxes.
 Each wallbox is instantiated here; solar_charging and rest_api import
 WALLBOXES directly and never need to know the concrete class.
+Wallboxes of further sites are built from config entries (see sites.py).
 """
 
+import os
+
 from wallbox.wallbox_base import WallboxBase
 from wallbox.wallbox_juice import JuiceChargerMe
 from wallbox.wallbox_keba import KebaP30X
 
+# config "type" → class
+WALLBOX_TYPES = {
+    "juice": JuiceChargerMe,
+    "keba":  KebaP30X,
+}
+
 # ── Network addresses ──────────────────────────────────────────────────────────
 CHARGER_ME_IP   = "192.168.188.94"
 KEBA_WALLBOX_IP = "192.168.188.132"
 
+# Read the KEBA from its UDP reports instead of polling Modbus (UDP interface
+# must be enabled on the wallbox, see keba_udp.py)
+KEBA_UDP_ENABLED = os.environ.get("PV_BACKEND_KEBA_UDP", "0") == "1"
+
 # ── Wallbox instances ──────────────────────────────────────────────────────────
 # number_of_phases: phases the *car* uses for charging.
 #   Adjust via the REST API (/wallbox/{id}/number_of_phases_used) at runtime.
@@ -35,5 +48,23 @@ WALLBOXES: dict[int, "WallboxBase"] = {
         number_of_phases=3,          # default; overrideable via API
         ip=KEBA_WALLBOX_IP,
         modbus_port=1502,
+        udp=KEBA_UDP_ENABLED,
     ),
 }
+
+
+def build_wallboxes(entries: list[dict]) -> dict[int, "WallboxBase"]:
+    """
+    Wallboxes from config entries like
+      {"id": 3, "type": "keba", "name": "Carport", "number_of_phases": 3,
+       "ip": "10.0.2.20", "modbus_port": 502}
+    """
+    wallboxes = {}
+    for entry in entries:
+        params = dict(entry)
+        wallbox_id = params.pop("id")
+        wallbox_type = params.pop("type")
+        if wallbox_type not in WALLBOX_TYPES:
+            raise ValueError(f"Wallbox {wallbox_id}: unknown type {wallbox_type!r}")
+        wallboxes[wallbox_id] = WALLBOX_TYPES[wallbox_type](wallbox_id=wallbox_id, **params)
+    return wallboxes
@@ -10,7 +10,7 @@ Pause:          write 0 A to register 1000  (device supports 0 A)
 
 import logging
 import math
-from modbus_interaction import read_modbus_data, write_modbus_data
+from modbus_interaction import device_slot, read_modbus_data, write_modbus_data
 from wallbox.wallbox_base import WallboxBase
 
 logger = logging.getLogger(__name__)
@@ -56,7 +56,7 @@ class JuiceChargerMe(WallboxBase):
             )[0]
             return value if value is not None else 0
         except Exception as e:
-            logger.error(f"Error reading charging state {self.ip}:{self.register} - {e}")
+            logger.error("Error reading charging state %s:%s - %s", self.ip, CHARGING_STATE_REGISTER, e)
             return 0  # Return 0 in case of an exception
 
     def read_max_current(self) -> int:
@@ -70,28 +70,35 @@ class JuiceChargerMe(WallboxBase):
             )[0]
             return value * 1000 if value is not None else 0
         except Exception as e:
-            logger.error(f"Error max current {self.ip}:{self.register} - {e}")
+            logger.error("Error max current %s:%s - %s", self.ip, MAX_CURRENT_REGISTER, e)
             return 0  # Return 0 in case of an exception
 
     def write_max_current(self, milliampere:int) -> None:
         """Write integer Ampere. Juice only supports whole Ampere steps. Therefore in this Method milliampere are floored to ampere"""
         ampere_int = math.floor(milliampere/1000)
 
-        # Check whether the value actually changed
-        old_current = self.read_max_current()
-        if abs(milliampere - old_current) < 1000:
-            logger.debug(f"[{self.name}] not setting current because of no change. Old: {old_current} mA, New:{milliampere} mA")
-            return
+        with self.exclusive_access():
+            # Check whether the value actually changed
+            old_current = self.read_max_current()
+            if abs(milliampere - old_current) < 1000:
+                logger.debug(
+                    "[%s] not setting current because of no change. Old: %s mA, New:%s mA",
+                    self.name, old_current, milliampere,
+                )
+                return
 
-        write_modbus_data(
-            ip=self.ip,
-            modbus_port=self.modbus_port,
-            register=MAX_CURRENT_REGISTER,
-            slave=self.slave,
-            value=ampere_int,
-        )
+            write_modbus_data(
+                ip=self.ip,
+                modbus_port=self.modbus_port,
+                register=MAX_CURRENT_REGISTER,
+                slave=self.slave,
+                value=ampere_int,
+            )
 
     def pause_charging(self) -> None:
         """Juice Charger Me supports pausing by writing 0 A."""
         logger.info(f"[{self.name}] Pausing charging (setting current to 0 A)")
         self.write_max_current(PAUSE_CURRENT)
+
+    def exclusive_access(self):
+        return device_slot(self.ip, self.modbus_port, self.slave)
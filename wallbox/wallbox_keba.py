@@ -6,7 +6,7 @@ Concrete implementation for the KEBA P30 X wallbox.
 Register map (read):
   1000 – Charging state (KEBA-specific codes, see mapping below)
   1004 – Cable state
-  1020 – Active power (W)          ← used for is_car_fully_charged()
+  1020 – Active power (mW)         ← used for is_car_fully_charged()
   1100 – Max charging current (mA) ← read back
   1110 – Max supported current (mA)
 
@@ -16,10 +16,19 @@ Register map (write):
 
 Pause/resume:
   KEBA does NOT support 0 A. Pause via register 5014 = 0, resume via 5014 = 1.
+
+With udp=True charging state, active power and max current come from the
+KEBA UDP reports (see keba_udp.py) while they are fresh; Modbus is the
+fallback. Writes stay on Modbus.
 """
 
 import logging
-from modbus_interaction import write_modbus_data, read_modbus_data
+import time
+from typing import Optional
+
+import polling_policy
+from modbus_interaction import device_slot, write_modbus_data, read_modbus_data
+from wallbox import keba_udp
 from wallbox.wallbox_base import WallboxBase
 
 logger = logging.getLogger(__name__)
@@ -65,22 +74,70 @@ class KebaP30X(WallboxBase):
         ip: str,
         modbus_port: int,
         slave: int = MODBUS_SLAVE,
+        udp: bool = False,
     ):
         super().__init__(wallbox_id, name, number_of_phases)
         self.ip = ip
         self.modbus_port = modbus_port
         self.slave = slave
         self._enabled = True  # track enable state to avoid redundant writes
+        self.udp = udp
+        self._udp_registered = False
+        # UDP report cache: field → (value, monotonic receive time)
+        self._udp_values: dict[str, tuple[int, float]] = {}
+        # fields changed by a write: field → (monotonic write time, written value or None)
+        self._udp_written: dict[str, tuple[float, Optional[int]]] = {}
 
     @staticmethod
     def _combine_registers(registers: list[int]) -> int:
         if len(registers) != 2:
-            logger.error(f"Error reading charging state for Keba wallbox")
+            logger.error("Error reading charging state for Keba wallbox")
             return None
         
         return (registers[0] << 16) | registers[1]
     
         
+    # ------------------------------------------------------------------
+    # UDP report cache
+    # ------------------------------------------------------------------
+
+    def update_udp_value(self, field: str, value: int, received_at: float) -> None:
+        """Called by the UDP transport for every reported value."""
+        written = self._udp_written.get(field)
+        if written is not None:
+            written_at, written_value = written
+            if received_at - written_at < keba_udp.KEBA_UDP_WRITE_SETTLE_S and value != written_value:
+                return   # answer to a report requested before the write
+            self._udp_written.pop(field, None)
+        previous = self._udp_values.get(field)
+        self._udp_values[field] = (value, received_at)
+        if field == "charging_state" and (previous is None or previous[0] != value):
+            # plugged in / unplugged / started: read the wallbox now, not at its next slow poll
+            polling_policy.wake(polling_policy.wallbox_target_name(self.wallbox_id))
+
+    def _udp_value(self, field: str) -> Optional[int]:
+        """Fresh reported value, or None (UDP off, nothing received yet, too old)."""
+        if not self.udp:
+            return None
+        if not self._udp_registered:
+            # registered on first use, so processes that never read (API workers) do not bind the port
+            self._udp_registered = True
+            self.udp = keba_udp.get_transport().register(self)
+        entry = self._udp_values.get(field)
+        if entry is None or time.monotonic() - entry[1] > keba_udp.KEBA_UDP_MAX_AGE_S:
+            return None
+        return entry[0]
+
+    def _invalidate_udp_values(self, *fields: str, written: Optional[int] = None) -> None:
+        """
+        Drop values a write changed; reads use Modbus until a report from after
+        the write arrives. written: the value the write set (single field), if known.
+        """
+        now = time.monotonic()
+        for field in fields:
+            self._udp_written[field] = (now, written)
+            self._udp_values.pop(field, None)
+
     # ------------------------------------------------------------------
     # Abstract implementations
     # ------------------------------------------------------------------
@@ -90,6 +147,10 @@ class KebaP30X(WallboxBase):
         Register 1000 returns KEBA-specific codes.
         Map to unified IEC 61851 codes via KEBA_STATE_MAP.
         """
+        reported = self._udp_value("charging_state")
+        if reported is not None:
+            return KEBA_STATE_MAP.get(reported, 0)
+
         registers = read_modbus_data(
             ip=self.ip,
             modbus_port=self.modbus_port,
@@ -100,17 +161,21 @@ class KebaP30X(WallboxBase):
         
         charging_state = self._combine_registers(registers)
         if charging_state is None:
-            logger.error(f"Error reading charging state for Keba wallbox")
+            logger.error("Error reading charging state for Keba wallbox")
             return 4
         
         unified = KEBA_STATE_MAP.get(charging_state, 0)
-        logger.debug(f"[{self.name}] Charging state raw={charging_state} → unified={unified}")
+        logger.debug("[%s] Charging state raw=%s → unified=%s", self.name, charging_state, unified)
         return unified
 
     def read_max_current(self) -> int:
         """
         Register 1100 returns current in mA.
         """
+        reported = self._udp_value("max_current")
+        if reported is not None:
+            return reported
+
         registers = read_modbus_data(
             ip=self.ip,
             modbus_port=self.modbus_port,
@@ -121,7 +186,7 @@ class KebaP30X(WallboxBase):
 
         value = self._combine_registers(registers)
         if value is None:
-            logger.error(f"Error reading max current for Keba wallbox")
+            logger.error("Error reading max current for Keba wallbox")
             return 0
         
         return value
@@ -132,20 +197,27 @@ class KebaP30X(WallboxBase):
         Write charging current. Accepts int in mA.
         """
 
-        # Check whether the value actually changed (within 0.05 A tolerance)
-        old_current = self.read_max_current()
-        if abs(milliampere - old_current) < 100:
-            logger.debug(f"[{self.name}] not setting current because of (nearly) no change. Old: {old_current} mA, New:{milliampere} mA")
-            return
+        with self.exclusive_access():
+            # Check whether the value actually changed (within 0.05 A tolerance)
+            old_current = self.read_max_current()
+            if abs(milliampere - old_current) < 100:
+                logger.debug(
+                    "[%s] not setting current because of (nearly) no change. Old: %s mA, New:%s mA",
+                    self.name, old_current, milliampere,
+                )
+                return
 
-        logger.debug(f"[{self.name}] Writing max current: {milliampere} mA")
-        write_modbus_data(
-            ip=self.ip,
-            modbus_port=self.modbus_port,
-            register=REG_SET_CURRENT,
-            slave=self.slave,
-            value=milliampere,
-        )
+            logger.debug("[%s] Writing max current: %s mA", self.name, milliampere)
+            write_modbus_data(
+                ip=self.ip,
+                modbus_port=self.modbus_port,
+                register=REG_SET_CURRENT,
+                slave=self.slave,
+                value=milliampere,
+            )
+            if self.udp:
+                self._invalidate_udp_values("max_current", written=milliampere)
+                keba_udp.get_transport().request_reports(self.ip, (2,))
 
     def pause_charging(self) -> None:
         """KEBA does not support 0 A. Pause via the enable/disable register."""
@@ -159,6 +231,7 @@ class KebaP30X(WallboxBase):
                 value=0,
             )
             self._enabled = False
+            self._invalidate_udp_values("charging_state", "active_power")
 
     def resume_charging(self) -> None:
         """Re-enable the charging station after a pause."""
@@ -172,6 +245,17 @@ class KebaP30X(WallboxBase):
                 value=1,
             )
             self._enabled = True
+            self._invalidate_udp_values("charging_state", "active_power")
+
+    def exclusive_access(self):
+        return device_slot(self.ip, self.modbus_port, self.slave)
+
+    def handover_state(self) -> dict:
+        # a paused station must be re-enabled by the new process
+        return {"enabled": self._enabled}
+
+    def restore_handover_state(self, state: dict) -> None:
+        self._enabled = state.get("enabled", True)
 
     # ------------------------------------------------------------------
     # Meter-based fully-charged detection
@@ -179,6 +263,10 @@ class KebaP30X(WallboxBase):
 
     def _read_active_power(self) -> int:
         """Return active power in mW from register 1020."""
+        reported = self._udp_value("active_power")
+        if reported is not None:
+            return reported
+
         registers = read_modbus_data(
             ip=self.ip,
             modbus_port=self.modbus_port,
@@ -188,11 +276,15 @@ class KebaP30X(WallboxBase):
         )
         value = self._combine_registers(registers=registers)
         if value is None:
-            logger.error(f"Error reading active power for Keba wallbox")
+            logger.error("Error reading active power for Keba wallbox")
             return 0
         
         return value
-    
+
+    def read_active_power_w(self) -> float:
+        """Active power from register 1020 converted to W."""
+        return self._read_active_power() / 1000
+
 
     def is_car_fully_charged(self) -> bool:
         """
@@ -203,11 +295,11 @@ class KebaP30X(WallboxBase):
         state = self.read_charging_state()
         if state not in (2, 3):
             return False  # not connected or not charging
-        power = self._read_active_power()
+        power = self.read_active_power_w()
         fully_charged = power < FULLY_CHARGED_POWER_THRESHOLD_W
         if fully_charged:
             logger.debug(
-                f"[{self.name}] Car appears fully charged "
-                f"(active power={power} W < {FULLY_CHARGED_POWER_THRESHOLD_W} W)"
+                "[%s] Car appears fully charged (active power=%s W < %s W)",
+                self.name, power, FULLY_CHARGED_POWER_THRESHOLD_W,
             )
         return fully_charged
\ No newline at end of file